@@ -286,8 +286,21 @@ class WVDialDialer(Dialer):
         self.attempting_connect = True
 
         self.proto = WVDialProtocol(self)
-        args = [self.binary, '-C', self.conf_path, 'connect']
-        self.iconn = reactor.spawnProcess(self.proto, args[0], args, env=None)
+
+        def spawn_wvdial(_):
+            if not self.attempting_connect:
+                # stopped meanwhile
+                return
+
+            args = [self.binary, '-C', self.conf_path, 'connect']
+            self.iconn = reactor.spawnProcess(self.proto, args[0], args,
+                                              env=None)
+
+        # wvdial must not open the data port before the channel pool
+        # has closed it
+        d = self.device.sconn.release_data_port()
+        d.addCallback(spawn_wvdial)
+        d.addErrback(self.proto.deferred.errback)
         return self.proto.deferred
 
     def stop(self):
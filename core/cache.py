@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Cache of the properties read from a device"""
+
+from __future__ import with_statement
+
+import os
+import pickle
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.python.failure import Failure
+
+# Events that invalidate cached properties
+EVENT_RADIO = 'radio'             # the radio was switched on or off
+EVENT_ACCESS_TECH = 'access_tech'  # ^MODE and the like
+EVENT_SETTINGS = 'settings'       # band, network mode or charset changed
+
+# The lifetime of a property: None for the whole session or the seconds
+# it is valid for; plus the events that invalidate it
+SESSION = None
+SIGNAL_TTL = 5
+REGISTRATION_TTL = 5
+
+CACHE_POLICIES = {
+    # never change while the device is plugged
+    'imei': (SESSION, ()),
+    'imsi': (SESSION, ()),
+    'iccid': (SESSION, ()),
+    'spn': (SESSION, ()),
+    'manufacturer_name': (SESSION, ()),
+    'card_model': (SESSION, ()),
+    'card_version': (SESSION, ()),
+    'bands': (SESSION, ()),
+    'charsets': (SESSION, ()),
+    'apn_range': (SESSION, ()),
+    'phonebook_size': (SESSION, ()),
+    # only change when we set them
+    'band': (SESSION, (EVENT_SETTINGS,)),
+    'network_mode': (SESSION, (EVENT_SETTINGS,)),
+    'charset': (SESSION, (EVENT_SETTINGS,)),
+    # also refreshed by the unsolicited notifications of the device
+    'signal': (SIGNAL_TTL, (EVENT_RADIO,)),
+    'registration': (REGISTRATION_TTL, (EVENT_RADIO, EVENT_ACCESS_TECH)),
+}
+
+# Getters of :class:`~core.middleware.WCDMAWrapper` cached as a whole
+CACHED_GETTERS = {
+    'get_imei': 'imei',
+    'get_imsi': 'imsi',
+    'get_iccid': 'iccid',
+    'get_spn': 'spn',
+    'get_manufacturer_name': 'manufacturer_name',
+    'get_card_model': 'card_model',
+    'get_card_version': 'card_version',
+    'get_bands': 'bands',
+    'get_charsets': 'charsets',
+    'get_apn_range': 'apn_range',
+    'get_phonebook_size': 'phonebook_size',
+    'get_band': 'band',
+    'get_network_mode': 'network_mode',
+    'get_charset': 'charset',
+}
+
+# Properties persisted by :class:`CapabilityStore` per IMEI and per ICCID
+DEVICE_PROPERTIES = ['manufacturer_name', 'card_model', 'card_version',
+                     'bands', 'charsets', 'apn_range']
+SIM_PROPERTIES = ['imsi', 'spn', 'phonebook_size']
+
+# Setters of :class:`~core.middleware.WCDMAWrapper` and the event they fire
+INVALIDATING_SETTERS = {
+    'set_band': EVENT_SETTINGS,
+    'set_network_mode': EVENT_SETTINGS,
+    'set_allowed_mode': EVENT_SETTINGS,
+    'set_charset': EVENT_SETTINGS,
+    'enable_radio': EVENT_RADIO,
+}
+
+
+class PropertyCache(object):
+    """
+    I cache the properties of a device as :obj:`CACHE_POLICIES` says
+
+    A property is kept for the session or for a number of seconds and is
+    dropped when any of its events is fired with :meth:`on_event`. The
+    notifications of the device refresh them with :meth:`update`.
+    Concurrent reads of a missing property share a single request.
+    """
+
+    def __init__(self, policies=CACHE_POLICIES, clock=reactor):
+        super(PropertyCache, self).__init__()
+        self.policies = policies
+        self.clock = clock
+        # {name: (expires, value)}, expires is None for the session
+        self.entries = {}
+        # {name: [deferreds waiting for the request in progress]}
+        self.waiting = {}
+        self.hits = {}
+        self.misses = {}
+
+    def _lookup(self, name):
+        try:
+            expires, value = self.entries[name]
+        except KeyError:
+            return False, None
+
+        if expires is not None and expires < self.clock.seconds():
+            del self.entries[name]
+            return False, None
+
+        return True, value
+
+    def get(self, name, fn, *callbacks):
+        """
+        Returns a deferred with the property ``name``
+
+        If it is not cached it is read calling ``fn`` and the result is
+        passed through ``callbacks`` before being cached.
+        """
+        found, value = self._lookup(name)
+        if found:
+            self.hits[name] = self.hits.get(name, 0) + 1
+            return defer.succeed(value)
+
+        self.misses[name] = self.misses.get(name, 0) + 1
+        d = defer.Deferred()
+        if name in self.waiting:
+            self.waiting[name].append(d)
+            return d
+
+        log.msg("get '%s' (noncached path)" % name, system='CACHE')
+        self.waiting[name] = [d]
+        request = defer.maybeDeferred(fn)
+        for cb in callbacks:
+            request.addCallback(cb)
+        request.addCallback(self.update, name)
+
+        def fire_waiters(result):
+            for waiter in self.waiting.pop(name, []):
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+
+        request.addBoth(fire_waiters)
+        return d
+
+    def update(self, value, name):
+        """
+        Caches ``value`` as the property ``name`` and returns it
+
+        None is not cached, the getters that log their errors return it
+        and the property would stay unknown for the whole session.
+        """
+        if value is None:
+            return value
+
+        ttl = self.policies.get(name, (SESSION, ()))[0]
+        expires = None if ttl is None else self.clock.seconds() + ttl
+        self.entries[name] = (expires, value)
+        return value
+
+    def invalidate(self, *names):
+        """Drops the properties ``names`` or all if none is given"""
+        if not names:
+            self.entries.clear()
+
+        for name in names:
+            self.entries.pop(name, None)
+
+    def on_event(self, event):
+        """Drops the properties invalidated by ``event``"""
+        names = [name for name, (ttl, events) in self.policies.iteritems()
+                    if event in events]
+        log.msg("'%s' invalidates %s" % (event, names), system='CACHE')
+        self.invalidate(*names)
+
+    def cached_getter(self, name, fn):
+        """Returns ``fn`` reading the property ``name`` through the cache"""
+
+        def getter():
+            return self.get(name, fn)
+
+        getter.__doc__ = fn.__doc__
+        return getter
+
+    def invalidating_setter(self, event, fn):
+        """Returns ``fn`` firing ``event`` once done, even if it failed"""
+
+        def setter(*args, **kwds):
+            d = defer.maybeDeferred(fn, *args, **kwds)
+
+            def fire_event(result):
+                self.on_event(event)
+                return result
+
+            d.addBoth(fire_event)
+            return d
+
+        setter.__doc__ = fn.__doc__
+        return setter
+
+    def install(self, obj):
+        """
+        Routes the getters and setters of ``obj`` through the cache
+
+        Instance attributes shadow the methods, including those overridden
+        by the device plugins, while their ``super`` calls are untouched.
+        """
+        for method, name in CACHED_GETTERS.iteritems():
+            if hasattr(obj, method):
+                setattr(obj, method,
+                        self.cached_getter(name, getattr(obj, method)))
+
+        for method, event in INVALIDATING_SETTERS.iteritems():
+            if hasattr(obj, method):
+                setattr(obj, method,
+                        self.invalidating_setter(event, getattr(obj, method)))
+
+    def to_dict(self):
+        """Returns the hits and misses of every property as a dict"""
+        names = set(self.hits) | set(self.misses)
+        return dict((name, dict(Hits=self.hits.get(name, 0),
+                                Misses=self.misses.get(name, 0),
+                                Cached=self._lookup(name)[0]))
+                    for name in names)
+
+
+def to_builtin(value):
+    """Returns ``value`` without dbus types, so it can be pickled"""
+    if isinstance(value, bool):
+        return bool(value)
+    if isinstance(value, (int, long)):
+        return long(value)
+    if isinstance(value, unicode):
+        return unicode(value)
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, tuple):
+        return tuple(map(to_builtin, value))
+    if isinstance(value, list):
+        return map(to_builtin, value)
+    return value
+
+
+def read_pickle(path, what):
+    """Returns the dict pickled in ``path`` or an empty one"""
+    try:
+        with open(path) as f:
+            return pickle.load(f)
+    except IOError:
+        return {}
+    except Exception, e:
+        log.err(e, "discarding corrupt %s file %s" % (what, path))
+        return {}
+
+
+def write_pickle(path, data, what):
+    """Pickles ``data`` to ``path`` replacing it atomically"""
+    tmp = path + '.tmp'
+    try:
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        with open(tmp, 'w') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    except (IOError, OSError), e:
+        log.err(e, "can not save %s to %s" % (what, path))
+
+
+class CapabilityStore(object):
+    """
+    I keep on disk what a device and its SIM told about themselves
+
+    The :obj:`DEVICE_PROPERTIES` are stored under the IMEI and the
+    :obj:`SIM_PROPERTIES` under the ICCID. On enable they are loaded into
+    the :class:`PropertyCache` once the IMEI is known and the ICCID has
+    been read again, so the enable sequence does not query the device
+    for them.
+    """
+
+    def __init__(self):
+        super(CapabilityStore, self).__init__()
+        self.path = None
+
+    def load(self, path):
+        """Uses the capabilities stored in ``path``"""
+        self.path = path
+
+    def seed(self, cache, imei, iccid=None):
+        """
+        Loads the capabilities of ``imei`` and ``iccid`` into ``cache``
+
+        :return: The names of the properties loaded
+        """
+        if self.path is None:
+            return []
+
+        stored = self._read()
+        props = dict(stored.get(('imei', imei), {}))
+        if iccid:
+            props.update(stored.get(('iccid', iccid), {}))
+
+        for name, value in props.iteritems():
+            if name not in cache.entries:
+                cache.update(value, name)
+
+        return sorted(props)
+
+    def record(self, cache, imei, iccid=None):
+        """Saves the capabilities of ``imei`` and ``iccid`` in ``cache``"""
+        if self.path is None:
+            return
+
+        def collect(names):
+            props = {}
+            for name in names:
+                found, value = cache._lookup(name)
+                if found:
+                    props[name] = to_builtin(value)
+            return props
+
+        stored = self._read()
+        stored[('imei', imei)] = collect(DEVICE_PROPERTIES)
+        if iccid:
+            stored[('iccid', iccid)] = collect(SIM_PROPERTIES)
+
+        write_pickle(self.path, stored, 'capabilities')
+
+    def _read(self):
+        return read_pickle(self.path, 'capabilities')
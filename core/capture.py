@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Serial traffic capture and replay
+
+A capture file starts with :obj:`CAPTURE_MAGIC` followed by records of
+a :obj:`RECORD_HEADER` and its data:
+
+ - :obj:`REC_PORT`: declares the port whose path is the data
+ - :obj:`REC_CMD`: the name of the command written in the next TX frame
+ - :obj:`REC_TX`: data written to the port
+ - :obj:`REC_RX`: data read from the port
+"""
+
+from __future__ import with_statement
+
+from collections import deque
+import struct
+from time import time
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from core.command import ATCmd
+
+CAPTURE_MAGIC = 'WADERCAP\x01'
+# type, port index, timestamp, data length
+RECORD_HEADER = struct.Struct('!BBdI')
+
+REC_PORT, REC_CMD, REC_TX, REC_RX = range(4)
+
+# Bytes buffered before the capture is written to disk
+CAPTURE_BUFFER_SIZE = 64 * 1024
+
+
+class TrafficCapture(object):
+    """
+    I record the traffic of one or more serial ports to ``path``
+
+    Frames are buffered in memory and written in blocks of
+    :obj:`CAPTURE_BUFFER_SIZE` so the capture stays cheap while enabled.
+    """
+
+    def __init__(self, path):
+        super(TrafficCapture, self).__init__()
+        self.path = path
+        self.ports = []
+        self.f = open(path, 'wb', CAPTURE_BUFFER_SIZE)
+        self.f.write(CAPTURE_MAGIC)
+
+    def _record(self, kind, port, data):
+        if self.f is None:
+            return
+
+        self.f.write(RECORD_HEADER.pack(kind, port, time(), len(data)))
+        self.f.write(data)
+
+    def add_port(self, path):
+        """Declares the port ``path`` and returns its index"""
+        if path not in self.ports:
+            self.ports.append(path)
+            self._record(REC_PORT, len(self.ports) - 1, path)
+
+        return self.ports.index(path)
+
+    def tx(self, port, data, name=None):
+        """Records ``data`` written to ``port`` by command ``name``"""
+        if name is not None:
+            self._record(REC_CMD, port, name)
+        self._record(REC_TX, port, str(data))
+
+    def rx(self, port, data):
+        """Records ``data`` read from ``port``"""
+        self._record(REC_RX, port, str(data))
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def read_capture(path):
+    """
+    Returns the frames of the capture at ``path``
+
+    :rtype: list of (timestamp, kind, port path, data) tuples
+    """
+    frames = []
+    ports = {}
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s is not a traffic capture" % path)
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                # the last record might be truncated
+                break
+
+            kind, port, timestamp, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+
+            if kind == REC_PORT:
+                ports[port] = data
+            else:
+                frames.append((timestamp, kind, ports.get(port), data))
+
+    return frames
+
+
+class ReplayTransport(object):
+    """I record what the replayed protocol writes"""
+
+    disconnecting = False
+
+    def __init__(self):
+        super(ReplayTransport, self).__init__()
+        self.written = deque()
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def loseConnection(self):
+        pass
+
+
+class CaptureReplay(object):
+    """
+    I replay a capture through ``sconn``
+
+    The RX frames of ``port`` are fed to ``sconn`` ``speed`` times
+    faster than they were captured, ``speed=0`` replays them without
+    delays. When the capture wrote a command that ``sconn`` did not
+    write on its own, I queue it so the response is parsed as it was
+    then. Writes of ``sconn`` missing from the capture are counted in
+    :attr:`unexpected`.
+    """
+
+    def __init__(self, frames, sconn, port=None, speed=1.0, clock=reactor):
+        super(CaptureReplay, self).__init__()
+        if port is None and frames:
+            port = frames[0][2]
+
+        self.frames = [f for f in frames if f[2] == port]
+        self.sconn = sconn
+        self.speed = float(speed)
+        self.clock = clock
+        self.transport = ReplayTransport()
+        self.pos = 0
+        self.injected = 0
+        self.unexpected = 0
+        self.started = None
+        self.deferred = None
+
+    def run(self):
+        """
+        Replays the capture
+
+        The deferred is callbacked with the elapsed time when done
+        """
+        self.sconn.makeConnection(self.transport)
+        self.deferred = defer.Deferred()
+        self.started = time()
+        self._step()
+        return self.deferred
+
+    def _step(self):
+        while self.pos < len(self.frames):
+            timestamp, kind, port, data = self.frames[self.pos]
+            self.pos += 1
+            if kind == REC_RX:
+                self.sconn.dataReceived(data)
+            elif kind == REC_TX:
+                self._expect(data)
+            elif kind == REC_CMD:
+                self._inject(data)
+
+            if self.speed and self.pos < len(self.frames):
+                delay = (self.frames[self.pos][0] - timestamp) / self.speed
+                if delay > 0:
+                    self.clock.callLater(delay, self._step)
+                    return
+
+        self.deferred.callback(time() - self.started)
+
+    def _expect(self, data):
+        while self.transport.written:
+            if self.transport.written.popleft() == data:
+                return
+            self.unexpected += 1
+
+        log.msg("replay: %r was not written" % data)
+
+    def _inject(self, name):
+        # the TX frame that follows is the command
+        data = self.frames[self.pos][3]
+        if data in self.transport.written:
+            return
+
+        at_str = data.rstrip('\r\n')
+        cmd = ATCmd(at_str, name=name, eol=data[len(at_str):])
+        # a split command is completed by the next TX frame
+        for _, _kind, _, _data in self.frames[self.pos + 1:]:
+            if _kind == REC_CMD:
+                break
+            if _kind == REC_TX and _data.endswith('\x1a'):
+                cmd.splitcmd = _data
+                break
+
+        self.injected += 1
+        self.sconn.queue_at_cmd(cmd).addErrback(lambda _: None)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Parallel AT channels over the ports of a device"""
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from wader.common.consts import (MM_MODEM_STATE_ENABLED,
+                                 MM_MODEM_STATE_REGISTERED)
+import wader.common.aterrors as E
+from core.command import ATCmd, BULK_CMDS
+from core.protocol import SerialProtocol
+from core.serialport import SerialPort
+
+# Seconds to wait before using the data port once the device is not
+# connected, so the dialer has time to release it
+POOL_EXPAND_DELAY = 5
+
+# Commands that set up a channel like the application port, they are
+# per channel in most devices
+CHANNEL_INIT_CMDS = ['ATE0', 'AT+CMEE=1', 'AT+CMGF=0']
+
+
+class ChannelProtocol(SerialProtocol):
+    """
+    I am the :class:`~core.protocol.SerialProtocol` of the data port
+
+    What the application port ``sconn`` learns and notifies is shared
+    with me, and so is its watchdog: both ports hang with the device.
+    """
+
+    def __init__(self, device, sconn):
+        super(ChannelProtocol, self).__init__(device)
+        self.stats = sconn.stats
+        self.timeouts = sconn.timeouts
+        self.mal = getattr(sconn, 'mal', None)
+        self.watchdog = sconn.watchdog
+        self.closed = False
+        self.waiters = []
+
+    def wait_closed(self):
+        """Returns a Deferred callbacked once my port has been closed"""
+        if self.closed:
+            return defer.succeed(True)
+
+        d = defer.Deferred()
+        self.waiters.append(d)
+        return d
+
+    def connectionLost(self, reason):
+        super(ChannelProtocol, self).connectionLost(reason)
+        self.closed = True
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.callback(True)
+
+
+class ChannelPool(object):
+    """
+    I send AT commands through both ports of a device while it is idle
+
+    The application port is served by ``sconn``. While the device is not
+    connected I open a :class:`ChannelProtocol` on the data port and
+    route the commands in :obj:`~core.command.BULK_CMDS` through it, so
+    a long listing does not hold up the interactive and polling
+    commands. Once a dialer is about to claim the data port I close it
+    and move its commands back to ``sconn``.
+
+    Devices with the ``no_channel_pool`` quirk only use one port.
+    """
+
+    def __init__(self, device, sconn, clock=reactor):
+        super(ChannelPool, self).__init__()
+        self.device = device
+        self.sconn = sconn
+        self.clock = clock
+        # the protocol of the data port, it is only used once ready
+        self.aux = None
+        # the last one collapsed, its port might still be closing
+        self.closing = None
+        self.ready = False
+        self.call = None
+
+    def is_usable(self):
+        """Returns True if the data port can be used for AT commands"""
+        device = self.device
+        return (not device.quirks.get('no_channel_pool', False)
+                and device.ports.has_two()
+                and MM_MODEM_STATE_ENABLED <= device.status
+                                           <= MM_MODEM_STATE_REGISTERED)
+
+    def route(self, cmd):
+        """Returns the protocol that should send ``cmd``"""
+        if self.ready and cmd.name in BULK_CMDS:
+            return self.aux
+
+        return self.sconn
+
+    def on_status(self, status):
+        """Opens or closes the second channel as the device ``status``"""
+        if MM_MODEM_STATE_ENABLED <= status <= MM_MODEM_STATE_REGISTERED:
+            if self.aux is None and self.call is None:
+                self.call = self.clock.callLater(POOL_EXPAND_DELAY,
+                                                 self.expand)
+        else:
+            self.collapse()
+
+    def open_port(self, protocol, path):
+        """Returns the transport of ``protocol`` over the port at ``path``"""
+        return SerialPort(protocol, path, reactor,
+                          baudrate=self.device.baudrate)
+
+    def expand(self):
+        """
+        Opens the second channel on the data port
+
+        :return: Deferred callbacked once the channel is ready
+        """
+        self.call = None
+        if self.aux is not None or not self.is_usable():
+            return defer.succeed(False)
+
+        aux = ChannelProtocol(self.device, self.sconn)
+        try:
+            self.port = self.open_port(aux, self.device.ports.dport.path)
+        except Exception, e:
+            log.err(e, "can not open %s" % self.device.ports.dport.path)
+            return defer.succeed(False)
+
+        self.aux = aux
+        cmds = list(CHANNEL_INIT_CMDS)
+        charset = getattr(self.device.sim, 'charset', None)
+        if charset:
+            cmds.append('AT+CSCS="%s"' % charset)
+
+        d = defer.gatherResults(
+                [aux.queue_at_cmd(ATCmd(cmd, name='send_at'))
+                    for cmd in cmds], consumeErrors=True)
+
+        def ready_cb(_):
+            if self.aux is aux:
+                log.msg("channel pool: sending bulk reads through %s" %
+                        self.device.ports.dport.path)
+                self.ready = True
+            return self.ready
+
+        def ready_eb(failure):
+            if self.aux is aux:
+                log.err(failure, "channel pool: can not set up the data port")
+                self.collapse()
+            return False
+
+        d.addCallbacks(ready_cb, ready_eb)
+        return d
+
+    def collapse(self):
+        """
+        Closes the second channel and moves its commands to ``sconn``
+
+        Only read-only commands are sent through it, so the one that might
+        be executing is sent again.
+
+        :return: Deferred callbacked once the data port has been closed
+        """
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+        aux, self.aux = self.aux, None
+        self.ready = False
+        if aux is None:
+            if self.closing is None:
+                return defer.succeed(True)
+            return self.closing.wait_closed()
+
+        cmds = aux.queue.drain()
+        if aux.cmd is not None:
+            aux.cancel_current_delayed_call()
+            cmds.insert(0, aux.cmd)
+            aux.cmd = None
+
+        # forget whatever the port might still send
+        aux.mal = None
+        self.closing = aux
+        d = aux.wait_closed()
+        # the port is closed asynchronously
+        self.port.loseConnection()
+        self.port = None
+
+        for cmd in cmds:
+            if cmd.name == 'send_at':
+                # the set up of the channel, it is not routed
+                cmd.deferred.errback(E.SerialSendFailed('channel closed'))
+            else:
+                cmd.protocol = self.sconn
+                self.sconn.queue.put(cmd)
+
+        log.msg("channel pool: data port released")
+        return d
@@ -0,0 +1,563 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+3GPP TS 27.010 multiplexer
+
+Devices with a single serial port can not send AT commands while PPP
+owns the port. If the plugin has a ``cmux`` quirk, the port is switched
+to the basic option of the 27.010 multiplexer with the AT+CMUX command
+of the quirk and two DLCs are opened on it: :obj:`AT_DLCI` for the
+:class:`~core.protocol.SerialProtocol` and :obj:`DATA_DLCI`, exported
+through a pty that becomes the data port of the device.
+"""
+
+import os
+import tty
+
+from zope.interface import implements
+from twisted.internet import defer, fdesc, reactor
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.internet.protocol import Protocol
+from twisted.python import log
+
+from wader.common.exceptions import MultiplexerError
+
+CMUX_FLAG = '\xf9'
+
+# frame types, without the P/F bit
+CMUX_SABM = 0x2f
+CMUX_UA = 0x63
+CMUX_DM = 0x0f
+CMUX_DISC = 0x43
+CMUX_UIH = 0xef
+CMUX_UI = 0x03
+CMUX_PF = 0x10
+
+# control channel message types, without the C/R and EA bits
+CMUX_MSG_CLD = 0xc0
+CMUX_MSG_TEST = 0x20
+CMUX_MSG_MSC = 0xe0
+CMUX_MSG_NSC = 0x10
+CMUX_MSG_FCON = 0xa0
+CMUX_MSG_FCOFF = 0x60
+# the commands of the peer that are answered with the same value, the
+# rest are not supported
+CMUX_ECHO_MSGS = frozenset([CMUX_MSG_CLD, CMUX_MSG_TEST, CMUX_MSG_MSC,
+                            CMUX_MSG_FCON, CMUX_MSG_FCOFF])
+
+# V.24 signals of the MSC message
+CMUX_MSC_FC = 0x02
+CMUX_MSC_RTC = 0x04
+CMUX_MSC_RTR = 0x08
+CMUX_MSC_DV = 0x80
+CMUX_MSC_ON = 0x01 | CMUX_MSC_RTC | CMUX_MSC_RTR | CMUX_MSC_DV
+CMUX_MSC_OFF = 0x01
+
+CONTROL_DLCI = 0
+AT_DLCI = 1
+DATA_DLCI = 2
+
+# AT command used if the cmux quirk is just True
+CMUX_COMMAND = 'AT+CMUX=0'
+# default maximum frame size of the basic option
+CMUX_N1 = 31
+# seconds to wait for a response and number of retransmissions
+CMUX_T1 = 0.5
+CMUX_N2 = 3
+# seconds the DTR of a DLC is kept low to hang up, longer than the time
+# the devices take to notice it
+CMUX_DTR_DELAY = 1
+
+
+def _build_crc_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xe0
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+CRC_TABLE = _build_crc_table()
+
+
+def get_fcs(data):
+    """Returns the frame check sequence of the bytes ``data``"""
+    fcs = 0xff
+    for char in data:
+        fcs = CRC_TABLE[fcs ^ ord(char)]
+    return 0xff - fcs
+
+
+def check_fcs(data, fcs):
+    """Returns True if ``fcs`` is the frame check sequence of ``data``"""
+    crc = 0xff
+    for char in data:
+        crc = CRC_TABLE[crc ^ ord(char)]
+    return CRC_TABLE[crc ^ fcs] == 0xcf
+
+
+def encode_frame(dlci, control, data='', cr=True):
+    """Returns a basic option frame for ``dlci`` with ``data``"""
+    address = chr((dlci << 2) | (int(cr) << 1) | 0x01)
+    length = len(data)
+    if length > 127:
+        length = chr((length & 0x7f) << 1) + chr(length >> 7)
+    else:
+        length = chr((length << 1) | 0x01)
+
+    header = address + chr(control) + length
+    # the FCS of UI frames covers their data as well
+    checked = header + data if control & ~CMUX_PF == CMUX_UI else header
+    return '%s%s%s%s%s' % (CMUX_FLAG, header, data,
+                           chr(get_fcs(checked)), CMUX_FLAG)
+
+
+def encode_message(msg_type, value='', cr=True):
+    """Returns a control channel message of ``msg_type`` with ``value``"""
+    return '%s%s%s' % (chr(msg_type | (int(cr) << 1) | 0x01),
+                       chr((len(value) << 1) | 0x01), value)
+
+
+def get_cmux_n1(cmd):
+    """Returns the maximum frame size set by the AT+CMUX command ``cmd``"""
+    try:
+        params = cmd.split('=', 1)[1].split(',')
+        return int(params[3])
+    except (IndexError, ValueError):
+        return CMUX_N1
+
+
+class FrameDecoder(object):
+    """
+    I incrementally decode basic option frames
+
+    :meth:`feed` returns the (dlci, control, data) of the complete frames,
+    frames with a bad FCS are dropped and I resynchronise on the next flag
+    """
+
+    def __init__(self):
+        super(FrameDecoder, self).__init__()
+        self.buf = ''
+        self.dropped = 0
+
+    def feed(self, data):
+        self.buf += data
+        frames = []
+        buf = self.buf
+        pos = 0
+        while True:
+            start = buf.find(CMUX_FLAG, pos)
+            if start == -1:
+                pos = len(buf)
+                break
+
+            # closing and opening flags might be shared or repeated
+            while buf[start + 1:start + 2] == CMUX_FLAG:
+                start += 1
+
+            pos = start
+            if len(buf) < start + 4:
+                break
+
+            address = ord(buf[start + 1])
+            control = ord(buf[start + 2])
+            length = ord(buf[start + 3])
+            header_len = 3
+            if not length & 0x01:
+                if len(buf) < start + 5:
+                    break
+                length = (length >> 1) | (ord(buf[start + 4]) << 7)
+                header_len = 4
+            else:
+                length >>= 1
+
+            end = start + 1 + header_len + length
+            if len(buf) < end + 2:
+                break
+
+            checked = buf[start + 1:start + 1 + header_len]
+            if control & ~CMUX_PF == CMUX_UI:
+                checked = buf[start + 1:end]
+            if buf[end + 1] != CMUX_FLAG or \
+                    not check_fcs(checked, ord(buf[end])):
+                self.dropped += 1
+                pos = start + 1
+                continue
+
+            frames.append((address >> 2, control & ~CMUX_PF,
+                           buf[start + 1 + header_len:end]))
+            # the closing flag might open the next frame
+            pos = end + 1
+
+        self.buf = buf[pos:]
+        return frames
+
+
+class CMUXChannel(object):
+    """I am the transport of a DLC"""
+
+    disconnecting = False
+
+    def __init__(self, mux, dlci):
+        super(CMUXChannel, self).__init__()
+        self.mux = mux
+        self.dlci = dlci
+        self.protocol = None
+
+    def connect(self, protocol):
+        """Makes ``protocol`` talk through me"""
+        self.protocol = protocol
+        protocol.makeConnection(self)
+
+    def deliver(self, data):
+        if self.protocol is not None:
+            self.protocol.dataReceived(data)
+
+    def write(self, data):
+        self.mux.send_data(self.dlci, data)
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def loseConnection(self):
+        self.mux.close_channel(self.dlci)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+    def logPrefix(self):
+        return '%s:%d' % (self.mux.logPrefix(), self.dlci)
+
+
+class CMUXMultiplexer(Protocol):
+    """
+    I multiplex DLCs over a serial port in 27.010 basic option mode
+
+    I am the protocol of the serial port once the device has entered
+    multiplexer mode. Use :meth:`open_channel` to get the transport
+    of a DLC.
+    """
+
+    def __init__(self, n1=CMUX_N1, clock=reactor):
+        self.n1 = n1
+        self.clock = clock
+        self.decoder = FrameDecoder()
+        self.channels = {}
+        # {dlci: [Deferred, frame, retries left, delayed call]}
+        self.pending = {}
+        # PtyChannel exporting the data DLC
+        self.pty = None
+        # {dlci: delayed call raising its DTR again}
+        self.hangups = {}
+
+    def logPrefix(self):
+        try:
+            return self.transport.logPrefix()
+        except AttributeError:
+            return 'cmux'
+
+    def dataReceived(self, data):
+        for dlci, control, info in self.decoder.feed(data):
+            self.handle_frame(dlci, control, info)
+
+    def handle_frame(self, dlci, control, info):
+        if control == CMUX_UA:
+            self._acknowledge(dlci)
+        elif control == CMUX_DM:
+            self._acknowledge(dlci, MultiplexerError("DLC %d refused" % dlci))
+        elif control == CMUX_DISC:
+            self.transport.write(encode_frame(dlci, CMUX_UA | CMUX_PF,
+                                              cr=False))
+            self._channel_closed(dlci)
+        elif control in (CMUX_UIH, CMUX_UI):
+            if dlci == CONTROL_DLCI:
+                self.handle_message(info)
+            elif dlci in self.channels:
+                self.channels[dlci].deliver(info)
+        else:
+            log.msg("cmux: unhandled frame %#x on DLC %d" % (control, dlci))
+
+    def handle_message(self, info):
+        if len(info) < 2:
+            return
+
+        msg_type = ord(info[0])
+        value = info[2:2 + (ord(info[1]) >> 1)]
+        if not msg_type & 0x02:
+            # a response to one of our commands
+            return
+
+        msg_type &= ~0x03
+        if msg_type not in CMUX_ECHO_MSGS:
+            log.msg("cmux: unsupported message %#x" % msg_type)
+            # the value of NSC is the type octet of the command
+            self.send_data(CONTROL_DLCI, encode_message(CMUX_MSG_NSC,
+                                                        info[0], cr=False))
+            return
+
+        if msg_type == CMUX_MSG_MSC and len(value) >= 2:
+            dlci = ord(value[0]) >> 2
+            log.msg("cmux: DLC %d modem status %#x" % (dlci, ord(value[1])))
+
+        self.send_data(CONTROL_DLCI, encode_message(msg_type, value,
+                                                    cr=False))
+
+    def _send_command(self, dlci, frame):
+        d = defer.Deferred()
+        self.pending[dlci] = [d, frame, CMUX_N2, None]
+        self._transmit(dlci)
+        return d
+
+    def _transmit(self, dlci):
+        pending = self.pending.get(dlci)
+        if pending is None:
+            return
+
+        d, frame, retries, call = pending
+        if retries < 0:
+            del self.pending[dlci]
+            d.errback(MultiplexerError("no response on DLC %d" % dlci))
+            return
+
+        pending[2] -= 1
+        pending[3] = self.clock.callLater(CMUX_T1, self._transmit, dlci)
+        self.transport.write(frame)
+
+    def _acknowledge(self, dlci, error=None):
+        pending = self.pending.pop(dlci, None)
+        if pending is None:
+            return
+
+        d, frame, retries, call = pending
+        if call is not None and call.active():
+            call.cancel()
+
+        if error is None:
+            d.callback(dlci)
+        else:
+            d.errback(error)
+
+    def _channel_closed(self, dlci):
+        channel = self.channels.pop(dlci, None)
+        if channel is not None and channel.protocol is not None:
+            channel.protocol.connectionLost(None)
+
+    def open_channel(self, dlci):
+        """
+        Opens ``dlci``
+
+        :return: Deferred callbacked with the :class:`CMUXChannel`
+        """
+        frame = encode_frame(dlci, CMUX_SABM | CMUX_PF)
+        d = self._send_command(dlci, frame)
+
+        def opened(_):
+            channel = CMUXChannel(self, dlci)
+            if dlci != CONTROL_DLCI:
+                self.channels[dlci] = channel
+                self.send_msc(dlci, CMUX_MSC_ON)
+            return channel
+
+        d.addCallback(opened)
+        return d
+
+    def close_channel(self, dlci):
+        """Closes ``dlci``"""
+        d = self._send_command(dlci, encode_frame(dlci, CMUX_DISC | CMUX_PF))
+        d.addBoth(lambda _: self._channel_closed(dlci))
+        return d
+
+    def send_data(self, dlci, data):
+        """Sends ``data`` to ``dlci`` split in frames of my frame size"""
+        for i in range(0, len(data), self.n1):
+            self.transport.write(encode_frame(dlci, CMUX_UIH,
+                                              data[i:i + self.n1]))
+
+    def send_msc(self, dlci, signals):
+        """Sends the V.24 ``signals`` of ``dlci``"""
+        value = chr((dlci << 2) | 0x03) + chr(signals)
+        self.send_data(CONTROL_DLCI, encode_message(CMUX_MSG_MSC, value))
+
+    def hangup(self, dlci):
+        """Drops the DTR of ``dlci``, which ends its data call"""
+        call = self.hangups.pop(dlci, None)
+        if call is not None and call.active():
+            call.cancel()
+
+        def raise_dtr():
+            del self.hangups[dlci]
+            self.send_msc(dlci, CMUX_MSC_ON)
+
+        self.send_msc(dlci, CMUX_MSC_OFF)
+        # raise it again so the next call can be made, but only once the
+        # device has noticed the drop
+        self.hangups[dlci] = self.clock.callLater(CMUX_DTR_DELAY, raise_dtr)
+
+    def close(self):
+        """Leaves multiplexer mode"""
+        calls = [p[3] for p in self.pending.values()] + self.hangups.values()
+        for call in calls:
+            if call is not None and call.active():
+                call.cancel()
+        self.pending = {}
+        self.hangups = {}
+
+        for dlci in self.channels.keys():
+            self._channel_closed(dlci)
+
+        self.send_data(CONTROL_DLCI, encode_message(CMUX_MSG_CLD))
+
+
+class PtyChannel(object):
+    """
+    I export a :class:`CMUXChannel` through a pty
+
+    :attr:`path` is the slave end, that the dialers open as data port.
+    The slave stays open while I exist so that the master does not hang
+    up when the dialer closes it.
+    """
+    implements(IReadDescriptor)
+
+    def __init__(self, channel, reactor=reactor):
+        super(PtyChannel, self).__init__()
+        self.channel = channel
+        self.reactor = reactor
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        fdesc.setNonBlocking(self.master)
+
+    def start(self):
+        self.channel.connect(self)
+        self.reactor.addReader(self)
+
+    def stop(self):
+        self.reactor.removeReader(self)
+        os.close(self.master)
+        os.close(self.slave)
+
+    # protocol of the channel
+
+    def makeConnection(self, transport):
+        pass
+
+    def connectionLost(self, reason):
+        pass
+
+    def dataReceived(self, data):
+        os.write(self.master, data)
+
+    # reader of the pty
+
+    def fileno(self):
+        return self.master
+
+    def doRead(self):
+        return fdesc.readFromFD(self.master, self.channel.write)
+
+    def logPrefix(self):
+        return 'PtyChannel'
+
+
+def start_multiplexer(device):
+    """
+    Switches the only port of ``device`` to multiplexer mode
+
+    The port keeps working without multiplexing if it fails
+
+    :return: Deferred callbacked with ``device``
+    """
+    cmd = device.quirks.get('cmux')
+    if not cmd or device.ports.has_two():
+        return defer.succeed(device)
+
+    if cmd is True:
+        cmd = CMUX_COMMAND
+
+    port = device.ports.dport
+    mux = CMUXMultiplexer(get_cmux_n1(cmd))
+    channels = {}
+
+    def open_channel(_, dlci):
+        d = mux.open_channel(dlci)
+        d.addCallback(lambda channel: channels.update({dlci: channel}))
+        return d
+
+    def enter_mux_mode(_):
+        port.obj.protocol = mux
+        mux.makeConnection(port.obj)
+        d = mux.open_channel(CONTROL_DLCI)
+        d.addCallback(open_channel, AT_DLCI)
+        d.addCallback(open_channel, DATA_DLCI)
+        return d
+
+    def mux_mode_cb(_):
+        channels[AT_DLCI].connect(device.sconn)
+        pty = PtyChannel(channels[DATA_DLCI])
+        pty.start()
+        mux.pty = pty
+
+        # the multiplexed port is now the control port
+        device.ports.cport.path, device.ports.cport.obj = port.path, port.obj
+        port.path, port.obj = pty.path, None
+        device.mux = mux
+        log.msg("cmux: %s multiplexed, data port %s" % (device, pty.path))
+        return device
+
+    def mux_mode_eb(failure):
+        log.err(failure, "cmux: can not multiplex %s" % device)
+        if port.obj.protocol is mux:
+            mux.close()
+            port.obj.protocol = device.sconn
+        return device
+
+    d = device.sconn.send_at(cmd)
+    d.addCallback(enter_mux_mode)
+    d.addCallback(mux_mode_cb)
+    d.addErrback(mux_mode_eb)
+    return d
+
+
+def stop_multiplexer(device):
+    """
+    Leaves multiplexer mode and restores the only port of ``device``
+
+    The serial port is left in the control port for the caller to close
+    """
+    mux, device.mux = device.mux, None
+    if mux is None:
+        return
+
+    mux.close()
+    mux.pty.stop()
+    ports = device.ports
+    ports.dport.path, ports.dport.obj = ports.cport.path, None
+    ports.cport.path = None
+    ports.cport.obj.protocol = device.sconn
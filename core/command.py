@@ -26,6 +26,12 @@ from wader.common.aterrors import ERROR_REGEXP
 
 OK_REGEXP = re.compile("\r\n(?P<resp>OK)\r\n")
 
+# ATCmd priority classes, lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_CONNECTION = 1
+PRIORITY_BACKGROUND = 2
+PRIORITIES = [PRIORITY_INTERACTIVE, PRIORITY_CONNECTION, PRIORITY_BACKGROUND]
+
 
 def build_cmd_dict(extract=OK_REGEXP, end=OK_REGEXP, error=ERROR_REGEXP):
     """Returns a dictionary ready to be used in `CMD_DICT`"""
@@ -51,8 +57,13 @@ def get_cmd_dict_copy():
 
 CMD_DICT = {
 
+    'ack_sms': build_cmd_dict(),
+
     'add_contact': build_cmd_dict(),
 
+    # the response is split by CompoundATCmd.split_response
+    'compound': dict(extract=None, end=OK_REGEXP, error=ERROR_REGEXP),
+
     'cancel_ussd': build_cmd_dict(),
 
     'change_pin': build_cmd_dict(),
@@ -178,6 +189,15 @@ CMD_DICT = {
     'get_sms_format': build_cmd_dict(
                               re.compile('\r\n\+CMGF:\s(?P<format>\d)\r\n')),
 
+    'get_sms_storage': build_cmd_dict(re.compile(r"""
+                              \r\n
+                              \+CPMS:\s
+                              "(?P<mem>\w+)",
+                              (?P<used>\d+),
+                              (?P<total>\d+)
+                              (?:,.*)?
+                              \r\n""", re.X)),
+
     'get_phonebook_size': build_cmd_dict(re.compile(r"""
                               \r\n
                               \+CPBR:\s
@@ -248,6 +268,11 @@ CMD_DICT = {
 
     'set_error_level': build_cmd_dict(),
 
+    'set_message_service': build_cmd_dict(re.compile(
+                              '\r\n\+CSMS:\s(?P<mt>\d),(?P<mo>\d),(?P<bm>\d)\r\n')),
+
+    'set_more_messages_mode': build_cmd_dict(),
+
     'set_netreg_notification': build_cmd_dict(),
 
     'set_network_info_format': build_cmd_dict(),
@@ -272,28 +297,182 @@ CMD_DICT = {
 }
 
 
+# Read-only commands, an identical command already queued or executing can
+# answer for them
+READ_ONLY_CMDS = frozenset([
+    'check_pin',
+    'get_apns',
+    'get_band',
+    'get_bands',
+    'get_card_model',
+    'get_card_version',
+    'get_charset',
+    'get_charsets',
+    'get_imei',
+    'get_imsi',
+    'get_manufacturer_name',
+    'get_netreg_status',
+    'get_network_info',
+    'get_network_mode',
+    'get_network_names',
+    'get_phonebook_size',
+    'get_pin_status',
+    'get_radio_status',
+    'get_roaming_ids',
+    'get_signal_quality',
+    'get_sms_format',
+    'get_sms_storage',
+    'get_smsc',
+    'get_syscfg',
+])
+
+
+# Long read-only commands that are sent through the second channel of a
+# ChannelPool when there is one, so they do not hold up the rest
+BULK_CMDS = frozenset([
+    'find_contacts',
+    'get_network_names',
+    'get_roaming_ids',
+    'list_contacts',
+    'list_sms',
+])
+
+
+# Commands that can be part of a compound command, their information
+# response lines are prefixed by the command itself, e.g. AT+CSQ -> +CSQ:
+COMPOUND_CMDS = frozenset([
+    'get_charset',
+    'get_netreg_status',
+    'get_network_info',
+    'get_pin_status',
+    'get_radio_status',
+    'get_signal_quality',
+    'get_sms_format',
+    'get_smsc',
+    'get_syscfg',
+])
+
+# The command name of the last command in an AT command line
+COMMAND_NAME_REGEXP = re.compile(r'(?P<name>[+^%*$_][A-Z][A-Z0-9]*)[^;]*$')
+
+
+# Commands that the device stops if a character is sent while it executes
+# them, see 27.007 section 5.6.1 (abortability)
+ABORTABLE_CMDS = frozenset([
+    'get_network_names',
+    'register_with_netid',
+])
+
+
 class ATCmd(object):
     """I encapsulate all the data related to an AT command"""
 
-    def __init__(self, cmd, name=None, eol='\r\n', nolog=tuple()):
+    def __init__(self, cmd, name=None, eol='\r\n', nolog=tuple(),
+                 priority=None, timeout=None):
         self.cmd = cmd
         self.name = name
         self.eol = eol
         self.nolog = nolog
+        # priority class, it decides which command the queue serves first.
+        # It depends on who asks: the daemons' polls are background, the
+        # connection setup is connection-critical and the rest interactive
+        if priority is None:
+            priority = PRIORITY_INTERACTIVE
+        self.priority = priority
+        # whether the device can be told to stop executing it
+        self.abortable = name in ABORTABLE_CMDS
+        # the protocol that queued me, see cancel()
+        self.protocol = None
         # Some commands like sending a sms require an special handling this
         # is because we have to wait till we receive a prompt like '\r\n> '
         # if splitcmd is set, the second part will be send 0.1 seconds later
         self.splitcmd = None
-        # command's deferred
-        self.deferred = defer.Deferred()
-        self.timeout = 15    # default timeout
+        # command's deferred, cancelling it cancels me
+        self.deferred = defer.Deferred(lambda _: self.cancel())
+        # seconds the caller gives the device to answer, if any. The
+        # learned timeout never goes below it
+        self.explicit_timeout = timeout
+        self.timeout = timeout or 15    # default timeout
         self.call_id = None  # DelayedCall reference
+        # timestamps of the stages the command goes through
+        self.queued_at = None
+        self.acquired_at = None
+        self.written_at = None
+        self.first_byte_at = None
+        self.completed_at = None
 
     def __repr__(self):
-        args = (self.name, self.get_cmd(), self.timeout)
-        return "<ATCmd name: %s raw: %r timeout: %d>" % args
+        args = (self.name, self.get_cmd(), self.timeout, self.priority)
+        return "<ATCmd name: %s raw: %r timeout: %d priority: %d>" % args
+
+    def cancel(self):
+        """
+        Cancels me, my caller is not interested in my result anymore
+
+        A queued command is removed without being sent, the one being
+        executed is stopped only if it is abortable. Use the ``cancel``
+        method of my deferred rather than calling me directly.
+        """
+        if self.protocol is not None:
+            self.protocol.cancel_at_cmd(self)
 
     def get_cmd(self):
         """Returns the raw AT command plus EOL"""
         cmd = self.cmd + self.eol
         return str(cmd)
+
+
+class CompoundATCmd(ATCmd):
+    """
+    I concatenate several :class:`ATCmd` in a single command line
+
+    The device answers all of them before a single final result code, e.g.
+    ``AT+CSQ;+CREG?`` is answered with::
+
+        \r\n+CSQ: 20,99\r\n\r\n+CREG: 0,1\r\n\r\nOK\r\n
+
+    Only the commands in :obj:`COMPOUND_CMDS` can be concatenated
+    """
+
+    def __init__(self, cmds):
+        at_str = ';'.join([cmds[0].cmd] + [cmd.cmd[2:] for cmd in cmds[1:]])
+        priority = min([cmd.priority for cmd in cmds])
+        # the failure will be handled by falling back to single commands
+        super(CompoundATCmd, self).__init__(at_str, name='compound',
+                                            nolog=(Exception,),
+                                            priority=priority)
+        self.cmds = cmds
+        self.timeout = max([cmd.timeout for cmd in cmds])
+
+    def split_response(self, response, cmd_dict):
+        """
+        Splits ``response`` in the list of matches of every command
+
+        :param cmd_dict: The cmd_dict with the regexps of every command
+        :rtype: list
+        """
+        # find where the response of every command starts
+        starts = []
+        pos = 0
+        for cmd in self.cmds:
+            name = COMMAND_NAME_REGEXP.search(cmd.cmd).group('name')
+            start = response.find('\r\n%s:' % name, pos)
+            if start != -1:
+                pos = start + 2
+            starts.append(start)
+
+        # and where it ends, commands without response get no matches
+        responses = []
+        end = len(response)
+        for cmd, start in reversed(zip(self.cmds, starts)):
+            if start == -1:
+                responses.insert(0, [])
+                continue
+
+            extract = cmd_dict[cmd.name]['extract']
+            # include the line terminator of the last line
+            matches = extract.finditer(response, start, end + 2)
+            responses.insert(0, list(matches))
+            end = start
+
+        return responses
@@ -27,6 +27,8 @@ from wader.common.consts import (MM_MODEM_STATE_UNKNOWN,
                                  MM_MODEM_STATE_CONNECTED)
 import wader.common.signals as S
 
+from core.command import PRIORITY_BACKGROUND
+
 SIG_SMS_NOTIFY_ONLINE_FREQ = 5
 SIG_SMS_NOTIFY_ONLINE_POLL = 6  # interval = FREQ * POLL
 SIG_REG_INFO_FREQ = 120
@@ -88,7 +90,7 @@ class SignalQualityDaemon(WaderDaemon):
 
     def function(self):
         """Executes `get_signal_quality` periodically"""
-        d = self.device.sconn.get_signal_quality()
+        d = self.device.sconn.get_signal_quality(PRIORITY_BACKGROUND)
         d.addCallback(self.device.sconn.emit_rssi)
 
         return True
@@ -112,7 +114,7 @@ class NetworkRegistrationDaemon(WaderDaemon):
         def schedule_if_necessary(registered):
 
             def poll():
-                d = self.device.sconn.get_netreg_info()
+                d = self.device.sconn.get_netreg_info(PRIORITY_BACKGROUND)
                 d.addCallbacks(is_registered_cb, is_registered_eb)
                 d.addCallback(schedule_if_necessary)
                 return False  # once only
@@ -121,7 +123,7 @@ class NetworkRegistrationDaemon(WaderDaemon):
                     time() < (self.expiry - (SIG_REG_INFO_POLL * 2)):
                 timeout_add_seconds(SIG_REG_INFO_POLL, poll)
 
-        d = self.device.sconn.get_netreg_info()
+        d = self.device.sconn.get_netreg_info(PRIORITY_BACKGROUND)
         d.addCallbacks(is_registered_cb, is_registered_eb)
         d.addCallback(schedule_if_necessary)
 
@@ -156,12 +158,13 @@ class SmsNotifyOnlineDaemon(WaderDaemon):
             if self.device.status != self.last_status:
                 # we just got connected
                 self.last_poll = 0
-                d = self.device.sconn.mal.list_sms_raw()
+                d = self.device.sconn.mal.list_sms_raw(PRIORITY_BACKGROUND)
                 d.addCallback(self._set_smslist)
             else:
                 self.last_poll += 1
                 if (self.last_poll % SIG_SMS_NOTIFY_ONLINE_POLL) == 0:
-                    d = self.device.sconn.mal.list_sms_raw()
+                    d = self.device.sconn.mal.list_sms_raw(
+                                                    PRIORITY_BACKGROUND)
                     d.addCallback(self._cmp_smslist)
 
         self.last_status = self.device.status
@@ -26,14 +26,19 @@ from twisted.python import log
 from wader.common.consts import (SMS_INTFACE, CTS_INTFACE, NET_INTFACE,
                                  CRD_INTFACE, MDM_INTFACE, WADER_SERVICE,
                                  HSO_INTFACE, SPL_INTFACE, USD_INTFACE,
-                                 MMS_INTFACE)
+                                 MMS_INTFACE, DGN_INTFACE)
 from wader.common.sms import Message
+from core.capture import TrafficCapture
 from core.mms import mms_to_dbus_data, dbus_data_to_mms
 from core.contact import Contact
 from wader.common._dbus import DBusExporterHelper
 from wader.common.utils import (convert_ip_to_int,
                                 convert_network_mode_to_access_technology)
 
+# Seconds a Scan caller waits for the networks around, a network search
+# still running afterwards is cancelled
+SCAN_REPLY_TIMEOUT = 120
+
 # welcome to the multiple inheritance madness!
 # python-dbus currently lacks an "export_as" keyword for use cases like
 # us. Where we have a main object with dozens of methods that we want to
@@ -141,6 +146,81 @@ class ModemExporter(Object, DBusExporterHelper):
         d.addCallback(sanitise)
         return self.add_callbacks(d, async_cb, async_eb)
 
+    @method(DGN_INTFACE, in_signature='', out_signature='a{sv}')
+    def GetCommandStats(self):
+        """
+        Returns the latency statistics of the AT commands sent to the device
+
+        ``Commands`` maps every command name to its count, errors, timeouts,
+        maximum latency in ms and the latency histograms of its stages.
+        The histograms have a count for each upper bound in ``Buckets``
+        plus one for the latencies above the last one.
+
+        :rtype: dict
+        """
+        stats = self.sconn.stats.to_dict()
+
+        commands = {}
+        for name, info in stats['Commands'].iteritems():
+            info = dict((key, dbus.Array(value, signature='u')
+                                if isinstance(value, list)
+                                else dbus.UInt32(value))
+                            for key, value in info.iteritems())
+            commands[name] = dbus.Dictionary(info, signature='sv')
+
+        return {'Buckets': dbus.Array(stats['Buckets'], signature='u'),
+                'Commands': dbus.Dictionary(commands, signature='sa{sv}'),
+                'QueueDepth': dbus.UInt32(stats['QueueDepth']),
+                'MaxQueueDepth': dbus.UInt32(stats['MaxQueueDepth']),
+                'Timeouts': dbus.UInt32(stats['Timeouts'])}
+
+    @method(DGN_INTFACE, in_signature='s', out_signature='')
+    def StartTrafficCapture(self, path):
+        """
+        Records the traffic of the serial port to ``path``
+
+        The capture can be replayed with :class:`~core.capture.CaptureReplay`
+        """
+        self.sconn.stop_capture()
+        port = self.device.ports.get_application_port()
+        self.sconn.start_capture(TrafficCapture(path), port.path)
+
+    @method(DGN_INTFACE, in_signature='', out_signature='')
+    def StopTrafficCapture(self):
+        """Stops recording the traffic of the serial port"""
+        self.sconn.stop_capture()
+
+    @method(DGN_INTFACE, in_signature='', out_signature='a{sv}')
+    def GetRecoveryStats(self):
+        """
+        Returns the recoveries of the device after it stopped answering
+
+        ``LastDuration`` and ``Downtime``, the time spent recovering the
+        device, are in ms.
+
+        :rtype: dict
+        """
+        stats = self.sconn.watchdog.to_dict()
+        return {'Model': stats['Model'],
+                'Recoveries': dbus.UInt32(stats['Recoveries']),
+                'Failures': dbus.UInt32(stats['Failures']),
+                'Recovering': dbus.Boolean(stats['Recovering']),
+                'LastDuration': dbus.UInt32(stats['LastDuration']),
+                'Downtime': dbus.UInt32(stats['Downtime'])}
+
+    @method(DGN_INTFACE, in_signature='', out_signature='a{sa{sv}}')
+    def GetCacheStats(self):
+        """
+        Returns the hits and misses of the cached properties of the device
+
+        :rtype: dict
+        """
+        stats = self.sconn.cache.to_dict()
+        return dict((name, {'Hits': dbus.UInt32(info['Hits']),
+                            'Misses': dbus.UInt32(info['Misses']),
+                            'Cached': dbus.Boolean(info['Cached'])})
+                    for name, info in stats.iteritems())
+
     @method(MDM_INTFACE, in_signature='', out_signature='(uuuu)',
             async_callbacks=('async_cb', 'async_eb'))
     def GetIP4Config(self, async_cb, async_eb):
@@ -176,6 +256,10 @@ class ModemExporter(Object, DBusExporterHelper):
     def MmPropertiesChanged(self, iface, properties):
         log.msg("emitting MmPropertiesChanged: %s %s" % (iface, properties))
 
+    @signal(dbus_interface=DGN_INTFACE, signature='bu')
+    def PortRecovered(self, success, duration):
+        log.msg("emitting PortRecovered(%s, %d)" % (success, duration))
+
 
 class SimpleExporter(ModemExporter):
     """I export the org.freedesktop.ModemManager.Modem.Simple interface"""
@@ -385,7 +469,7 @@ class ContactsExporter(CardExporter):
         :param number: The contact number
         :rtype: int
         """
-        d = self.sconn.add_contact(Contact(name, number))
+        d = self.sconn.phonebook.add_contact(Contact(name, number))
         return self.add_callbacks(d, async_cb, async_eb)
 
     @method(CTS_INTFACE, in_signature='u', out_signature='',
@@ -396,7 +480,7 @@ class ContactsExporter(CardExporter):
 
         :param index: The index of the contact to be deleted
         """
-        d = self.sconn.delete_contact(index)
+        d = self.sconn.phonebook.delete_contact(index)
         return self.add_callbacks_and_swallow(d, async_cb, async_eb)
 
     @method(CTS_INTFACE, in_signature='uss', out_signature='u',
@@ -409,7 +493,8 @@ class ContactsExporter(CardExporter):
         :param number: The new number of the contact to be edited
         :param index: The index of the contact to be edited
         """
-        d = self.sconn.add_contact(Contact(name, number, index=index))
+        contact = Contact(name, number, index=index)
+        d = self.sconn.phonebook.add_contact(contact)
         return self.add_callbacks(d, async_cb, async_eb)
 
     @method(CTS_INTFACE, in_signature='s', out_signature='a(uss)',
@@ -421,7 +506,7 @@ class ContactsExporter(CardExporter):
         :param pattern: The pattern to match contacts against
         :rtype: list
         """
-        d = self.sconn.find_contacts(pattern)
+        d = self.sconn.phonebook.find_contacts(pattern)
         d.addCallback(lambda contacts:
                       [(c.index, c.name, c.number) for c in contacts])
         return self.add_callbacks(d, async_cb, async_eb)
@@ -435,10 +520,9 @@ class ContactsExporter(CardExporter):
         :param number: The number to match contacts against
         :rtype: list
         """
-        d = self.sconn.list_contacts()
+        d = self.sconn.phonebook.find_contacts_by_number(number)
         d.addCallback(lambda contacts:
-                      [(c.index, c.name, c.number) for c in contacts
-                            if c.number.endswith(number)])
+                      [(c.index, c.name, c.number) for c in contacts])
         return self.add_callbacks(d, async_cb, async_eb)
 
     @method(CTS_INTFACE, in_signature='u', out_signature='(uss)',
@@ -450,7 +534,7 @@ class ContactsExporter(CardExporter):
         :param index: The index of the contact to get
         :rtype: tuple
         """
-        d = self.sconn.get_contact(index)
+        d = self.sconn.phonebook.get_contact(index)
         d.addCallback(lambda c: (c.index, c.name, c.number))
         return self.add_callbacks(d, async_cb, async_eb)
 
@@ -458,8 +542,7 @@ class ContactsExporter(CardExporter):
             async_callbacks=('async_cb', 'async_eb'))
     def GetCount(self, async_cb, async_eb):
         """Returns the number of contacts in the SIM"""
-        d = self.sconn.list_contacts()
-        d.addCallback(len)
+        d = self.sconn.phonebook.get_count()
         return self.add_callbacks(d, async_cb, async_eb)
 
     @method(CTS_INTFACE, in_signature='', out_signature='i',
@@ -477,7 +560,7 @@ class ContactsExporter(CardExporter):
 
         :rtype: list of tuples
         """
-        d = self.sconn.list_contacts()
+        d = self.sconn.phonebook.list_contacts()
         d.addCallback(lambda contacts:
                       [(c.index, c.name, c.number) for c in contacts])
         return self.add_callbacks(d, async_cb, async_eb)
@@ -534,8 +617,8 @@ class NetworkExporter(ContactsExporter):
         return self.add_callbacks(d, async_cb, async_eb)
 
     @method(NET_INTFACE, in_signature='', out_signature='aa{ss}',
-            async_callbacks=('async_cb', 'async_eb'))
-    def Scan(self, async_cb, async_eb):
+            async_callbacks=('async_cb', 'async_eb'), sender_keyword='sender')
+    def Scan(self, async_cb, async_eb, sender=None):
         """Returns the basic information of the networks around"""
         d = self.sconn.get_network_names()
 
@@ -561,7 +644,8 @@ class NetworkExporter(ContactsExporter):
             return response
 
         d.addCallback(process_netnames)
-        return self.add_callbacks(d, async_cb, async_eb)
+        return self.add_cancellable_callbacks(d, async_cb, async_eb,
+                                              sender, SCAN_REPLY_TIMEOUT)
 
     @method(NET_INTFACE, in_signature='u', out_signature='',
             async_callbacks=('async_cb', 'async_eb'))
@@ -855,6 +939,10 @@ class SmsExporter(MmsExporter):
     def Delivered(self, reference):
         log.msg('emitting Delivered(%d)' % reference)
 
+    @signal(dbus_interface=SMS_INTFACE, signature='u')
+    def DeliveryTimedOut(self, reference):
+        log.msg('emitting DeliveryTimedOut(%d)' % reference)
+
 
 class UssdExporter(SmsExporter):
     """I export the org.freedesktop.ModemManager.Modem.Gsm.Ussd interface"""
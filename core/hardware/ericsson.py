@@ -30,7 +30,8 @@ from wader.common.encoding import (pack_ucs2_bytes, from_u, check_if_ucs2,
 from wader.common.utils import revert_dict
 import wader.common.signals as S
 
-from core.command import get_cmd_dict_copy, build_cmd_dict, ATCmd
+from core.command import (get_cmd_dict_copy, build_cmd_dict, ATCmd,
+                          PRIORITY_CONNECTION)
 from core.contact import Contact
 from core.hardware.base import WCDMACustomizer
 from core.middleware import WCDMAWrapper
@@ -140,7 +141,7 @@ def ericsson_new_indication(args, device):
 
     if itype is 2:      # Signal quality
         strength = value * 20
-        device.sconn.updatecache(strength, 'signal')
+        device.sconn.cache.update(strength, 'signal')
         device.sconn.emit_rssi(strength)
     elif itype is 5:    # Service indicator
         pass
@@ -303,7 +304,7 @@ class EricssonWrapper(WCDMAWrapper):
         d.addCallback(get_network_mode_cb)
         return d
 
-    def get_netreg_status(self):
+    def get_netreg_status(self, priority=None):
         deferred = defer.Deferred()
         self.state_dict['creg_retries'] = 0
 
@@ -322,13 +323,13 @@ class EricssonWrapper(WCDMAWrapper):
             def get_netreg_status_eb(failure):
                 return auxdef.errback(failure)
 
-            d = super(EricssonWrapper, self).get_netreg_status()
+            d = super(EricssonWrapper, self).get_netreg_status(priority)
             d.addCallbacks(get_netreg_status_cb, get_netreg_status_eb)
             return auxdef
 
         return get_it(deferred)
 
-    def get_signal_quality(self):
+    def get_signal_quality(self, priority=None):
         # On Ericsson, AT+CSQ only returns valid data in GPRS mode
         # So we need to override and provide an alternative. +CIND
         # returns an indication between 0-5 so let's just multiply
@@ -342,7 +343,8 @@ class EricssonWrapper(WCDMAWrapper):
                 # we'll assume that we don't have RSSI right now
                 return 0
 
-        cmd = ATCmd('AT+CIND?', name='get_signal_quality')
+        cmd = ATCmd('AT+CIND?', name='get_signal_quality',
+                    priority=priority)
         d = self.queue_at_cmd(cmd)
         d.addCallback(get_signal_quality_cb)
         return d
@@ -551,7 +553,8 @@ class EricssonWrapper(WCDMAWrapper):
 
     def _get_ip4_config(self):
         """Returns the ip4 config on a later Ericsson NDIS device"""
-        cmd = ATCmd('AT*E2IPCFG?', name='get_ip4_config')
+        cmd = ATCmd('AT*E2IPCFG?', name='get_ip4_config',
+                    priority=PRIORITY_CONNECTION)
         d = self.queue_at_cmd(cmd)
 
         def _get_ip4_config_cb(resp):
@@ -621,7 +624,8 @@ class EricssonWrapper(WCDMAWrapper):
         else:
             args = (conn_id, user, passwd, _auth)
 
-        return self.send_at('AT*EIAAUW=%d,1,"%s","%s",%s' % args)
+        return self.send_at('AT*EIAAUW=%d,1,"%s","%s",%s' % args,
+                            priority=PRIORITY_CONNECTION)
 
     def hso_connect(self):
         conn_id = self.state_dict.get('conn_id')
@@ -642,7 +646,8 @@ class EricssonWrapper(WCDMAWrapper):
         self.device.connection_attempt_failed = False
         self.device.set_status(consts.MM_MODEM_STATE_CONNECTING)
 
-        d = self.send_at('AT*ENAP=1,%d' % conn_id)
+        d = self.send_at('AT*ENAP=1,%d' % conn_id,
+                         priority=PRIORITY_CONNECTION)
 
         ip_method = self.device.get_property(consts.MDM_INTFACE, 'IpMethod')
         if ip_method == consts.MM_IP_METHOD_DHCP:
@@ -654,7 +659,8 @@ class EricssonWrapper(WCDMAWrapper):
             # early, but actually no worse than ipmethod == PPP).
 
             def get_enap():
-                cmd = ATCmd('AT*ENAP?', name='get_enap')
+                cmd = ATCmd('AT*ENAP?', name='get_enap',
+                            priority=PRIORITY_CONNECTION)
                 d = self.queue_at_cmd(cmd)
 
                 def get_enap_cb(resp):
@@ -726,7 +732,7 @@ class EricssonWrapper(WCDMAWrapper):
             if self.device.status > consts.MM_MODEM_STATE_REGISTERED:
                 self.device.set_status(consts.MM_MODEM_STATE_REGISTERED)
 
-        d = self.send_at('AT*ENAP=0')
+        d = self.send_at('AT*ENAP=0', priority=PRIORITY_CONNECTION)
         d.addCallback(disconnect_cb)
         return d
 
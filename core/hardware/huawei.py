@@ -122,7 +122,7 @@ def huawei_new_rssi(args, device):
     except (ValueError, TypeError):
         return None
 
-    device.sconn.updatecache(strength, 'signal')
+    device.sconn.cache.update(strength, 'signal')
     device.sconn.emit_rssi(strength)
     return None
 
@@ -382,7 +382,7 @@ class HuaweiWCDMAWrapper(WCDMAWrapper):
         d.addCallback(lambda match: self._regexp_to_contact(match[0]))
         return d
 
-    def get_network_info(self, _type=None):
+    def get_network_info(self, _type=None, priority=None):
 
         # Some E220 firmwares will append an extra char to AT+COPS?
         # (off-by-one) or reply as 'FFFFFFFFFF+'. The following callback
@@ -398,7 +398,8 @@ class HuaweiWCDMAWrapper(WCDMAWrapper):
             # clean extra '@', 'x1a', etc
             return NETINFO_REGEXP.sub('', operator), tech
 
-        d = super(HuaweiWCDMAWrapper, self).get_network_info(_type)
+        d = super(HuaweiWCDMAWrapper, self).get_network_info(_type,
+                                                              priority)
         d.addCallback(process_netinfo_cb)
         return d
 
@@ -27,7 +27,8 @@ import wader.common.aterrors as E
 import wader.common.signals as S
 from wader.common.utils import revert_dict, rssi_to_percentage
 
-from core.command import get_cmd_dict_copy, build_cmd_dict, ATCmd
+from core.command import (get_cmd_dict_copy, build_cmd_dict, ATCmd,
+                          PRIORITY_CONNECTION)
 from core.exported import HSOExporter
 from core.hardware.base import WCDMACustomizer
 from core.middleware import WCDMAWrapper
@@ -144,7 +145,7 @@ def icera_new_conn_mode(args, device):
     except (ValueError, TypeError, IndexError):
         return None
 
-    device.sconn.updatecache(strength, 'signal')
+    device.sconn.cache.update(strength, 'signal')
     device.sconn.emit_rssi(strength)
 
     device.sconn.emit_network_mode(netmode)
@@ -321,7 +322,8 @@ class IceraWrapper(WCDMAWrapper):
         if conn_id is None:
             raise E.CallIndexError("conn_id is None")
 
-        cmd = ATCmd('AT%%IPDPADDR=%d' % conn_id, name='get_ip4_config')
+        cmd = ATCmd('AT%%IPDPADDR=%d' % conn_id, name='get_ip4_config',
+                    priority=PRIORITY_CONNECTION)
         d = self.queue_at_cmd(cmd)
 
         def _get_ip4_config_cb(resp):
@@ -354,7 +356,7 @@ class IceraWrapper(WCDMAWrapper):
 
         args = (conn_id, _auth, user, passwd)
         cmd = ATCmd('AT%%IPDPCFG=%d,0,%d,"%s","%s"' % args,
-                    name='hso_authenticate')
+                    name='hso_authenticate', priority=PRIORITY_CONNECTION)
         d = self.queue_at_cmd(cmd)
         d.addCallback(lambda resp: resp[0].group('resp'))
         return d
@@ -374,7 +376,8 @@ class IceraWrapper(WCDMAWrapper):
         self.device.connection_attempt_failed = False
         self.device.set_status(consts.MM_MODEM_STATE_CONNECTING)
 
-        return self.send_at('AT%%IPDPACT=%d,1' % conn_id)
+        return self.send_at('AT%%IPDPACT=%d,1' % conn_id,
+                            priority=PRIORITY_CONNECTION)
 
     def hso_disconnect(self):
         conn_id = self.state_dict.get('conn_id')
@@ -388,7 +391,8 @@ class IceraWrapper(WCDMAWrapper):
             if self.device.status > consts.MM_MODEM_STATE_REGISTERED:
                 self.device.set_status(consts.MM_MODEM_STATE_REGISTERED)
 
-        d = self.send_at('AT%%IPDPACT=%d,0' % conn_id)
+        d = self.send_at('AT%%IPDPACT=%d,0' % conn_id,
+                         priority=PRIORITY_CONNECTION)
         d.addCallback(disconnect_cb)
         return d
 
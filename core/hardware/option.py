@@ -27,7 +27,8 @@ import wader.common.aterrors as E
 import wader.common.signals as S
 from wader.common.utils import rssi_to_percentage, revert_dict
 
-from core.command import get_cmd_dict_copy, build_cmd_dict, ATCmd
+from core.command import (get_cmd_dict_copy, build_cmd_dict, ATCmd,
+                          PRIORITY_CONNECTION)
 from core.exported import HSOExporter
 from core.hardware.base import WCDMACustomizer
 from core.middleware import WCDMAWrapper
@@ -141,7 +142,7 @@ def option_new_rssi(args, device):
     except (ValueError, TypeError, IndexError):
         return None
 
-    device.sconn.updatecache(strength, 'signal')
+    device.sconn.cache.update(strength, 'signal')
     device.sconn.emit_rssi(strength)
     return None
 
@@ -407,7 +408,8 @@ class OptionHSOWrapper(OptionWrapper):
         if not conn_id:
             raise E.CallIndexError("conn_id is None")
 
-        cmd = ATCmd('AT_OWANDATA=%d' % conn_id, name='get_ip4_config')
+        cmd = ATCmd('AT_OWANDATA=%d' % conn_id, name='get_ip4_config',
+                    priority=PRIORITY_CONNECTION)
         d = self.queue_at_cmd(cmd)
 
         def _get_ip4_config_cb(resp):
@@ -437,7 +439,7 @@ class OptionHSOWrapper(OptionWrapper):
 
         args = (conn_id, _auth, user, passwd)
         cmd = ATCmd('AT$QCPDPP=%d,%d,"%s","%s"' % args,
-                    name='hso_authenticate')
+                    name='hso_authenticate', priority=PRIORITY_CONNECTION)
         d = self.queue_at_cmd(cmd)
         d.addCallback(lambda resp: resp[0].group('resp'))
         return d
@@ -460,7 +462,8 @@ class OptionHSOWrapper(OptionWrapper):
 
         self.device.set_status(consts.MM_MODEM_STATE_CONNECTING)
 
-        return self.device.sconn.send_at('AT_OWANCALL=%d,1,0' % conn_id)
+        return self.device.sconn.send_at('AT_OWANCALL=%d,1,0' % conn_id,
+                                         priority=PRIORITY_CONNECTION)
 
     def hso_disconnect(self):
         conn_id = self.state_dict.get('conn_id')
@@ -475,7 +478,8 @@ class OptionHSOWrapper(OptionWrapper):
             if self.device.status > consts.MM_MODEM_STATE_REGISTERED:
                 self.device.set_status(consts.MM_MODEM_STATE_REGISTERED)
 
-        d = self.device.sconn.send_at('AT_OWANCALL=%d,0,0' % conn_id)
+        d = self.device.sconn.send_at('AT_OWANCALL=%d,0,0' % conn_id,
+                                      priority=PRIORITY_CONNECTION)
         d.addCallback(disconnect_cb)
         return d
 
@@ -20,7 +20,8 @@
 from time import mktime
 
 from twisted.internet import reactor
-from twisted.internet.defer import  succeed, gatherResults, Deferred
+from twisted.internet.defer import  (succeed, gatherResults, Deferred,
+                                     DeferredList)
 from twisted.python import log
 
 from messaging.sms import SmsDeliver
@@ -30,8 +31,11 @@ from messaging.sms.wap import (extract_push_notification,
 from wader.common.aterrors import (CMSError314, SimBusy, SimNotStarted,
                                    SimFailure)
 from wader.common.encoding import pack_dbus_safe_string
-from wader.common.signals import SIG_MMS, SIG_SMS, SIG_SMS_COMP, SIG_SMS_DELV
+from wader.common.exceptions import MalformedSMSError
+from wader.common.signals import (SIG_MMS, SIG_SMS, SIG_SMS_COMP, SIG_SMS_DELV,
+                                  SIG_SMS_DELV_TIMEOUT)
 from wader.common.sms import Message
+from core.cache import read_pickle, write_pickle
 from core.mms import dbus_data_to_mms
 
 STO_INBOX, STO_DRAFTS, STO_SENT = 1, 2, 3
@@ -41,11 +45,27 @@ SMS_DATE_THRESHOLD = 5
 MAL_RETRIES = 3
 MAL_RETRY_TIMEOUT = 3
 
+# Seconds the SMS notifications are collected for before reading them
+SMS_NOTIFICATION_WINDOW = 0.5
 
-def debug(s):
+# Seconds a delivery report is waited for
+DELIVERY_REPORT_TTL = 24 * 60 * 60
+
+# Seconds the changes to the SMS storage are collected for before
+# writing its snapshot
+SNAPSHOT_DELAY = 5
+
+
+def debug(s, *args):
     # Change this to remove debugging
     if 1:
-        print s
+        # the arguments are only formatted when printed
+        print s % args if args else s
+
+
+def get_fragment_key(sms):
+    """Returns the key of the concatenated SMS that ``sms`` is part of"""
+    return (sms.number, sms.ref, sms.cnt, sms.csca)
 
 
 def should_fragment_be_assembled(sms, fragment):
@@ -77,7 +97,7 @@ def should_fragment_be_assembled(sms, fragment):
         # different SMSC
         return False
 
-    debug("MAL: Assembling fragment %s with sms %s" % (fragment, sms))
+    debug("MAL: Assembling fragment %s with sms %s", fragment, sms)
     return True
 
 
@@ -96,17 +116,61 @@ class NotificationContainer(object):
     def __init__(self, tx_id=None):
         self.notifications = []
         self.tx_id = tx_id
+        # the (wap_push, notification) received last
+        self.last = None
 
     def add_notification(self, wap_push, notification):
         self.notifications.append((wap_push, notification))
+        if (self.last is None or wap_push.datetime is None
+                or self.last[0].datetime is None
+                or wap_push.datetime >= self.last[0].datetime):
+            self.last = (wap_push, notification)
 
     def get_last_notification(self):
         """Returns the last received notification"""
-        # comp function must return an int
-        ret = sorted(self.notifications,
-                     lambda _, n: int(mktime(n[0].datetime.timetuple())))
-        # return the last element
-        return ret[-1][1]
+        return self.last[1]
+
+
+class SnapshotStore(object):
+    """
+    I keep on disk the SMS storage of every SIM, keyed by its ICCID
+
+    A snapshot is a dict of the real index of every stored SMS to the
+    storage it is in and its raw PDU.
+    """
+
+    def __init__(self):
+        super(SnapshotStore, self).__init__()
+        self.path = None
+
+    def load(self, path):
+        """Uses the snapshots stored in ``path``"""
+        self.path = path
+
+    def get(self, iccid):
+        """Returns the snapshot of ``iccid`` or None"""
+        if self.path is None:
+            return None
+
+        return read_pickle(self.path, 'SMS snapshots').get(iccid)
+
+    def put(self, iccid, snapshot):
+        """Saves ``snapshot`` as the one of ``iccid``"""
+        if self.path is None:
+            return
+
+        stored = read_pickle(self.path, 'SMS snapshots')
+        stored[iccid] = snapshot
+        write_pickle(self.path, stored, 'SMS snapshots')
+
+    def discard(self, iccid):
+        """Drops the snapshot of ``iccid``"""
+        if self.path is None:
+            return
+
+        stored = read_pickle(self.path, 'SMS snapshots')
+        if stored.pop(iccid, None) is not None:
+            write_pickle(self.path, stored, 'SMS snapshots')
 
 
 class MessageAssemblyLayer(object):
@@ -118,21 +182,232 @@ class MessageAssemblyLayer(object):
         self.last_wap_index = 0
         self.sms_map = {}
         self.wap_map = {}
-        self.sms_pending = []
+        # {(Transaction-Id, From): index in wap_map}
+        self.wap_index = {}
         self.cached = False
+        # {fragment key: [logical indexes of the incomplete SMS]}
+        self.fragments = {}
+        # {TP-MR: (expiry time, sent SMS)} of the delivery reports waited
+        # for and their TP-MRs, oldest first. The TP-MR is a byte so there
+        # are at most 256
+        self.reports = {}
+        self.report_refs = []
+        self.report_ttl = DELIVERY_REPORT_TTL
+        self.reports_call = None
+        self.clock = reactor
+        # SMS notified in the current window and their waiting deferreds
+        self.notification_window = SMS_NOTIFICATION_WINDOW
+        self.notified = {}
+        self.notified_call = None
+        # {real index: (where, PDU)} of the SMS in the storage, the PDU
+        # is None for the SMS we saved
+        self.stored = {}
+        self.snapshots = SnapshotStore()
+        self.snapshot_call = None
+        self.iccid = None
 
     def initialize(self, obj=None):
         debug("MAL::initialize obj: %s" % obj)
         if obj is not None:
             self.wrappee = obj
 
+        # the pending snapshot is the one of the previous SIM
+        self._flush_snapshot()
         # revert to initial state
         self.last_sms_index = self.last_wap_index = 0
         self.sms_map = {}
-        self.sms_pending = []
+        self.fragments = {}
+        # the WAP pushes are in the SMS storage, they are listed again
+        self.wap_map = {}
+        self.wap_index = {}
+        self.stored = {}
+        self.iccid = None
         self.cached = False
-        # populate sms cache
-        return self._do_initialize()
+        if self.snapshots.path is None:
+            # populate sms cache
+            return self._do_initialize()
+
+        def get_iccid_eb(failure):
+            debug("MAL::initialize no ICCID, not using snapshots: %s",
+                  failure.getErrorMessage())
+            return self._do_initialize()
+
+        d = self.wrappee.get_iccid()
+        d.addCallbacks(self._warm_initialize, get_iccid_eb)
+        return d
+
+    def _warm_initialize(self, iccid):
+        """
+        Populates the cache from the snapshot of the SIM ``iccid``
+
+        The snapshot answers the first listing right away while it is
+        checked against the storage in the background.
+        """
+        self.iccid = iccid
+        snapshot = self.snapshots.get(iccid)
+        if not snapshot:
+            return self._do_initialize()
+
+        messages = []
+        for index in sorted(snapshot):
+            where, pdu = snapshot[index]
+            try:
+                sms = Message.from_pdu(pdu)
+            except ValueError:
+                log.err(MalformedSMSError, "Malformed PDU: %s" % pdu)
+                continue
+
+            sms.index, sms.where = index, where
+            messages.append(sms)
+
+        debug("MAL::_warm_initialize %d SMS from the snapshot of %s",
+              len(messages), iccid)
+        ret = self._gen_cache(messages)
+        self.clock.callLater(0, self._reconcile)
+        return ret
+
+    def _reconcile(self):
+        """
+        Checks the cache populated from a snapshot against the storage
+
+        If the storage holds more SMS than the snapshot the unread ones
+        are read, anything else lists the storage again.
+        """
+
+        def resync():
+            debug("MAL::_reconcile snapshot is stale, listing again")
+            d = self.wrappee.do_list_sms()
+            d.addCallback(self._resync)
+            return d
+
+        def check(used):
+            if used != len(self.stored):
+                return resync()
+
+            debug("MAL::_reconcile snapshot is up to date")
+            self._save_snapshot()
+
+        def add_unread(messages):
+            for sms in messages:
+                # the notified ones might have been read meanwhile
+                if sms.index not in self.stored:
+                    self._add_sms(sms, emit=True)
+
+        def storage_cb(result):
+            used, total = result
+            if used <= len(self.stored):
+                return check(used)
+
+            # received while we were not running
+            d = self.wrappee.do_list_sms(0)
+            d.addCallback(add_unread)
+            d.addCallback(lambda _: check(used))
+            return d
+
+        def reconcile_eb(failure):
+            log.err(failure, "MAL: can not reconcile the SMS snapshot")
+
+        d = self.wrappee.get_sms_storage()
+        d.addCallback(storage_cb)
+        d.addErrback(reconcile_eb)
+        return d
+
+    def _resync(self, messages):
+        """
+        Brings the cache in line with the stored ``messages``
+
+        The SMS and MMS notifications still stored keep their logical
+        index, the ones gone are dropped and the new ones are added and
+        signalled.
+        """
+        listed = dict([(sms.index, sms) for sms in messages])
+
+        for index, sms in self.sms_map.items():
+            if not sms.real_indexes:
+                # routed to us
+                continue
+
+            if self._is_stored(sms, listed):
+                map(listed.pop, sms.real_indexes)
+            else:
+                del self.sms_map[index]
+                self._unindex_fragments(index, sms)
+
+        for index, container in self.wap_map.items():
+            _from = container.get_last_notification().headers['From']
+            notifications = container.notifications
+            container = NotificationContainer(container.tx_id)
+            for wap_push, notification in notifications:
+                if self._is_stored(wap_push, listed):
+                    map(listed.pop, wap_push.real_indexes)
+                    container.add_notification(wap_push, notification)
+
+            if container.notifications:
+                self.wap_map[index] = container
+            else:
+                del self.wap_map[index]
+                self.wap_index.pop((container.tx_id, _from), None)
+
+        self.stored = {}
+        for sms in messages:
+            self._store(sms)
+
+        for index in sorted(listed):
+            self._add_sms(listed[index], emit=True)
+
+        self._save_snapshot()
+
+    def _is_stored(self, sms, listed):
+        """Returns True if every part of ``sms`` is in ``listed``"""
+        for index in sms.real_indexes:
+            if index not in listed:
+                return False
+
+            # the real index might have been reused meanwhile
+            pdu = self.stored.get(index, (None, None))[1]
+            if pdu is not None and pdu != listed[index].pdu:
+                return False
+
+        return True
+
+    def _store(self, sms):
+        """Mirrors ``sms`` read from the storage in :attr:`stored`"""
+        if sms.index is not None:
+            self.stored[sms.index] = (sms.where, sms.pdu)
+
+    def _unstore(self, indexes):
+        for index in indexes:
+            self.stored.pop(index, None)
+
+    def _save_snapshot(self):
+        """
+        Saves :attr:`stored` as the snapshot of the current SIM
+
+        It is written :data:`SNAPSHOT_DELAY` seconds later, so a burst
+        of changes only writes it once.
+        """
+        if self.iccid is None or self.snapshot_call is not None:
+            return
+
+        self.snapshot_call = self.clock.callLater(SNAPSHOT_DELAY,
+                                                  self._write_snapshot)
+
+    def _flush_snapshot(self):
+        """Writes the pending snapshot right away"""
+        if self.snapshot_call is not None:
+            self.snapshot_call.cancel()
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        self.snapshot_call = None
+        if self.iccid is None:
+            return
+
+        if None in [pdu for where, pdu in self.stored.itervalues()]:
+            # the PDU of the SMS we saved is not known, list it next time
+            self.snapshots.discard(self.iccid)
+        else:
+            self.snapshots.put(self.iccid, dict(self.stored))
 
     def _do_initialize(self):
         # init counter
@@ -167,7 +442,8 @@ class MessageAssemblyLayer(object):
         # save the real index if indexes is None
         if indexes:
             map(sms.real_indexes.add, indexes)
-        else:
+        elif sms.index is not None:
+            # SMS routed to us are not stored
             sms.real_indexes.add(sms.index)
         #debug("MAL::_do_add_sms sms.real_indexes %s" % sms.real_indexes)
         # assign a new logical index
@@ -177,13 +453,48 @@ class MessageAssemblyLayer(object):
         self.sms_map[self.last_sms_index] = sms
         return self.last_sms_index
 
+    def _index_fragments(self, index, sms):
+        key = get_fragment_key(sms)
+        self.fragments.setdefault(key, []).append(index)
+
+    def _unindex_fragments(self, index, sms):
+        key = get_fragment_key(sms)
+        indexes = self.fragments.get(key, [])
+        if index in indexes:
+            indexes.remove(index)
+        if not indexes:
+            self.fragments.pop(key, None)
+
+    def _find_incomplete_sms(self, fragment):
+        """
+        Returns the logical index of the SMS ``fragment`` belongs to
+
+        Only the incomplete SMS with the same sender, reference, number
+        of parts and SMSC are checked, the date still tells apart those
+        reusing a reference.
+        """
+        for index in self.fragments.get(get_fragment_key(fragment), []):
+            sms = self.sms_map.get(index)
+            if sms and should_fragment_be_assembled(sms, fragment):
+                return index
+
+        return None
+
+    def _rebuild_fragments(self):
+        self.fragments = {}
+        for index in sorted(self.sms_map):
+            sms = self.sms_map[index]
+            if sms.cnt and not sms.completed:
+                self._index_fragments(index, sms)
+
     def _add_sms(self, sms, emit=False):
         """
         Adds ``sms`` to the cache
 
         It returns the logical index where it was stored
         """
-        debug("MAL::_add_sms: %s" % sms)
+        debug("MAL::_add_sms: %s", sms)
+        self._store(sms)
         if not sms.cnt:
             index = self._do_add_sms(sms)
             debug("MAL::_add_sms  single part SMS added with "
@@ -194,45 +505,47 @@ class MessageAssemblyLayer(object):
                     self.wrappee.emit_signal(signal, index, True)
             return index
         else:
-            for index, value in self.sms_map.iteritems():
-                if should_fragment_be_assembled(value, sms):
-                    # append the sms and emit the different signals
-                    completed = self.sms_map[index].append_sms(sms)
-                    debug("MAL::_add_sms  multi part SMS with logical "
-                          "index %d, completed %s" % (index, completed))
-
-                    # check if we have just assembled a WAP push notification
+            index = self._find_incomplete_sms(sms)
+            if index is not None:
+                # append the sms and emit the different signals
+                completed = self.sms_map[index].append_sms(sms)
+                debug("MAL::_add_sms  multi part SMS with logical "
+                      "index %d, completed %s" % (index, completed))
+
+                # check if we have just assembled a WAP push notification
+                if completed:
+                    self._unindex_fragments(index, sms)
+                    notification = self.sms_map[index]
+                    if self._is_a_wap_push_notification(notification):
+                        if self._process_wap_push_notification(index,
+                                                                    emit):
+                            debug("MAL::_add_sms MMS processed OK")
+                            # There's no need to return an index here as we
+                            # have been called by gen_cache and MMS has a
+                            # different index scheme than SMS.
+                            return
+
+                        # XXX: Must have been a non-MMS notification WAP
+                        #      push, there's nothing we can do with those
+                        #      presently. Leave them to be displayed as
+                        #      SMS, although poorly, so that they may be
+                        #      removed by the user if desired.
+
+                if emit:
+                    # only emit signals in runtime, not startup
+                    self.wrappee.emit_signal(SIG_SMS, index, completed)
                     if completed:
-                        notification = self.sms_map[index]
-                        if self._is_a_wap_push_notification(notification):
-                            if self._process_wap_push_notification(index,
-                                                                        emit):
-                                debug("MAL::_add_sms MMS processed OK")
-                                # There's no need to return an index here as we
-                                # have been called by gen_cache and MMS has a
-                                # different index scheme than SMS.
-                                return
-
-                            # XXX: Must have been a non-MMS notification WAP
-                            #      push, there's nothing we can do with those
-                            #      presently. Leave them to be displayed as
-                            #      SMS, although poorly, so that they may be
-                            #      removed by the user if desired.
-
-                    if emit:
-                        # only emit signals in runtime, not startup
-                        self.wrappee.emit_signal(SIG_SMS, index, completed)
-                        if completed:
-                            self.wrappee.emit_signal(SIG_SMS_COMP, index,
-                                                     completed)
-
-                    # return sms logical index
-                    return index
+                        self.wrappee.emit_signal(SIG_SMS_COMP, index,
+                                                 completed)
+
+                # return sms logical index
+                return index
 
             # this is the first fragment of this multipart sms, add it
             # to cache, emit signal and wait for the rest of fragments
             # to arrive. It returns the logical index where was stored
             index = self._do_add_sms(sms)
+            self._index_fragments(index, sms)
             if emit:
                 self.wrappee.emit_signal(SIG_SMS, index, False)
 
@@ -248,11 +561,28 @@ class MessageAssemblyLayer(object):
                   " NotificationContainer %d does not exist" % index)
             return
 
+        _from = container.get_last_notification().headers['From']
+        self.wap_index.pop((container.tx_id, _from), None)
+
         indexes = []
         for wap_push, _ in container.notifications:
             indexes.extend(wap_push.real_indexes)
 
-        ret = map(self.wrappee.do_delete_sms, indexes)
+        return self._delete_stored(indexes)
+
+    def _delete_stored(self, indexes):
+        """Deletes the real ``indexes``, unstoring each once deleted"""
+
+        def delete_sms_cb(_, index):
+            self._unstore([index])
+            self._save_snapshot()
+
+        ret = []
+        for index in indexes:
+            d = self.wrappee.do_delete_sms(index)
+            d.addCallback(delete_sms_cb, index)
+            ret.append(d)
+
         return gatherResults(ret)
 
     def acknowledge_mms(self, index, extra_info):
@@ -265,9 +595,9 @@ class MessageAssemblyLayer(object):
         debug("MAL::delete_sms: %d" % index)
         if index in self.sms_map:
             sms = self.sms_map.pop(index)
-            ret = map(self.wrappee.do_delete_sms, sms.real_indexes)
+            self._unindex_fragments(index, sms)
             debug("MAL::delete_sms deleting %s" % sms.real_indexes)
-            return gatherResults(ret)
+            return self._delete_stored(sms.real_indexes)
 
         error = "SMS with logical index %d does not exist"
         raise CacheIncoherenceError(error % index)
@@ -308,18 +638,32 @@ class MessageAssemblyLayer(object):
 
         return ret
 
+    def _gen_cache(self, messages):
+        """Populates the cache with the stored ``messages``"""
+        debug("MAL::_gen_cache")
+        # the SMS routed to us are not in the storage
+        self.sms_map = dict([(index, sms) for index, sms in
+                             self.sms_map.iteritems()
+                                if not sms.real_indexes])
+        # the WAP pushes are listed again
+        self.wap_map = {}
+        self.wap_index = {}
+        self.stored = {}
+        self._rebuild_fragments()
+        for sms in messages:
+            self._add_sms(sms)
+
+        self.cached = True
+        return self._list_sms()
+
     def list_sms(self):
         """Returns all the sms"""
         debug("MAL::list_sms")
 
         def gen_cache(messages):
-            debug("MAL::list_sms::gen_cache")
-            self.sms_map = {}
-            for sms in messages:
-                self._add_sms(sms)
-
-            self.cached = True
-            return self._list_sms()
+            ret = self._gen_cache(messages)
+            self._save_snapshot()
+            return ret
 
         if self.cached:
             debug("MAL::list_sms::cached path")
@@ -329,10 +673,10 @@ class MessageAssemblyLayer(object):
         d.addCallback(gen_cache)
         return d
 
-    def list_sms_raw(self):
+    def list_sms_raw(self, priority=None):
         """Returns all the raw sms, not assembled via the mal"""
         debug("MAL::list_sms_raw")
-        return self.wrappee.do_list_sms()
+        return self.wrappee.do_list_sms(priority=priority)
 
     def send_mms(self, mms, extra_info):
         debug("MAL::send_mms: %s" % mms)
@@ -352,6 +696,7 @@ class MessageAssemblyLayer(object):
         debug("MAL::send_sms_from_storage: %d" % index)
         if index in self.sms_map:
             sms = self.sms_map.pop(index)
+            self._unindex_fragments(index, sms)
             indexes = sorted(sms.real_indexes)
             debug("MAL::send_sms_from_storage sending %s" % indexes)
             ret = map(self.wrappee.do_send_sms_from_storage, indexes)
@@ -364,44 +709,167 @@ class MessageAssemblyLayer(object):
         """Saves ``sms`` in the cache memorizing the resulting indexes"""
         debug("MAL::save_sms: %s" % sms)
         d = self.wrappee.do_save_sms(sms)
-        d.addCallback(lambda indexes: self._do_add_sms(sms, indexes))
-        d.addCallback(lambda logical_index: [logical_index])
+
+        def save_sms_cb(indexes):
+            for index in indexes:
+                self.stored[index] = (STO_DRAFTS, None)
+            self._save_snapshot()
+            return [self._do_add_sms(sms, indexes)]
+
+        d.addCallback(save_sms_cb)
         return d
 
     def _save_sms_reference(self, indexes, sms):
         sms.status_references.extend(indexes)
         sms.status_reference = indexes[0]
-        self.sms_pending.append(sms)
+        expires = self.clock.seconds() + self.report_ttl
+        for ref in indexes:
+            if ref in self.reports:
+                # the reference wrapped around before its report arrived,
+                # the report can not be told apart anymore
+                debug("MAL::_save_sms_reference %d reused" % ref)
+                self._expire_report(ref)
+            self.reports[ref] = (expires, sms)
+            self.report_refs.append(ref)
+
+        self._schedule_reports_expiry()
         return [sms.status_reference]
 
+    def _pop_report(self, ref):
+        """Stops waiting for the delivery report ``ref``, returns its SMS"""
+        _, sms = self.reports.pop(ref)
+        self.report_refs.remove(ref)
+        return sms
+
+    def _expire_report(self, ref):
+        """Gives up on the delivery reports of the SMS sent as ``ref``"""
+        sms = self._pop_report(ref)
+        for _ref in sms.status_references:
+            if self.reports.get(_ref, (None, None))[1] is sms:
+                self._pop_report(_ref)
+
+        sms.status_references = []
+        log.msg("delivery report of SMS %d timed out" % sms.status_reference)
+        self.wrappee.emit_signal(SIG_SMS_DELV_TIMEOUT, sms.status_reference)
+
+    def _expire_reports(self):
+        self.reports_call = None
+        now = self.clock.seconds()
+        while self.report_refs:
+            ref = self.report_refs[0]
+            if self.reports[ref][0] > now:
+                break
+            self._expire_report(ref)
+
+        self._schedule_reports_expiry()
+
+    def _schedule_reports_expiry(self):
+        if self.reports_call is not None or not self.reports:
+            return
+
+        expires = self.reports[self.report_refs[0]][0]
+        delay = max(expires - self.clock.seconds(), 0)
+        self.reports_call = self.clock.callLater(delay, self._expire_reports)
+
     def on_sms_delivery_report(self, pdu):
         """Executed when a SMS delivery report is received"""
         data = SmsDeliver(pdu).data
         sms = Message.from_dict(data)
         assert sms.is_status_report(), "SMS IS NOT STATUS REPORT"
-        # XXX: O(N) here
-        for _sms in self.sms_pending:
-            if sms.ref in _sms.status_references:
-                # one confirmation received
-                _sms.status_references.remove(sms.ref)
-                # no more status references? Then we are done, remove it from
-                # the status_references list and emit signal
-                if not _sms.status_references:
-                    self.sms_pending.remove(_sms)
-                    return self.wrappee.emit_signal(SIG_SMS_DELV,
-                                                    _sms.status_reference)
-                break
-        else:
+        try:
+            _sms = self._pop_report(sms.ref)
+        except KeyError:
             log.err("Received status report with "
                     "unknown reference: %d" % sms.ref)
+            return
+
+        # one confirmation received
+        _sms.status_references.remove(sms.ref)
+        # no more status references? Then we are done, emit signal
+        if not _sms.status_references:
+            return self.wrappee.emit_signal(SIG_SMS_DELV,
+                                            _sms.status_reference)
 
     def on_sms_notification(self, index):
-        """Executed when a SMS notification is received"""
+        """
+        Executed when a SMS notification is received
+
+        The notifications received within :attr:`notification_window`
+        seconds are read together, so the parts of a multipart SMS are
+        assembled and emitted at once. Returns a deferred that will be
+        callbacked with the logical index of the SMS.
+        """
         debug("MAL::on_sms_notification: %d" % index)
-        d = self.wrappee.do_get_sms(index)
-        d.addCallback(self._add_sms, emit=True)
+        d = Deferred()
+        self.notified.setdefault(index, []).append(d)
+        if self.notified_call is None:
+            self.notified_call = self.clock.callLater(
+                    self.notification_window, self._read_notified_sms)
+        return d
+
+    def _read_notified_sms(self):
+        """
+        Reads and adds the SMS notified in the last window
+
+        The unread SMS are listed at once, the notified ones missing from
+        the listing are read by index. Every index is handled on its own,
+        a failed read only errbacks the deferreds waiting for it.
+        """
+        self.notified_call = None
+        notified, self.notified = self.notified, {}
+        indexes = sorted(notified)
+        debug("MAL::_read_notified_sms: %s" % indexes)
+
+        def get_sms(index, listed):
+            if index in listed:
+                return succeed(listed[index])
+
+            # read meanwhile or its PDU could not be parsed
+            return self.wrappee.do_get_sms(index)
+
+        def list_sms_cb(messages):
+            listed = dict([(sms.index, sms) for sms in messages
+                                if sms.index in notified])
+            d = DeferredList([get_sms(index, listed) for index in indexes],
+                             consumeErrors=True)
+            d.addCallback(add_sms_cb)
+            return d
+
+        def list_sms_eb(failure):
+            log.err(failure, "MAL: can not list the notified SMS")
+            return list_sms_cb([])
+
+        def add_sms_cb(results):
+            for index, (success, result) in zip(indexes, results):
+                if not success:
+                    for d in notified[index]:
+                        d.errback(result)
+                    continue
+
+                # handle bogus CMTI notifications, see #180
+                if result is not None:
+                    result = self._add_sms(result, emit=True)
+
+                for d in notified[index]:
+                    d.callback(result)
+
+            self._save_snapshot()
+
+        d = self.wrappee.do_list_sms(0)
+        d.addCallbacks(list_sms_cb, list_sms_eb)
         return d
 
+    def on_sms_direct(self, pdu):
+        """Executed when a SMS is routed to us rather than stored"""
+        debug("MAL::on_sms_direct: %s" % pdu)
+        try:
+            sms = Message.from_pdu(pdu)
+        except ValueError:
+            log.err(MalformedSMSError, "Malformed PDU: %s" % pdu)
+            return
+
+        return self._add_sms(sms, emit=True)
+
     def _is_a_wap_push_notification(self, sms):
         """Returns True if ``sms`` is a WAP push notification"""
         if sms.fmt != 0x04:
@@ -423,27 +891,20 @@ class MessageAssemblyLayer(object):
 
         wap_push = self.sms_map.pop(index)
 
-        index = None
         new = False
         _from = notification.headers['From']
         tx_id = notification.headers['Transaction-Id']
-        for i, container in self.wap_map.items():
-            if container.tx_id != tx_id:
-                continue
-
-            noti = container.get_last_notification()
-            if _from == noti.headers['From']:
-                index = i
-                break
-        else:
+        index = self.wap_index.get((tx_id, _from))
+        if index is None:
             # this is the first time we see this tx_id
             index = self.last_wap_index
             self.last_wap_index += 1
+            self.wap_index[(tx_id, _from)] = index
+            self.wap_map[index] = NotificationContainer(tx_id)
             new = True
 
-        container = self.wap_map.get(index, NotificationContainer(tx_id))
+        container = self.wap_map[index]
         container.add_notification(wap_push, notification)
-        self.wap_map[index] = container
 
         if emit and new:
             # emit the signal if this is the first time we
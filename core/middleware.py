@@ -63,11 +63,14 @@ from wader.common.signals import SIG_CREG
 from wader.common.sms import Message
 from wader.common.utils import rssi_to_percentage
 
+from core.cache import PropertyCache, CapabilityStore, EVENT_ACCESS_TECH
+from core.cmux import DATA_DLCI
 from core.contact import Contact
 from core.mal import MessageAssemblyLayer
 from core.mms import (send_m_send_req, send_m_notifyresp_ind,
                               get_payload)
 from core.oal import get_os_object
+from core.phonebook import Phonebook
 from core.protocol import WCDMAProtocol
 from core.sim import (COM_READ_BINARY, EF_AD, EF_SPN, EF_ICCID, SW_OK,
                               RETRY_ATTEMPTS, RETRY_TIMEOUT)
@@ -88,6 +91,8 @@ class WCDMAWrapper(WCDMAProtocol):
         self.state_dict = {}
         # message assembly layer (initted on do_enable_device)
         self.mal = MessageAssemblyLayer(self)
+        # mirror of the SIM phonebook (loaded once the SIM is initted)
+        self.phonebook = Phonebook(self)
 
         self.signal_matchs = []
 
@@ -100,29 +105,12 @@ class WCDMAWrapper(WCDMAProtocol):
         self.iface = None
 
         self.apn_range = None
+        # SMS parts queued and not sent yet
+        self.sms_pending = 0
 
-        self.caches = {
-            'signal': (0, 0),
-            'registration': (0, (0, '', '')),
-        }
-
-    def maybecached(self, name, fn, cblist):
-        if self.caches[name][0] >= time():  # cache hasn't expired
-            log.msg("get '%s' (cached path)" % name, system='CACHE')
-            d = defer.succeed(self.caches[name][1])
-        else:
-            log.msg("get '%s' (noncached path)" % name, system='CACHE')
-            d = fn()
-            for cb in cblist:
-                d.addCallback(cb)
-            d.addCallback(self.updatecache, name)
-        return d
-
-    def updatecache(self, value, name):
-        CACHETIME = 5
-
-        self.caches[name] = (time() + CACHETIME, value)
-        return value
+        self.cache = PropertyCache()
+        self.cache.install(self)
+        self.capabilities = CapabilityStore()
 
     def emit_network_mode(self, value):
         """
@@ -130,6 +118,7 @@ class WCDMAWrapper(WCDMAProtocol):
         """
         if value < 0 or value > MM_NETWORK_MODE_LAST:
             return
+        self.cache.on_event(EVENT_ACCESS_TECH)
         self.device.exporter.NetworkMode(dbus.UInt32(value))
 
     def emit_rssi(self, value):
@@ -485,7 +474,7 @@ class WCDMAWrapper(WCDMAProtocol):
         d.addCallback(lambda response: response[0].group('name'))
         return d
 
-    def _get_netreg_info(self, status):
+    def _get_netreg_info(self, status, priority=None):
         # Ugly but it works. The naive approach with DeferredList won't work
         # as the call order is not guaranteed
         resp = [status]
@@ -512,11 +501,11 @@ class WCDMAWrapper(WCDMAProtocol):
             failure.trap(E.NoNetwork, ex.LimitedServiceNetworkError)
             resp.append('')
 
-        d = self.get_network_info('numeric')
+        d = self.get_network_info('numeric', priority)
         d.addCallback(get_netinfo_cb)
         d.addErrback(get_netinfo_eb)
 
-        d.addCallback(lambda _: self.get_network_info('name'))
+        d.addCallback(lambda _: self.get_network_info('name', priority))
         d.addCallback(get_netinfo_cb)
         d.addErrback(get_netinfo_eb)
 
@@ -538,23 +527,33 @@ class WCDMAWrapper(WCDMAProtocol):
 
         return reginfo
 
-    def get_netreg_info(self):
-        """Get the registration status and the current operator"""
-        return self.maybecached('registration', self.get_netreg_status,
-                [lambda info: info[1], self._get_netreg_info,
-                    self._get_netreg_info_emit])
+    def get_netreg_info(self, priority=None):
+        """
+        Get the registration status and the current operator
+
+        The daemons poll it with ``priority`` set to the background class
+        """
+        if priority is None:
+            # do not keep the caller waiting for a background poll
+            self.promote_cmds('get_netreg_status', 'get_network_info')
+
+        return self.cache.get('registration',
+                lambda: self.get_netreg_status(priority),
+                lambda info: info[1],
+                lambda status: self._get_netreg_info(status, priority),
+                self._get_netreg_info_emit)
 
     def on_creg_cb(self, status):
         """Callback for +CREG notifications"""
         d = defer.succeed(status)
         d.addCallback(self._get_netreg_info)
         d.addCallback(self._get_netreg_info_emit)
-        d.addCallback(self.updatecache, 'registration')
+        d.addCallback(self.cache.update, 'registration')
         return d
 
-    def get_netreg_status(self):
+    def get_netreg_status(self, priority=None):
         """Returns a tuple with the network registration status"""
-        d = super(WCDMAWrapper, self).get_netreg_status()
+        d = super(WCDMAWrapper, self).get_netreg_status(priority)
 
         def convert_cb(resp):
             # convert them to int
@@ -563,7 +562,7 @@ class WCDMAWrapper(WCDMAProtocol):
         d.addCallback(convert_cb)
         return d
 
-    def get_network_info(self, _type=None):
+    def get_network_info(self, _type=None, priority=None):
         """
         Returns the network info  (a.k.a AT+COPS?)
 
@@ -573,7 +572,7 @@ class WCDMAWrapper(WCDMAProtocol):
         care of insisting before this problem. This method will convert
         numeric network IDs to alphanumeric.
         """
-        d = super(WCDMAWrapper, self).get_network_info(_type)
+        d = super(WCDMAWrapper, self).get_network_info(_type, priority)
 
         def get_net_info_cb(netinfo):
             """
@@ -827,15 +826,20 @@ class WCDMAWrapper(WCDMAProtocol):
                 obj.group('netid')) for obj in raw if int(obj.group('netid'))])
         return d
 
-    def get_signal_quality(self):
+    def get_signal_quality(self, priority=None):
         """Returns the signal level quality"""
         if self.device.status < MM_MODEM_STATE_ENABLED:
             return defer.succeed(0)
 
-        return self.maybecached('signal',
-                    super(WCDMAWrapper, self).get_signal_quality,
-                    [lambda response: int(response[0].group('rssi')),
-                        rssi_to_percentage])
+        if priority is None:
+            # do not keep the caller waiting for a background poll
+            self.promote_cmds('get_signal_quality')
+
+        return self.cache.get('signal',
+                    lambda: super(WCDMAWrapper, self).get_signal_quality(
+                                                                priority),
+                    lambda response: int(response[0].group('rssi')),
+                    rssi_to_percentage)
 
     def get_sms(self, index):
         return self.mal.get_sms(index)
@@ -868,6 +872,17 @@ class WCDMAWrapper(WCDMAProtocol):
         d.addCallback(lambda response: int(response[0].group('format')))
         return d
 
+    def get_sms_storage(self):
+        """
+        Returns the occupancy of the storage messages are read from
+
+        :rtype: tuple (used, total)
+        """
+        d = super(WCDMAWrapper, self).get_sms_storage()
+        d.addCallback(lambda response: (int(response[0].group('used')),
+                                        int(response[0].group('total'))))
+        return d
+
     def get_smsc(self):
         """Returns the SMSC number stored in the SIM"""
         d = super(WCDMAWrapper, self).get_smsc()
@@ -951,13 +966,13 @@ class WCDMAWrapper(WCDMAProtocol):
     def list_sms(self):
         return self.mal.list_sms()
 
-    def do_list_sms(self):
+    def do_list_sms(self, status=4, priority=None):
         """
-        Returns all the SMS in the SIM card
+        Returns the SMS with ``status`` in the SIM card, all by default
 
         :rtype: list
         """
-        d = super(WCDMAWrapper, self).list_sms()
+        d = super(WCDMAWrapper, self).list_sms(status, priority)
 
         def get_all_sms_cb(messages):
             sms_list = []
@@ -993,9 +1008,10 @@ class WCDMAWrapper(WCDMAProtocol):
                          [int(resp[0].group('index')) for resp in response])
         return d
 
-    def send_at(self, atstr, name='send_at', callback=None):
+    def send_at(self, atstr, name='send_at', callback=None, priority=None):
         """Sends an arbitrary AT string ``atstr``"""
-        d = super(WCDMAWrapper, self).send_at(atstr, name=name)
+        d = super(WCDMAWrapper, self).send_at(atstr, name=name,
+                                              priority=priority)
         if callback is None:
             d.addCallback(lambda response: response[0].group('resp'))
         else:
@@ -1051,18 +1067,63 @@ class WCDMAWrapper(WCDMAProtocol):
         return self.mal.send_sms(sms)
 
     def do_send_sms(self, sms):
+        pdus = sms.to_pdu()
+        sent = [time()]
 
-        def send_sms_cb(response):
+        def send_sms_cb(response, part):
+            now = time()
+            log.msg("SMS part %d/%d sent in %.3fs" %
+                    (part, len(pdus), now - sent[-1]))
+            sent.append(now)
             return int(response[0].group('index'))
 
+        def send_sms_done(result):
+            self.sms_pending -= 1
+            return result
+
+        # keep the link to the SMSC open between the parts and with the
+        # messages that follow right after
+        mode = self._get_more_messages_mode(len(pdus))
+        if mode:
+            self._set_more_messages_mode(mode)
+
+        self.sms_pending += len(pdus)
         ret = []
-        for pdu in sms.to_pdu():
+        for part, pdu in enumerate(pdus):
             d = super(WCDMAWrapper, self).send_sms(pdu.pdu, pdu.length)
-            d.addCallback(send_sms_cb)
+            d.addCallback(send_sms_cb, part + 1)
+            d.addBoth(send_sms_done)
             ret.append(d)
 
+        if mode == 2:
+            # the modem closes the link a few seconds after the last one
+            self._set_more_messages_mode(1)
+
         return defer.gatherResults(ret)
 
+    def _get_more_messages_mode(self, parts):
+        """Returns the AT+CMMS mode to send ``parts`` PDUs with"""
+        if self.device.quirks.get('no_more_messages_mode', False) or \
+                not self.state_dict.get('more_messages_mode', True):
+            return 0
+
+        if parts > 1:
+            return 2
+
+        # a burst of messages
+        return 1 if self.sms_pending else 0
+
+    def _set_more_messages_mode(self, mode):
+
+        def set_more_messages_mode_eb(failure):
+            # the SMS are sent nonetheless, each one with its own link
+            log.msg("AT+CMMS is not supported: %s" % failure.getErrorMessage())
+            self.state_dict['more_messages_mode'] = False
+
+        d = super(WCDMAWrapper, self).set_more_messages_mode(mode)
+        d.addErrback(set_more_messages_mode_eb)
+        return d
+
     def send_sms_from_storage(self, index):
         """Sends the SMS stored at ``index`` and returns the new index"""
         return self.mal.send_sms_from_storage(index)
@@ -1202,27 +1263,65 @@ class WCDMAWrapper(WCDMAProtocol):
         # There's no way to query this, so we have to assume :-(
         self.device.set_property(USD_INTFACE, 'State', 'idle')
 
-        d = self.get_bands()
-        d.addCallback(lambda bands: self.device.set_property(CRD_INTFACE,
-                                        'SupportedBands', dbus.UInt32(bands)))
-        d.addCallback(lambda _: self.get_network_modes())
-        d.addCallback(lambda modes: self.device.set_property(CRD_INTFACE,
-                                        'SupportedModes', dbus.UInt32(modes)))
-        d.addCallback(lambda _: self.get_pin_status())
-        d.addCallback(lambda active: self.device.set_property(CRD_INTFACE,
-                                        'PinEnabled', dbus.Boolean(active)))
-        d.addCallback(lambda _: self.get_imei())
-        d.addCallback(lambda imei: self.device.set_property(MDM_INTFACE,
-                                        'EquipmentIdentifier', imei))
-        d.addCallback(lambda _: self.get_iccid())
-
         def iccid_eb(failure):
             failure.trap(E.General)
-            self.device.set_property(CRD_INTFACE, 'SimIdentifier', ''),
+            return ''
+
+        # the queries are independent, they are queued together. Only
+        # get_pin_status could be sent in a compound command, so they
+        # are not collected in one
+        d = defer.gatherResults([self.get_bands(), self.get_network_modes(),
+                                 self.get_pin_status(), self.get_imei(),
+                                 self.get_iccid().addErrback(iccid_eb)],
+                                consumeErrors=True)
+
+        def set_properties((bands, modes, active, imei, iccid)):
+            self.device.set_property(CRD_INTFACE,
+                                     'SupportedBands', dbus.UInt32(bands))
+            self.device.set_property(CRD_INTFACE,
+                                     'SupportedModes', dbus.UInt32(modes))
+            self.device.set_property(CRD_INTFACE,
+                                     'PinEnabled', dbus.Boolean(active))
+            self.device.set_property(MDM_INTFACE,
+                                     'EquipmentIdentifier', imei)
+            self.device.set_property(CRD_INTFACE, 'SimIdentifier', iccid)
+
+        # the callers expect the failure of the query, not a FirstError
+        d.addCallbacks(set_properties,
+                       lambda failure: failure.value.subFailure)
+        return d
+
+    def _get_sim_identity(self):
+        # (IMEI, ICCID), the ICCID is None without a readable SIM
+        d = defer.gatherResults([self.get_imei(),
+                                 self.get_iccid().addErrback(lambda _: None)])
+        return d
+
+    def load_capabilities(self):
+        """
+        Loads the stored capabilities of the device and its SIM
+
+        The ICCID is read again so the properties of a swapped SIM are
+        not used.
+        """
+        self.cache.invalidate('iccid')
+
+        def seed((imei, iccid)):
+            names = self.capabilities.seed(self.cache, imei, iccid)
+            if names:
+                log.msg("using the stored %s" % ', '.join(names))
+
+        d = self._get_sim_identity()
+        d.addCallbacks(seed, log.err)
+        return d
 
-        d.addCallbacks(lambda iccid:
-                self.device.set_property(CRD_INTFACE,
-                                        'SimIdentifier', iccid), iccid_eb)
+    def save_capabilities(self, resp=None):
+        """Stores the capabilities of the device and its SIM"""
+        d = self._get_sim_identity()
+        d.addCallbacks(lambda (imei, iccid):
+                        self.capabilities.record(self.cache, imei, iccid),
+                       log.err)
+        d.addCallback(lambda _: resp)
         return d
 
     def get_simple_status(self):
@@ -1238,11 +1337,16 @@ class WCDMAWrapper(WCDMAProtocol):
                         band=band,
                         network_mode=net_mode)
 
-        deferred_list = []
-        deferred_list.append(self.get_signal_quality())
-        deferred_list.append(self.get_netreg_info())
-        deferred_list.append(self.get_band())
-        deferred_list.append(self.get_network_mode())
+        # send the queries as a compound command where possible
+        self.begin_compound()
+        try:
+            deferred_list = []
+            deferred_list.append(self.get_signal_quality())
+            deferred_list.append(self.get_netreg_info())
+            deferred_list.append(self.get_band())
+            deferred_list.append(self.get_network_mode())
+        finally:
+            self.end_compound()
 
         d = defer.gatherResults(deferred_list)
         d.addCallback(get_simple_status_cb)
@@ -1309,21 +1413,36 @@ class WCDMAWrapper(WCDMAProtocol):
 
         self.device.set_status(MM_MODEM_STATE_CONNECTING)
 
-        # open the data port
-        port = self.device.ports.dport
-        # this will raise a SerialException if port is busy
-        port.obj = serial.Serial(port.path)
-        port.obj.flush()
-        # send ATDT and convert number to string as pyserial does
-        # not like to write unicode to serial ports
-        number = settings.get('number')
-        d = defer.maybeDeferred(port.obj.write,
-                                "ATDT%s\r\n" % str(number))
+        def open_port(_):
+            port = self.device.ports.dport
+            # this will raise a SerialException if port is busy
+            port.obj = serial.Serial(port.path)
+            port.obj.flush()
+            # send ATDT and convert number to string as pyserial does
+            # not like to write unicode to serial ports
+            number = settings.get('number')
+            return port.obj.write("ATDT%s\r\n" % str(number))
+
+        d = self.release_data_port()
+        d.addCallback(open_port)
 
         # we should detect error or success here and set state
 
         return d
 
+    def release_data_port(self):
+        """
+        Closes the channel the pool might have open on the data port
+
+        It must be called before dialing on the data port.
+
+        :return: Deferred callbacked once the data port is closed
+        """
+        if self.pool is None:
+            return defer.succeed(True)
+
+        return self.pool.collapse()
+
     def disconnect_from_internet(self):
         """Disconnects the modem"""
         ip_method = self.device.get_property(MDM_INTFACE, 'IpMethod')
@@ -1354,6 +1473,11 @@ class WCDMAWrapper(WCDMAProtocol):
 
         self.device.set_status(MM_MODEM_STATE_DISCONNECTING)
 
+        mux = getattr(self.device, 'mux', None)
+        if mux is not None:
+            # the data port is a pty, the DTR is dropped through the mux
+            mux.hangup(DATA_DLCI)
+
         # XXX: should check that we did stop the connection and set status
 
         def restore_speed(speed):
@@ -1520,6 +1644,7 @@ class WCDMAWrapper(WCDMAProtocol):
             d.addErrback(set_status)
             d.addCallback(self.device.initialize)
             d.addCallback(setdefaults)
+            d.addCallback(self.save_capabilities)
             d.addCallback(signals)
             return d
 
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""In-memory mirror of the SIM phonebook"""
+
+from twisted.internet import defer
+from twisted.python import log
+from twisted.python.failure import Failure
+
+import wader.common.aterrors as E
+
+# The values of the slots in :attr:`Phonebook.slots`
+FREE, USED = 0, 1
+
+
+class Phonebook(object):
+    """
+    I mirror the SIM phonebook of a device
+
+    The contacts are listed once and then served from memory. The slots
+    in use are tracked in a bitmap, one byte per slot, so a free one is
+    found without listing the phonebook again. Writes go through to the
+    SIM with the contact methods of ``sconn`` and only change the mirror
+    once they succeed.
+    """
+
+    def __init__(self, sconn):
+        super(Phonebook, self).__init__()
+        self.sconn = sconn
+        self.size = 0
+        # {index: Contact}
+        self.contacts = {}
+        # slots[i] is USED if slot i is taken, there is no slot 0
+        self.slots = bytearray()
+        self.loaded = False
+        # deferreds waiting for the load in progress
+        self.waiting = []
+
+    def load(self):
+        """
+        Loads the phonebook of the SIM
+
+        :return: Deferred callbacked once it is loaded
+        """
+        self.loaded = False
+        return self._when_loaded(lambda: len(self.contacts))
+
+    def _load(self):
+
+        def list_contacts(size):
+            self.size = size
+            if getattr(self.sconn.device, 'sim', None) is not None:
+                self.sconn.device.sim.size = size
+            return self.sconn.list_contacts()
+
+        def list_contacts_cb(contacts):
+            self.contacts = {}
+            self.slots = bytearray(self.size + 1)
+            for contact in contacts:
+                self._store(contact)
+
+            self.loaded = True
+            log.msg("phonebook: %d of %d slots in use" %
+                        (len(self.contacts), self.size))
+
+        def fire_waiters(result):
+            # a failed load is tried again on next use
+            for waiter in self.waiting[:]:
+                self.waiting.remove(waiter)
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(None)
+
+        d = self.sconn.get_phonebook_size()
+        d.addCallback(list_contacts)
+        d.addCallback(list_contacts_cb)
+        d.addBoth(fire_waiters)
+
+    def _when_loaded(self, f, *args):
+        """Returns a deferred with ``f(*args)`` once I am loaded"""
+        if self.loaded:
+            return defer.maybeDeferred(f, *args)
+
+        d = defer.Deferred()
+        d.addCallback(lambda _: f(*args))
+        self.waiting.append(d)
+        if len(self.waiting) == 1:
+            self._load()
+        return d
+
+    def _store(self, contact):
+        self.contacts[contact.index] = contact
+        if 0 < contact.index < len(self.slots):
+            self.slots[contact.index] = USED
+
+    def _release(self, index):
+        self.contacts.pop(index, None)
+        if 0 < index < len(self.slots):
+            self.slots[index] = FREE
+
+    def get_free_index(self):
+        """Returns the first free slot or None if the phonebook is full"""
+        index = self.slots.find(chr(FREE), 1)
+        return index if index != -1 else None
+
+    def list_contacts(self):
+        """Returns all the contacts sorted by index"""
+        return self._when_loaded(
+                lambda: [self.contacts[i] for i in sorted(self.contacts)])
+
+    def get_contact(self, index):
+        """Returns the contact at ``index``"""
+
+        def get_contact():
+            try:
+                return self.contacts[index]
+            except KeyError:
+                raise E.NotFound("No contact at index %d" % index)
+
+        return self._when_loaded(get_contact)
+
+    def get_count(self):
+        """Returns the number of contacts"""
+        return self._when_loaded(lambda: len(self.contacts))
+
+    def find_contacts(self, pattern):
+        """Returns the contacts whose name starts with ``pattern``"""
+        pattern = pattern.lower()
+        return self._when_loaded(lambda:
+                [self.contacts[i] for i in sorted(self.contacts)
+                    if self.contacts[i].name.lower().startswith(pattern)])
+
+    def find_contacts_by_number(self, number):
+        """Returns the contacts whose number ends with ``number``"""
+        return self._when_loaded(lambda:
+                [self.contacts[i] for i in sorted(self.contacts)
+                    if self.contacts[i].number.endswith(number)])
+
+    def add_contact(self, contact):
+        """
+        Writes ``contact`` to its index or to the first free slot
+
+        The index of ``contact`` is set to the slot used.
+
+        :return: The index of the contact
+        """
+
+        def add_contact():
+            index = contact.index
+            if not index:
+                index = self.get_free_index()
+                if index is None:
+                    raise E.MemoryFull("The phonebook is full")
+
+            contact.index = index
+            # taken right away so concurrent adds use other slots
+            was_used = index in self.contacts
+            if 0 < index < len(self.slots):
+                self.slots[index] = USED
+
+            def add_contact_cb(_):
+                self._store(contact)
+                return index
+
+            def add_contact_eb(failure):
+                if not was_used:
+                    self._release(index)
+                return failure
+
+            d = self.sconn.add_contact(contact)
+            d.addCallbacks(add_contact_cb, add_contact_eb)
+            return d
+
+        return self._when_loaded(add_contact)
+
+    def delete_contact(self, index):
+        """Deletes the contact at ``index``"""
+
+        def delete_contact():
+            d = self.sconn.delete_contact(index)
+            d.addCallback(lambda result: self._release(index) or result)
+            return d
+
+        return self._when_loaded(delete_contact)
@@ -38,6 +38,8 @@ import wader.common.exceptions as ex
 import wader.common.interfaces as interfaces
 from wader.common.utils import flatten_list
 
+from core.channels import ChannelPool
+from core.cmux import stop_multiplexer
 from core.daemon import build_daemon_collection
 from core.sim import SIMBaseClass
 import plugins
@@ -88,6 +90,8 @@ class DevicePlugin(object):
         self.props = {MDM_INTFACE: {}, HSO_INTFACE: {}, CRD_INTFACE: {},
                       NET_INTFACE: {}, USD_INTFACE: {}}
         self.ports = None
+        # 27.010 multiplexer of single port devices with the cmux quirk
+        self.mux = None
 
     def __repr__(self):
         args = (self.__class__.__name__, self.ports)
@@ -130,6 +134,9 @@ class DevicePlugin(object):
 
         self._status = status
 
+        if self.sconn is not None and self.sconn.pool is not None:
+            self.sconn.pool.on_status(status)
+
     @property
     def status(self):
         """Returns the internal device status"""
@@ -161,6 +168,9 @@ class DevicePlugin(object):
             if self.sconn is not None and self.sconn.transport:
                 self.sconn.transport.unregisterProducer()
 
+            if self.mux is not None:
+                stop_multiplexer(self)
+
             if self.ports.cport.obj is not None:
                 self.ports.cport.obj.loseConnection("Bye!")
                 self.ports.cport.obj = None
@@ -198,7 +208,22 @@ class DevicePlugin(object):
                 return _
 
             d.addCallback(set_enable)
+
+            def start_pool(_):
+                if self.sconn.pool is None:
+                    self.sconn.pool = ChannelPool(self, self.sconn)
+                    self.sconn.pool.on_status(self._status)
+                return _
+
+            d.addCallback(start_pool)
             d.addCallback(lambda _: self.sconn.mal.initialize(obj=self.sconn))
+
+            def load_phonebook(_):
+                # in the background, it is not needed to be enabled
+                self.sconn.phonebook.load().addErrback(log.err)
+                return _
+
+            d.addCallback(load_phonebook)
             d.addCallback(lambda _: size)
             return d
 
@@ -223,6 +248,7 @@ class DevicePlugin(object):
                 return defer.fail(at.SerialSendFailed())
             log.msg('Enabling radio and initialising SIM')
             d = self.sconn.enable_radio(True)
+            d.addCallback(lambda _: self.sconn.load_capabilities())
             d.addCallback(initialize_sim)
             d.addErrback(log.err)
             return d
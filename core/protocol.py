@@ -19,6 +19,7 @@
 """Twisted protocols for serial communication"""
 
 import re
+from time import time
 
 from twisted.internet import protocol, defer, reactor
 from twisted.python.failure import Failure
@@ -27,7 +28,11 @@ from twisted.python import log
 import wader.common.aterrors as E
 import wader.common.signals as S
 
-from core.command import ATCmd
+from core.command import (ATCmd, CompoundATCmd, PRIORITIES, READ_ONLY_CMDS,
+                          COMPOUND_CMDS, OK_REGEXP, PRIORITY_INTERACTIVE)
+from core.stats import CommandStats
+from core.timeouts import TimeoutPolicy
+from core.watchdog import Watchdog
 
 # Standard unsolicited notifications
 CALL_RECV = re.compile('\r\nRING\r\n')
@@ -35,9 +40,345 @@ STK_DEBUG = re.compile('\r\n\+STC:\s\d+\r\n')
 # Standard solicited notifications
 SMS_RECEIVED = re.compile('\r\n\+CMTI:\s"(?P<where>\w{2,})",(?P<id>\d+)\r\n')
 SMS_DELIVERY = re.compile('\r\n\+CDS:\s\d+\r\n(?P<pdu>[A-Za-z0-9]+)\r\n')
+SMS_DIRECT = re.compile('\r\n\+CMT:\s[^\r]*,\d+\r\n(?P<pdu>[A-Za-z0-9]+)\r\n')
 
 SPLIT_PROMPT = re.compile('\r?\r\n>\s$')
 CREG_REGEXP = re.compile('\r\n\+CREG:\s*(?P<status>\d)\r\n')
+LINE_END = re.compile('\r\n')
+
+# Standard notifications known by every device, the token is the text that
+# follows the leading line terminator of the notification
+STANDARD_NOTIFICATIONS = [
+    # (kind, token, regexp)
+    ('sms_received', '+CMTI', SMS_RECEIVED),
+    ('sms_delivery', '+CDS', SMS_DELIVERY),
+    ('sms_direct', '+CMT', SMS_DIRECT),
+    ('stk_debug', '+STC', STK_DEBUG),
+    ('creg', '+CREG', CREG_REGEXP),
+    ('call', 'RING', CALL_RECV),
+]
+
+# Number of commands that can overtake a waiting command of a lower priority
+# class before it is served anyway
+MAX_OVERTAKES = 4
+
+# Size of the consumed prefix of the idle buffer past which it is compacted
+BUFFER_COMPACT_THRESHOLD = 4096
+
+# Number of line terminators that the end of response and error regexps
+# are rescanned from, the longest end regexp we have spans three of them:
+# '(\r\n)?\r\n(OK)\r\n'
+RESPONSE_LOOKBACK = 3
+
+
+def rewind_lines(_buffer, pos, lines=RESPONSE_LOOKBACK):
+    """
+    Returns the offset of the ``lines``-th line terminator before ``pos``
+
+    If ``_buffer`` does not contain that many line terminators it returns 0
+    """
+    for i in range(lines):
+        pos = _buffer.rfind('\r\n', 0, pos)
+        if pos <= 0:
+            return 0
+
+    return pos
+
+
+class NotificationDispatcher(object):
+    """
+    I recognise and dispatch unsolicited notifications in a single pass
+
+    I merge the standard notifications and the keys of a customizer's
+    ``signal_translations`` in a dispatch table and a scanner regexp that
+    is anchored at line starts. Every notification found by the scanner is
+    matched against its own regexp, handed to the handler registered for
+    its kind and consumed from the buffer, all in one pass.
+
+    Use :func:`get_notification_dispatcher` rather than instantiating me
+    """
+
+    def __init__(self, async_regexp=None, signal_translations=None):
+        super(NotificationDispatcher, self).__init__()
+        self.table = {}
+        if async_regexp is not None and signal_translations:
+            for name in signal_translations:
+                self.table[name] = ('signal', async_regexp)
+
+        for kind, token, regexp in STANDARD_NOTIFICATIONS:
+            # the device's own translations take precedence
+            self.table.setdefault(token, (kind, regexp))
+
+        # longest tokens first so no token shadows another one
+        tokens = sorted(self.table, key=len, reverse=True)
+        self.scanner = re.compile('\r\n(%s)' % '|'.join(map(re.escape,
+                                                             tokens)))
+
+    def dispatch(self, _buffer, handlers):
+        """
+        Dispatches the notifications in ``_buffer`` to ``handlers``
+
+        ``_buffer`` can be a `str` or a `buffer` of the protocol's buffer
+
+        :param handlers: dict mapping a notification kind to a callable that
+                         receives the match and returns True if the
+                         notification should be consumed. Kinds without a
+                         handler are left in the buffer.
+        :return: ``_buffer`` without the consumed notifications
+        """
+        kept = []
+        last = 0
+        for hit in self.scanner.finditer(_buffer):
+            start = hit.start()
+            if start < last:
+                continue
+
+            kind, regexp = self.table[hit.group(1)]
+            handler = handlers.get(kind)
+            if handler is None:
+                continue
+
+            if kind == 'signal':
+                # device regexps are not necessarily anchored at the line
+                # start, look for them in the notification line only
+                match = LINE_END.search(_buffer, hit.end())
+                end = match.end() if match else len(_buffer)
+                match = regexp.search(_buffer, start, end)
+            else:
+                match = regexp.match(_buffer, start)
+
+            if match is None or match.start() < last or not handler(match):
+                continue
+
+            kept.append(_buffer[last:match.start()])
+            last = match.end()
+
+        if not kept:
+            return _buffer
+
+        kept.append(_buffer[last:])
+        return ''.join(kept)
+
+
+def get_notification_dispatcher(custom):
+    """
+    Returns the :class:`NotificationDispatcher` for customizer ``custom``
+
+    The dispatcher is only built once per customizer class
+    """
+    klass = custom.__class__
+    dispatcher = klass.__dict__.get('_notification_dispatcher')
+    if dispatcher is None:
+        dispatcher = NotificationDispatcher(custom.async_regexp,
+                                            custom.signal_translations)
+        klass._notification_dispatcher = dispatcher
+
+    return dispatcher
+
+
+class ResponseParser(object):
+    """
+    I incrementally parse the response to an :class:`~core.command.ATCmd`
+
+    Data is fed to me as it arrives and I remember how far I have scanned
+    so that the response is not rescanned from the beginning on every
+    chunk. The buffer is divided at its last line terminator: everything
+    before it is made of complete lines that have already been checked for
+    unsolicited notifications, and the ``extract`` matches found in them
+    are collected as soon as they complete. The last complete line is
+    checked again with the next chunk, as it might be the header of a
+    multi-line notification such as ``+CMT``. The end of response and
+    error regexps are only searched in the last few lines.
+    """
+
+    def __init__(self, cmdinfo, process_notifications=None):
+        super(ResponseParser, self).__init__()
+        self.extract = cmdinfo['extract']
+        self.end = cmdinfo['end']
+        self.process_notifications = process_notifications
+        # the response only grows while it is parsed, the regexps are run
+        # on a buffer() of it so no copies are made. It is never modified
+        # in place as the extract matches are sliced from it lazily
+        self.buf = bytearray()
+        # offset of the last line terminator in buf
+        self.line_pos = 0
+        # offset where the next notifications scan will start
+        self.notify_pos = 0
+        # offset where the next extract scan will start
+        self.extract_pos = 0
+        # offset where the next end of response/error scan will start
+        self.tail_pos = 0
+        # extract matches found so far
+        self.matches = []
+
+    def feed(self, data):
+        """Appends ``data`` to the buffer and scans it"""
+        if self.process_notifications is not None:
+            pending = str(self.buf[self.notify_pos:]) + data
+            tail = self.process_notifications(pending)
+        else:
+            pending = tail = data
+
+        if tail is pending:
+            self.buf.extend(data)
+        else:
+            # a notification was consumed, the tail has been rewritten
+            buf = self.buf[:self.notify_pos]
+            buf.extend(tail)
+            self.buf = buf
+            self.line_pos = min(self.line_pos, self.notify_pos)
+            self.extract_pos = min(self.extract_pos, self.notify_pos)
+
+        last = self.buf.rfind('\r\n', self.line_pos)
+        if last == -1:
+            return
+
+        self.line_pos = last
+        if self.extract:
+            # only complete lines are scanned for matches
+            self._scan_extract(last + 2)
+
+        # the last complete line is scanned again unless it is part of
+        # the response already extracted
+        self.notify_pos = max(rewind_lines(self.buf, last, 1),
+                              min(self.extract_pos, last))
+
+    def _scan_extract(self, endpos):
+        for match in self.extract.finditer(buffer(self.buf), self.extract_pos,
+                                           endpos):
+            self.matches.append(match)
+            self.extract_pos = match.end()
+
+    def search_end(self):
+        """Returns the end of response match or None"""
+        return self.end.search(buffer(self.buf), self.tail_pos)
+
+    def search_error(self):
+        """
+        Returns the AT error found in the response or None
+
+        See :func:`~wader.common.aterrors.extract_error`
+        """
+        return E.extract_error(buffer(self.buf), self.tail_pos)
+
+    def advance(self):
+        """Marks the buffer as scanned for the end of response and errors"""
+        self.tail_pos = rewind_lines(self.buf, len(self.buf))
+
+    def get_response(self):
+        """Returns all the extract matches in the response"""
+        self._scan_extract(len(self.buf))
+        return self.matches
+
+    def getvalue(self):
+        """Returns the response as a `str`"""
+        return str(self.buf)
+
+
+class PriorityCommandQueue(object):
+    """
+    I am a :class:`~twisted.internet.defer.DeferredQueue` with priority lanes
+
+    Every :class:`~core.command.ATCmd` is put in the lane of its priority
+    class and :meth:`get` always serves the highest priority lane first.
+    To protect the lower classes from starvation, a waiting command is
+    served anyway once ``max_overtakes`` commands have overtaken it.
+    The commands put with :meth:`put_first` go before all of them.
+    """
+
+    def __init__(self, max_overtakes=MAX_OVERTAKES):
+        super(PriorityCommandQueue, self).__init__()
+        self.max_overtakes = max_overtakes
+        self.lanes = dict((priority, []) for priority in PRIORITIES)
+        self.overtakes = dict((priority, 0) for priority in PRIORITIES)
+        # commands that can not wait for any other queued one
+        self.urgent = []
+        self.waiting = []
+
+    def __len__(self):
+        return len(self.urgent) + sum(map(len, self.lanes.values()))
+
+    def put(self, cmd):
+        """Puts ``cmd`` in the lane of its priority class"""
+        if self.waiting:
+            self.waiting.pop(0).callback(cmd)
+        else:
+            self.lanes.setdefault(cmd.priority, []).append(cmd)
+            self.overtakes.setdefault(cmd.priority, 0)
+
+    def put_first(self, cmd):
+        """Puts ``cmd`` ahead of every queued command"""
+        if self.waiting:
+            self.waiting.pop(0).callback(cmd)
+        else:
+            self.urgent.append(cmd)
+
+    def get(self):
+        """
+        Returns a `Deferred` that will be callbacked with the next command
+
+        :rtype: `Deferred`
+        """
+        if len(self):
+            return defer.succeed(self._pop())
+
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def _pop(self):
+        if self.urgent:
+            return self.urgent.pop(0)
+
+        busy = sorted(p for p in self.lanes if self.lanes[p])
+        # the lowest class whose head has been overtaken too many times
+        # goes first, otherwise the highest class does
+        starved = [p for p in busy if self.overtakes[p] >= self.max_overtakes]
+        priority = starved[-1] if starved else busy[0]
+
+        self.overtakes[priority] = 0
+        for p in busy:
+            if p > priority:
+                self.overtakes[p] += 1
+
+        return self.lanes[priority].pop(0)
+
+    def remove(self, cmd):
+        """Removes ``cmd``, returns True if it was queued"""
+        if cmd in self.urgent:
+            self.urgent.remove(cmd)
+            return True
+
+        lane = self.lanes.get(cmd.priority, [])
+        if cmd not in lane:
+            return False
+
+        lane.remove(cmd)
+        return True
+
+    def drain(self):
+        """Removes and returns the queued commands in the order I serve them"""
+        cmds = []
+        while len(self):
+            cmds.append(self._pop())
+        return cmds
+
+    def promote(self, cmd, priority):
+        """
+        Moves the queued ``cmd`` to the lane of ``priority`` if higher
+
+        Returns True if ``cmd`` was still queued
+        """
+        lane = self.lanes.get(cmd.priority, [])
+        if cmd not in lane:
+            return False
+
+        if priority < cmd.priority:
+            lane.remove(cmd)
+            cmd.priority = priority
+            self.put(cmd)
+
+        return True
 
 
 class BufferingStateMachine(object, protocol.Protocol):
@@ -52,8 +393,44 @@ class BufferingStateMachine(object, protocol.Protocol):
         self.cmd = None
         self.state = 'idle'
         # idle and wait buffers
-        self.idlebuf = ""
-        self.waitbuf = ""
+        self.idlebuf = bytearray()
+        self.waitbuf = bytearray()
+        # offset in idlebuf where the next notifications scan will start
+        self.idle_pos = 0
+        # response parser for the current AT command
+        self.parser = None
+        # latency statistics of the commands
+        self.stats = CommandStats()
+        # timeouts learned from the latency of the commands
+        self.timeouts = TimeoutPolicy(getattr(device, 'name', None))
+        # TrafficCapture recording the traffic and index of our port in it
+        self.capture = None
+        self.capture_port = None
+        # whether the SMS routed to us must be acknowledged with AT+CNMA
+        self.sms_ack = False
+        # unsolicited notifications dispatcher and handlers
+        if self.custom is not None:
+            self.dispatcher = get_notification_dispatcher(self.custom)
+        else:
+            self.dispatcher = NotificationDispatcher()
+
+        self.idle_handlers = {
+            'signal': self.process_signal_notification,
+            'sms_received': self.process_notification_sms_received,
+            'sms_delivery': self.process_notification_sms_delivery,
+            'sms_direct': self.process_notification_sms_direct,
+            'stk_debug': lambda match: True,
+            'creg': self.process_notification_creg_received,
+            'call': self.process_notification_call_received,
+        }
+        # the rest are left as part of the response
+        self.waiting_handlers = {
+            'signal': self.process_signal_notification,
+            'sms_received': self.process_notification_sms_received,
+            'sms_delivery': self.process_notification_sms_delivery,
+            'sms_direct': self.process_notification_sms_direct,
+            'creg': self.process_notification_creg_received,
+        }
         # log prefix for situations where the prefix is not appended
         self._prefix = ""
 
@@ -69,6 +446,8 @@ class BufferingStateMachine(object, protocol.Protocol):
 
     def _timeout_eb(self):
         """Executed when a command exceeds its timeout"""
+        self.stats.on_timeout(self.cmd)
+        self.timeouts.on_timeout(self.cmd, self.cmd.timeout)
         msg = "Command '%r' timed out, this is my waitbuf: %s"
         e = E.SerialResponseTimeout(msg % (self.cmd, self.waitbuf))
         self.notify_failure(e)
@@ -86,6 +465,13 @@ class BufferingStateMachine(object, protocol.Protocol):
         Notify success to current :class:`~core.command.ATCmd`
         """
         self.cancel_current_delayed_call()
+        self.cmd.completed_at = time()
+        self.stats.on_completed(self.cmd)
+        self.timeouts.on_completed(self.cmd)
+        if self.cmd.deferred.called:
+            # cancelled while it was executing
+            return
+
         try:
             self.cmd.deferred.callback(result)
         except Exception, e:
@@ -94,8 +480,13 @@ class BufferingStateMachine(object, protocol.Protocol):
 
     def notify_failure(self, failure):
         """Notify failure to current :class:`~core.command.ATCmd`"""
+        if not isinstance(failure, Failure):
+            failure = Failure(failure)
         self.cancel_current_delayed_call()
-        self.cmd.deferred.errback(failure)
+        self.cmd.completed_at = time()
+        self.stats.on_completed(self.cmd, failed=True)
+        if not self.cmd.deferred.called:
+            self.cmd.deferred.errback(failure)
 
     def set_cmd(self, cmd):
         """
@@ -105,6 +496,7 @@ class BufferingStateMachine(object, protocol.Protocol):
         """
         self.cmd = cmd
         # set the timeout for this command
+        cmd.timeout = self.timeouts.get_timeout(cmd)
         self.cmd.call_id = reactor.callLater(cmd.timeout, self._timeout_eb)
         self.set_state('waiting')
 
@@ -120,8 +512,10 @@ class BufferingStateMachine(object, protocol.Protocol):
         """Transitions to idle state and cleans internal buffers"""
         self.cmd = None
         self.set_state('idle')
-        self.idlebuf = ""
-        self.waitbuf = ""
+        self.idlebuf = bytearray()
+        self.waitbuf = bytearray()
+        self.idle_pos = 0
+        self.parser = None
 
     def send_splitcmd(self):
         """
@@ -129,6 +523,21 @@ class BufferingStateMachine(object, protocol.Protocol):
         """
         raise NotImplementedError()
 
+    def start_capture(self, capture, port):
+        """
+        Records the traffic of ``port`` in ``capture``
+
+        :type capture: :class:`~core.capture.TrafficCapture`
+        """
+        self.capture_port = capture.add_port(port)
+        self.capture = capture
+
+    def stop_capture(self):
+        """Stops recording the traffic and closes the capture"""
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+
     def emit_signal(self, signal, *args, **kwds):
         """
         Emits ``signal``
@@ -147,80 +556,105 @@ class BufferingStateMachine(object, protocol.Protocol):
         super(BufferingStateMachine, self).connectionLost(reason)
         log.msg("Serial connection was lost")
         self.transport = None
+        self.stop_capture()
 
     def dataReceived(self, data):
         """See `twisted.internet.protocol.Protocol.dataReceived`"""
-        # XXX: Change the following zero to one to log all data from the modem
-        if 0:
-            log.msg('dataReceived: %s' % str(data))
+        if self.capture is not None:
+            self.capture.rx(self.capture_port, data)
+        if self.cmd is not None and self.cmd.first_byte_at is None:
+            self.cmd.first_byte_at = time()
         state = 'handle_%s' % self.state
         getattr(self, state)(data)
 
-    def process_notifications(self, _buffer):
+    def process_signal_notification(self, match):
         """
-        Processes unsolicited notifications in ``_buffer``
+        Processes the device's own unsolicited notification in ``match``
 
-        :param _buffer: Buffer to scan
+        Returns True if the notification is known to the device
         """
-        if not self.device.custom or not self.device.custom.async_regexp:
-            return _buffer
-
-        custom = self.device.custom
-        # we have to use re.finditer as some cards like to pipeline
-        # several asynchronous notifications in one
-        for match in re.finditer(custom.async_regexp, _buffer):
-            name, value = match.groups()
-            if name in custom.signal_translations:
-                # we obtain the signal name and the associated function
-                # that will translate the device unsolicited message to
-                # the signal used in Wader internally
-                signal, func = custom.signal_translations[name]
-
-                # if we have a transform function defined, then use it
-                # otherwise use value as args
-                if func:
-                    try:
-                        args = func(value, self.device)
-                    except Exception, e:
-                        msg = "%s can not handle notification %s"
-                        log.err(e, msg % (func, value))
-                        args = value
-
-                    if signal is not None:
-                        self.emit_signal(signal, args)
-
-                # remove from the idlebuf the match (but only once please)
-                _buffer = _buffer.replace(match.group(), '', 1)
-
-        return _buffer
-
-    def process_notification_sms_received(self, _buffer):
-        while True:
-            match = SMS_RECEIVED.match(_buffer)
-            if not match:
-                break
-
-            mal = getattr(self, 'mal', None)
-            if mal:
-                index = int(match.group('id'))
-                mal.on_sms_notification(index)
-
-            _buffer = _buffer.replace(match.group(), '', 1)
+        custom = self.custom
+        name, value = match.groups()
+        if name not in custom.signal_translations:
+            return False
+
+        # we obtain the signal name and the associated function
+        # that will translate the device unsolicited message to
+        # the signal used in Wader internally
+        signal, func = custom.signal_translations[name]
+
+        # if we have a transform function defined, then use it
+        # otherwise use value as args
+        if func:
+            try:
+                args = func(value, self.device)
+            except Exception, e:
+                msg = "%s can not handle notification %s"
+                log.err(e, msg % (func, value))
+                args = value
+
+            if signal is not None:
+                self.emit_signal(signal, args)
+
+        return True
+
+    def process_notification_sms_received(self, match):
+        mal = getattr(self, 'mal', None)
+        if mal:
+            index = int(match.group('id'))
+            mal.on_sms_notification(index)
+
+        return True
+
+    def process_notification_sms_delivery(self, match):
+        mal = getattr(self, 'mal', None)
+        if mal:
+            pdu = match.group('pdu')
+            mal.on_sms_delivery_report(pdu)
+
+        if self.sms_ack:
+            self.ack_sms()
+
+        return True
+
+    def process_notification_sms_direct(self, match):
+        mal = getattr(self, 'mal', None)
+        if mal:
+            pdu = match.group('pdu')
+            mal.on_sms_direct(pdu)
+
+        if self.sms_ack:
+            self.ack_sms()
+
+        return True
+
+    def ack_sms(self):
+        """Acknowledges the last SMS or status report routed to us"""
+        raise NotImplementedError()
 
-        return _buffer
+    def process_notification_creg_received(self, match):
+        status = int(match.group('status'))
+        self.emit_signal(S.SIG_CREG, status)
+        return True
 
-    def process_notification_creg_received(self, _buffer):
-        while True:
-            match = CREG_REGEXP.match(_buffer)
-            if not match:
-                break
+    def process_notification_call_received(self, match):
+        self.emit_signal(S.SIG_CALL)
+        return True
 
-            status = int(match.group('status'))
-            self.emit_signal(S.SIG_CREG, status)
+    def process_notifications(self, _buffer):
+        """
+        Processes unsolicited notifications in ``_buffer``
 
-            _buffer = _buffer.replace(match.group(), '', 1)
+        :param _buffer: Buffer to scan
+        """
+        return self.dispatcher.dispatch(_buffer, self.idle_handlers)
 
-        return _buffer
+    def process_waiting_notifications(self, _buffer):
+        """
+        Processes the unsolicited notifications that might arrive while
+        we are waiting for a response
+        """
+        return self.dispatcher.dispatch(_buffer, self.waiting_handlers)
 
     def handle_idle(self, data):
         """
@@ -232,121 +666,72 @@ class BufferingStateMachine(object, protocol.Protocol):
         - STK init garbage
         - Call received (we're not handling it in waiting)
         - A SMS arrived
-        - SMS notification (Not handled yet)
+        - SMS delivery report
         - Device's own unsolicited notifications
         - Default: i.e. this device originated a notification that we don't
           understand yet, the point is to log it and make it visible so the
           user can report it to us
+
+        All of them are recognised and consumed in a single pass by the
+        device's :class:`NotificationDispatcher`
         """
         log.msg("idle: %r" % data)
-        self.idlebuf += data
-
-        # most possible event:
-        # device's own unsolicited notifications
-        # signal translations stuff
-        self.idlebuf = self.process_notifications(self.idlebuf)
-        if not self.idlebuf:
-            return
-
-        # second most possible event:
-        # new SMS arrived
-        self.idlebuf = self.process_notification_sms_received(self.idlebuf)
-        if not self.idlebuf:
-            return
+        self.idlebuf.extend(data)
 
-        # third most possible event:
-        # SMS delivery report
-        match = SMS_DELIVERY.match(self.idlebuf)
-        if match:
-            mal = getattr(self, 'mal', None)
-            if mal:
-                pdu = match.group('pdu')
-                mal.on_sms_delivery_report(pdu)
-
-            # the report might be repeated, consume as many as possible
-            # idle: unmatched data '\r\n+CDS: 27\r\n07914306073011F006C
-            # 00B914306565711F90120910134454001209101344540000100\r\n\r
-            # \n+CDS: 27\r\n07914306073011F006C10B914306565711F90120910
-            # 144454001209101444540000100\r\n'
-            self.idlebuf = self.idlebuf.replace(match.group(), '')
-            if not self.idlebuf:
-                return
-
-        # fourth most possible event
-        match = STK_DEBUG.match(self.idlebuf)
-        if match:
-            self.idlebuf = self.idlebuf.replace(match.group(), '')
-            if not self.idlebuf:
-                return
+        pending = buffer(self.idlebuf, self.idle_pos)
+        tail = self.process_notifications(pending)
+        if tail is not pending:
+            self.idlebuf[self.idle_pos:] = tail
 
-        # fifth most possible event
-        self.idlebuf = self.process_notification_creg_received(self.idlebuf)
-        if not self.idlebuf:
+        if len(self.idlebuf) == self.idle_pos:
+            del self.idlebuf[:]
+            self.idle_pos = 0
             return
 
-        # sixth most possible event:
-        match = CALL_RECV.match(self.idlebuf)
-        if match:
-            self.emit_signal(S.SIG_CALL)
-
-            self.idlebuf = self.idlebuf.replace(match.group(), '')
-            if not self.idlebuf:
-                return
-
-        log.msg("idle: unmatched data %r" % self.idlebuf)
+        log.msg("idle: unmatched data %r" % str(self.idlebuf[self.idle_pos:]))
+        # the last lines might be the start of a notification
+        self.idle_pos = max(self.idle_pos,
+                            rewind_lines(self.idlebuf, len(self.idlebuf)))
+        if self.idle_pos > BUFFER_COMPACT_THRESHOLD:
+            del self.idlebuf[:self.idle_pos]
+            self.idle_pos = 0
 
     def handle_waiting(self, data):
         """Process ``data`` in the wait state"""
-        self.waitbuf += data
-
-        self.waitbuf = self.process_notifications(self.waitbuf)
+        if self.parser is None:
+            try:
+                cmdinfo = self.custom.cmd_dict[self.cmd.name]
+            except KeyError, e:
+                log.err(e, 'command %s not present in my cmd dict' % self.cmd)
+                return self.transition_to_idle()
+
+            self.parser = ResponseParser(cmdinfo,
+                                         self.process_waiting_notifications)
+
+        parser = self.parser
+        parser.feed(data)
+        self.waitbuf = parser.buf
         if not self.waitbuf:
             return
 
-        # new SMS arrived
-        self.waitbuf = self.process_notification_sms_received(self.waitbuf)
-        if not self.waitbuf:
-            return
-
-        # CREG arrived
-        self.waitbuf = self.process_notification_creg_received(self.waitbuf)
-        if not self.waitbuf:
-            return
-
-        try:
-            cmdinfo = self.custom.cmd_dict[self.cmd.name]
-        except KeyError, e:
-            log.err(e, 'command %s not present in my cmd dict' % self.cmd)
-            return self.transition_to_idle()
-
-        match = cmdinfo['end'].search(self.waitbuf)
+        match = parser.search_end()
         if match:  # end of response
-            if cmdinfo['extract']:
+            if parser.extract:
                 # There's an regex to extract info from data
-                response = list(re.finditer(cmdinfo['extract'], self.waitbuf))
+                response = parser.get_response()
                 resp_repr = str([m.groups() for m in response])
                 log.msg("%s: callback = %s" % (self.state, resp_repr))
                 self.notify_success(response)
-
-                # now clean self.waitbuf
-                for _m in response:
-                    self.waitbuf = self.waitbuf.replace(_m.group(), '', 1)
-                # now clean end of command
-                endmatch = cmdinfo['end'].search(self.waitbuf)
-                if endmatch:
-                    self.waitbuf = self.waitbuf.replace(endmatch.group(),
-                                                        '', 1)
             else:
                 # there's no regex in cmdinfo to extract info
                 log.msg("%s: no callback registered" % self.state)
-                self.notify_success(self.waitbuf)
-                self.waitbuf = self.waitbuf.replace(match.group(), '', 1)
+                self.notify_success(parser.getvalue())
 
             self.transition_to_idle()
         else:
             # there is no end of response detected, so we have either an error
             # or a split command (like send_sms, save_sms, etc.)
-            match = E.extract_error(self.waitbuf)
+            match = parser.search_error()
             if match:
                 exception, error, m = match
                 e = exception(error)
@@ -355,15 +740,13 @@ class BufferingStateMachine(object, protocol.Protocol):
                     log.err(e, "waiting")
                 # send the failure back
                 self.notify_failure(f)
-                # remove the exception string from the waitbuf
-                self.waitbuf = self.waitbuf.replace(m.group(), '', 1)
                 self.transition_to_idle()
             else:
+                parser.advance()
                 match = SPLIT_PROMPT.search(data)
                 if match:
                     log.msg("waiting: split command prompt detected")
                     self.send_splitcmd()
-                    self.waitbuf = self.waitbuf.replace(match.group(), '', 1)
                 else:
                     log.msg("waiting: unmatched data %r" % data)
 
@@ -407,10 +790,54 @@ class SerialProtocol(BufferingStateMachine):
 
     def __init__(self, device):
         super(SerialProtocol, self).__init__(device)
-        self.queue = defer.DeferredQueue()
+        self.queue = PriorityCommandQueue()
         self.mutex = defer.DeferredLock()
+        # commands collected to be sent as a compound command
+        self.compound = None
+        # ChannelPool that might send some commands through another port
+        self.pool = None
+        # recovers the device if it stops answering
+        self.watchdog = Watchdog(self)
+        # the executing command aborted to let the urgent ones through
+        self.preempted = None
         self._check_queue()
 
+    def _timeout_eb(self):
+        # the watchdog must fail the queued commands before the next one
+        # is sent
+        self.watchdog.on_timeout()
+        super(SerialProtocol, self)._timeout_eb()
+
+    def notify_success(self, result):
+        self.watchdog.on_response()
+        if self._requeue_preempted():
+            return
+
+        super(SerialProtocol, self).notify_success(result)
+
+    def notify_failure(self, failure):
+        if not isinstance(failure, Failure):
+            failure = Failure(failure)
+        if not failure.check(E.SerialResponseTimeout):
+            # an error response, the device is alive
+            self.watchdog.on_response()
+            if self._requeue_preempted():
+                return
+
+        self.preempted = None
+        super(SerialProtocol, self).notify_failure(failure)
+
+    def _requeue_preempted(self):
+        """Queues the preempted command again, returns True if it was"""
+        cmd, self.preempted = self.preempted, None
+        if cmd is not self.cmd or cmd.deferred.called:
+            return False
+
+        self.cancel_current_delayed_call()
+        # after the urgent commands it was aborted for
+        self.queue.put_first(cmd)
+        return True
+
     def transition_to_idle(self):
         """Transitions to idle state and processes next queued `ATCmd`"""
         super(SerialProtocol, self).transition_to_idle()
@@ -423,11 +850,15 @@ class SerialProtocol(BufferingStateMachine):
         """
         Used to send the second part of a split command after prompt appears
         """
+        if self.capture is not None:
+            self.capture.tx(self.capture_port, self.cmd.splitcmd)
         self.transport.write(self.cmd.splitcmd)
 
     def _process_at_cmd(self, cmd):
 
         def _transition_and_send(_):
+            cmd.acquired_at = time()
+            self.stats.on_queue_depth(len(self.queue))
             self.set_cmd(cmd)
             msg = "%s: sending %r" % (self.state, cmd.cmd)
 
@@ -439,6 +870,9 @@ class SerialProtocol(BufferingStateMachine):
             else:
                 log.msg(msg, system=self._get_log_prefix())
 
+                cmd.written_at = time()
+                if self.capture is not None:
+                    self.capture.tx(self.capture_port, cmd.get_cmd(), cmd.name)
                 self.transport.write(cmd.get_cmd())
 
         d = self.mutex.acquire()
@@ -454,13 +888,152 @@ class SerialProtocol(BufferingStateMachine):
         """
         Queues an :class:`~core.command.ATCmd` ``cmd``
 
+        Commands are served by priority class, interactive commands first,
+        then connection-critical ones and then the background polls.
+        If I have a :class:`~core.channels.ChannelPool` it might route
+        ``cmd`` through its other channel.
         This deferred will be callbacked with the command's response
 
         :rtype: `Deferred`
         """
-        self.queue.put(cmd)
+        cmd.queued_at = time()
+        cmd.protocol = self
+        if not self.watchdog.check(cmd):
+            return cmd.deferred
+
+        if self.pool is not None:
+            channel = self.pool.route(cmd)
+            if channel is not self:
+                return channel.queue_at_cmd(cmd)
+
+        if self.compound is not None and cmd.name in COMPOUND_CMDS:
+            self.compound.append(cmd)
+        else:
+            self.queue.put(cmd)
+            self.stats.on_queue_depth(len(self.queue))
+
+        return cmd.deferred
+
+    def queue_urgent_cmd(self, cmd):
+        """
+        Queues ``cmd`` ahead of every queued :class:`~core.command.ATCmd`
+
+        It is sent as soon as the executing command finishes, or right
+        away if there is none. It never goes through another channel.
+
+        :rtype: `Deferred`
+        """
+        cmd.queued_at = time()
+        cmd.protocol = self
+        if not self.watchdog.check(cmd):
+            return cmd.deferred
+
+        self.queue.put_first(cmd)
+        self.stats.on_queue_depth(len(self.queue))
         return cmd.deferred
 
+    def cancel_at_cmd(self, cmd):
+        """
+        Cancels the queued or executing ``cmd``
+
+        A queued command is removed and the device never sees it, an
+        executing command is aborted if it is abortable, otherwise it runs
+        to completion and its result is discarded.
+        """
+        if self.queue.remove(cmd):
+            log.msg("cancelled queued %r" % cmd.cmd,
+                    system=self._get_log_prefix())
+            if not cmd.deferred.called:
+                cmd.deferred.errback(defer.CancelledError())
+            return True
+
+        if cmd is self.cmd and cmd.abortable and self.transport is not None:
+            self._abort_current_cmd()
+            return True
+
+        return False
+
+    def preempt_current_cmd(self):
+        """
+        Aborts the executing command so the urgent ones are sent right away
+
+        Only abortable commands are preempted, they are sent again after
+        the urgent commands. Returns True if the command was aborted.
+        """
+        cmd = self.cmd
+        if (cmd is None or not cmd.abortable or cmd is self.preempted
+                or cmd.deferred.called or self.transport is None):
+            return False
+
+        self.preempted = cmd
+        self._abort_current_cmd()
+        return True
+
+    def _abort_current_cmd(self):
+        cmd = self.cmd
+        log.msg("aborting %r" % cmd.cmd, system=self._get_log_prefix())
+        # an aborted command ends with a bare final result code
+        if self.parser is None:
+            cmdinfo = dict(self.custom.cmd_dict[cmd.name], end=OK_REGEXP)
+            self.parser = ResponseParser(
+                    cmdinfo, self.process_waiting_notifications)
+        else:
+            self.parser.end = OK_REGEXP
+        self.transport.write('\r')
+
+    def begin_compound(self):
+        """
+        Starts collecting commands to be sent as a compound command
+
+        Until :meth:`end_compound` is called, the queued commands that can
+        be concatenated are collected rather than queued. Devices with the
+        ``no_compound_commands`` quirk do not support them.
+        """
+        if self.device.quirks.get('no_compound_commands', False):
+            return
+
+        if self.compound is None:
+            self.compound = []
+
+    def end_compound(self):
+        """Queues the commands collected since :meth:`begin_compound`"""
+        cmds, self.compound = self.compound, None
+        if not cmds:
+            return
+
+        if len(cmds) == 1:
+            self.queue.put(cmds[0])
+            return
+
+        cmd = CompoundATCmd(cmds)
+        cmd.queued_at = min([subcmd.queued_at for subcmd in cmds])
+        cmd.deferred.addCallbacks(self._compound_cb, self._compound_eb,
+                                  callbackArgs=(cmd,), errbackArgs=(cmd,))
+        self.queue.put(cmd)
+        self.stats.on_queue_depth(len(self.queue))
+
+    def _compound_cb(self, response, cmd):
+        responses = cmd.split_response(response, self.custom.cmd_dict)
+        for subcmd, matches in zip(cmd.cmds, responses):
+            if subcmd.deferred.called:
+                # cancelled
+                continue
+
+            try:
+                subcmd.deferred.callback(matches)
+            except Exception, e:
+                args = (subcmd, matches)
+                log.err(e, "'%r' callback failed with args '%s'" % args)
+
+    def _compound_eb(self, failure, cmd):
+        # we don't know which one failed, send them one by one
+        log.msg("compound command %r failed: %s, falling back to single "
+                "commands" % (cmd.cmd, failure.getErrorMessage()),
+                system=self._get_log_prefix())
+        for subcmd in cmd.cmds:
+            if not subcmd.deferred.called:
+                self.queue.put(subcmd)
+
 
 class WCDMAProtocol(SerialProtocol):
     """
@@ -472,6 +1045,122 @@ class WCDMAProtocol(SerialProtocol):
 
     def __init__(self, device):
         super(WCDMAProtocol, self).__init__(device)
+        # read-only commands queued or executing that an identical one can
+        # join, keyed by (name, raw cmd). Emptied when a write is queued
+        self.inflight = {}
+        # {read-only command: deferreds of the callers sharing it}
+        self.shared = {}
+        # number of round trips saved by coalescing read-only commands
+        self.coalesced = 0
+
+    def queue_at_cmd(self, cmd):
+        """
+        Queues an :class:`~core.command.ATCmd` ``cmd``
+
+        If ``cmd`` is a read-only command and an identical one is already
+        queued or executing, ``cmd`` is not queued and its deferred will
+        be fired with the result of the former. Any other command stops
+        the reads queued before it from being joined, a read queued after
+        a write must see its result.
+
+        :rtype: `Deferred`
+        """
+        if cmd.name not in READ_ONLY_CMDS:
+            self.inflight = {}
+            return super(WCDMAProtocol, self).queue_at_cmd(cmd)
+
+        key = (cmd.name, cmd.get_cmd())
+        if key in self.inflight:
+            queued, waiters = self.inflight[key]
+            # do not let an interactive caller wait for a background poll
+            self._promote(queued, cmd.priority)
+            waiters.append(cmd.deferred)
+            cmd.protocol = self
+
+            self.coalesced += 1
+            log.msg("coalesced %r with queued command, %d round trips saved"
+                    % (cmd.cmd, self.coalesced),
+                    system=self._get_log_prefix())
+            return cmd.deferred
+
+        # every caller gets its own deferred, so one of them can cancel it
+        # without cancelling the command for the rest
+        waiters = [cmd.deferred]
+        cmd.deferred = defer.Deferred()
+        self.inflight[key] = (cmd, waiters)
+        self.shared[cmd] = waiters
+
+        def fire_waiters(result):
+            del self.shared[cmd]
+            if self.inflight.get(key, (None, None))[0] is cmd:
+                del self.inflight[key]
+            for d in waiters:
+                if d.called:
+                    # cancelled
+                    continue
+
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+        cmd.deferred.addBoth(fire_waiters)
+        super(WCDMAProtocol, self).queue_at_cmd(cmd)
+        return waiters[0]
+
+    def promote_cmds(self, *names):
+        """Moves the queued read-only commands ``names`` to the first class"""
+        for (name, raw), (queued, waiters) in self.inflight.items():
+            if name in names:
+                self._promote(queued, PRIORITY_INTERACTIVE)
+
+    def _promote(self, cmd, priority):
+        """
+        Moves the queued read-only ``cmd`` to the lane of ``priority``
+
+        It stays put if that would send it before a write queued earlier
+        in a lower lane, its callers must see the result of the write.
+        """
+        for p, lane in self.queue.lanes.items():
+            if p <= priority:
+                continue
+
+            for queued in lane:
+                if (queued.name not in READ_ONLY_CMDS
+                        and queued.queued_at <= cmd.queued_at):
+                    return
+
+        self.queue.promote(cmd, priority)
+
+    def cancel_at_cmd(self, cmd):
+        """
+        Cancels ``cmd``
+
+        A read-only command is only cancelled once all the callers that
+        share it have cancelled it.
+        """
+        for queued, waiters in self.shared.items():
+            if cmd is not queued and cmd.deferred not in waiters:
+                continue
+
+            # the deferred being cancelled has not been called yet
+            if len([d for d in waiters if not d.called]) > 1:
+                return False
+
+            cmd = queued
+            break
+
+        return super(WCDMAProtocol, self).cancel_at_cmd(cmd)
+
+    def ack_sms(self):
+        """Acknowledges the last SMS or status report routed to us"""
+        cmd = ATCmd('AT+CNMA', name='ack_sms')
+        # the ME stops routing them to us if the ack is late, it can not
+        # wait for a long command such as AT+COPS=?
+        d = self.queue_urgent_cmd(cmd)
+        d.addErrback(log.err, "AT+CNMA failed")
+        self.preempt_current_cmd()
+        return d
 
     def add_contact(self, name, number, index):
         """
@@ -586,8 +1275,8 @@ class WCDMAProtocol(SerialProtocol):
         """
         Enables/disable radio stack
         """
-        cmd = ATCmd("AT+CFUN=%d" % int(enable), name='enable_radio')
-        cmd.timeout = 30
+        cmd = ATCmd("AT+CFUN=%d" % int(enable), name='enable_radio',
+                    timeout=30)
         return self.queue_at_cmd(cmd)
 
     def find_contacts(self, pattern):
@@ -662,12 +1351,12 @@ class WCDMAProtocol(SerialProtocol):
         cmd = ATCmd('AT+GMI', name='get_manufacturer_name')
         return self.queue_at_cmd(cmd)
 
-    def get_netreg_status(self):
+    def get_netreg_status(self, priority=None):
         """Returns the network registration status"""
-        cmd = ATCmd('AT+CREG?', name='get_netreg_status')
+        cmd = ATCmd('AT+CREG?', name='get_netreg_status', priority=priority)
         return self.queue_at_cmd(cmd)
 
-    def get_network_info(self, _type=None):
+    def get_network_info(self, _type=None, priority=None):
         """Returns a tuple with the network info"""
         if _type is 'name':
             s = 'AT+COPS=3,0;+COPS?'
@@ -675,13 +1364,12 @@ class WCDMAProtocol(SerialProtocol):
             s = 'AT+COPS=3,2;+COPS?'
         else:
             s = 'AT+COPS?'
-        cmd = ATCmd(s, name='get_network_info')
+        cmd = ATCmd(s, name='get_network_info', priority=priority)
         return self.queue_at_cmd(cmd)
 
     def get_network_names(self):
         """Returns a tuple with the network info"""
-        cmd = ATCmd('AT+COPS=?', name='get_network_names')
-        cmd.timeout = 300
+        cmd = ATCmd('AT+COPS=?', name='get_network_names', timeout=300)
         return self.queue_at_cmd(cmd)
 
     def get_phonebook_size(self):
@@ -692,8 +1380,7 @@ class WCDMAProtocol(SerialProtocol):
         :raise SimBusy: When the SIM is not ready.
         :raise CMSError500: When the SIM is not ready.
         """
-        cmd = ATCmd('AT+CPBR=?', name='get_phonebook_size')
-        cmd.timeout = 15
+        cmd = ATCmd('AT+CPBR=?', name='get_phonebook_size', timeout=15)
         return self.queue_at_cmd(cmd)
 
     def get_pin_status(self):
@@ -711,21 +1398,23 @@ class WCDMAProtocol(SerialProtocol):
         cmd = ATCmd('AT+CPOL?', name='get_roaming_ids')
         return self.queue_at_cmd(cmd)
 
-    def get_signal_quality(self):
+    def get_signal_quality(self, priority=None):
         """Returns a tuple with the RSSI and BER of the connection"""
-        cmd = ATCmd('AT+CSQ', name='get_signal_quality')
+        cmd = ATCmd('AT+CSQ', name='get_signal_quality', priority=priority)
         return self.queue_at_cmd(cmd)
 
-    def list_sms(self):
+    def list_sms(self, status=4, priority=None):
         """
-        Returns all the messages stored in the SIM card
+        Returns the messages with ``status`` stored in the SIM card
+
+        ``status`` is 0 for the received unread messages and 4 for all
 
         :raise General: When no messages are found.
         :raise NotFound: When no messages are found.
 
         :rtype: list
         """
-        cmd = ATCmd('AT+CMGL=4', name='list_sms')
+        cmd = ATCmd('AT+CMGL=%d' % status, name='list_sms', priority=priority)
         return self.queue_at_cmd(cmd)
 
     def get_sms(self, index):
@@ -738,6 +1427,11 @@ class WCDMAProtocol(SerialProtocol):
         cmd = ATCmd('AT+CMGF?', name='get_sms_format')
         return self.queue_at_cmd(cmd)
 
+    def get_sms_storage(self):
+        """Returns the occupancy of the message storages"""
+        cmd = ATCmd('AT+CPMS?', name='get_sms_storage')
+        return self.queue_at_cmd(cmd)
+
     def get_smsc(self):
         """Returns the SMSC stored in the SIM"""
         cmd = ATCmd('AT+CSCA?', name='get_smsc')
@@ -770,8 +1464,7 @@ class WCDMAProtocol(SerialProtocol):
     def register_with_netid(self, netid, mode=1, _format=2):
         """Registers with ``netid``"""
         atstr = 'AT+COPS=%d,%d,"%s"' % (mode, _format, netid)
-        cmd = ATCmd(atstr, name='register_with_netid')
-        cmd.timeout = 30
+        cmd = ATCmd(atstr, name='register_with_netid', timeout=30)
         return self.queue_at_cmd(cmd)
 
     def reset_settings(self):
@@ -820,8 +1513,8 @@ class WCDMAProtocol(SerialProtocol):
     def send_ussd(self, ussd):
         """Sends the USSD command ``ussd``"""
         dcs = 15
-        cmd = ATCmd('AT+CUSD=1,"%s",%d' % (ussd, dcs), name='send_ussd')
-        cmd.timeout = 30
+        cmd = ATCmd('AT+CUSD=1,"%s",%d' % (ussd, dcs), name='send_ussd',
+                    timeout=30)
         return self.queue_at_cmd(cmd)
 
     def set_apn(self, index, apn):
@@ -839,6 +1532,27 @@ class WCDMAProtocol(SerialProtocol):
         cmd = ATCmd('AT+CMEE=%d' % level, name='set_error_level')
         return self.queue_at_cmd(cmd)
 
+    def set_message_service(self, service):
+        """
+        Selects the messaging ``service`` (AT+CSMS)
+
+        With service 1 the SMS and status reports routed to us must be
+        acknowledged with AT+CNMA.
+        """
+        cmd = ATCmd('AT+CSMS=%d' % service, name='set_message_service')
+        return self.queue_at_cmd(cmd)
+
+    def set_more_messages_mode(self, mode):
+        """
+        Sets the more messages to send mode (AT+CMMS) to ``mode``
+
+        0 disables it, 1 keeps the link to the SMSC open until the gap
+        between two messages exceeds a few seconds and 2 keeps it open
+        until it is disabled.
+        """
+        cmd = ATCmd('AT+CMMS=%d' % mode, name='set_more_messages_mode')
+        return self.queue_at_cmd(cmd)
+
     def set_netreg_notification(self, val=1):
         """Sets CREG unsolicited notification"""
         cmd = ATCmd('AT+CREG=%d' % val, name='set_netreg_notification')
@@ -866,11 +1580,10 @@ class WCDMAProtocol(SerialProtocol):
         cmd = ATCmd('AT+CSCA="%s"' % number, name='set_smsc')
         return self.queue_at_cmd(cmd)
 
-    def send_at(self, at_str, name='send_at', timeout=None):
+    def send_at(self, at_str, name='send_at', timeout=None, priority=None):
         """Send an arbitrary AT string to the SIM card"""
-        cmd = ATCmd(at_str, name=name)
-        if timeout:
-            cmd.timeout = timeout
+        cmd = ATCmd(at_str, name=name, priority=priority,
+                    timeout=timeout or None)
         return self.queue_at_cmd(cmd)
 
     def sim_access_restricted(self, command, fileid=None, p1=None,
@@ -19,8 +19,10 @@
 """Logging Serial Port and related classes"""
 
 from twisted import version as TwistedVersion
+from twisted.internet.error import ConnectionDone
 from twisted.internet.serialport import SerialPort as _SerialPort
 from twisted.python import log
+from twisted.python.failure import Failure
 
 
 class Port(object):
@@ -92,6 +94,12 @@ class SerialPort(_SerialPort, log.Logger):
                 (TwistedVersion.major == 11 and TwistedVersion.minor < 1):
             self.protocol.connectionLost(reason)
 
+    def abort(self):
+        """Closes the port right away, dropping any pending output"""
+        self.stopReading()
+        self.stopWriting()
+        self.connectionLost(Failure(ConnectionDone("port aborted")))
+
     def logPrefix(self):
         """Returns the last part of the port being used"""
         return self._port.split('/')[-1]
@@ -79,11 +79,42 @@ class SIMBaseClass(object):
         return charset
 
     def setup_sms(self):
+        if self.sconn.device.quirks.get('direct_sms', False):
+            return self.setup_direct_sms()
+
         # Notification when a SMS arrives...
         self.sconn.set_sms_indication(2, 1, 0, 1, 0)
         # set PDU mode
         self.sconn.set_sms_format(0)
 
+    def setup_direct_sms(self):
+        """
+        Routes the incoming SMS to us rather than to the SIM storage
+
+        They are delivered with +CMT and handed over to the MAL, saving
+        the AT+CMGR and AT+CMGD round trips and the SIM writes. The phase
+        2+ service is used when available so the network only considers
+        them delivered once we acknowledge them.
+        """
+
+        def set_message_service_cb(response):
+            # +CSMS: <mt>,<mo>,<bm>, mt is 1 if the service is supported
+            try:
+                self.sconn.sms_ack = int(response[0].group('mt')) == 1
+            except IndexError:
+                self.sconn.sms_ack = False
+
+        def set_message_service_eb(failure):
+            # phase 2 service, the SMS are acknowledged by the modem
+            self.sconn.sms_ack = False
+
+        d = self.sconn.set_message_service(1)
+        d.addCallbacks(set_message_service_cb, set_message_service_eb)
+
+        self.sconn.set_sms_indication(2, 2, 0, 1, 0)
+        # set PDU mode
+        self.sconn.set_sms_format(0)
+
     def initialize(self, set_encoding=True):
         """
         Initializes the SIM card
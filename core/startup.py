@@ -39,6 +39,7 @@ from twisted.python.logfile import BaseLogFile, LogReader
 import wader.common.consts as consts
 from wader.common._dbus import DBusExporterHelper
 from wader.common.provider import NetworkProvider
+from core.cmux import start_multiplexer
 from core.serialport import SerialPort
 
 DELAY = 10
@@ -330,6 +331,8 @@ def attach_to_serial_port(device):
     port.obj = SerialPort(device.sconn, port.path, reactor,
                           baudrate=device.baudrate)
     reactor.callLater(ATTACH_DELAY, lambda: d.callback(device))
+    # single port devices might be able to multiplex it
+    d.addCallback(start_multiplexer)
     return d
 
 
@@ -342,6 +345,9 @@ def setup_and_export_device(device):
 
     log.msg("wrapping plugin %s with class %s" % (device, wrapper_klass))
     device.sconn = wrapper_klass(device)
+    device.sconn.timeouts.load(consts.TIMEOUTS_CACHE)
+    device.sconn.capabilities.load(consts.CAPABILITIES_CACHE)
+    device.sconn.mal.snapshots.load(consts.SMS_SNAPSHOTS_CACHE)
 
     # Use the exporter that device specifies
     if not device.custom.exporter_klass:
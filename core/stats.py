@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""AT command latency and queue statistics"""
+
+from bisect import bisect_left
+
+# Upper bounds in milliseconds of the latency histogram buckets, there is
+# an extra bucket for the latencies above the last one
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+# Stages of an AT command measured by CommandStats
+STAGE_QUEUED = 'Queued'          # queue_at_cmd -> written to the port
+STAGE_FIRST_BYTE = 'FirstByte'   # written -> first byte of the response
+STAGE_EXECUTION = 'Execution'    # written -> response or failure
+STAGE_TOTAL = 'Total'            # queue_at_cmd -> response or failure
+STAGES = [STAGE_QUEUED, STAGE_FIRST_BYTE, STAGE_EXECUTION, STAGE_TOTAL]
+
+
+class LatencyHistogram(object):
+    """I count latencies in :obj:`LATENCY_BUCKETS`"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        super(LatencyHistogram, self).__init__()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.max = 0
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def add(self, seconds):
+        """Adds a latency of ``seconds``"""
+        ms = int(seconds * 1000)
+        self.counts[bisect_left(self.buckets, ms)] += 1
+        self.max = max(self.max, ms)
+
+
+class CommandStats(object):
+    """
+    I keep the latency statistics of the AT commands sent to a device
+
+    Every :class:`~core.command.ATCmd` is timestamped by the protocol as it
+    goes through its stages, once it completes I add its latencies to the
+    histograms of its name. I also track the depth of the command queue
+    and the number of commands that timed out.
+    """
+
+    def __init__(self):
+        super(CommandStats, self).__init__()
+        # {name: {stage: LatencyHistogram}}
+        self.histograms = {}
+        self.errors = {}
+        self.timeouts = {}
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+    def _get_histograms(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = dict((stage, LatencyHistogram())
+                                            for stage in STAGES)
+        return self.histograms[name]
+
+    def on_queue_depth(self, depth):
+        """Records the current depth of the command queue"""
+        self.queue_depth = depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def on_timeout(self, cmd):
+        """Records that ``cmd`` timed out"""
+        self.timeouts[cmd.name] = self.timeouts.get(cmd.name, 0) + 1
+
+    def on_completed(self, cmd, failed=False):
+        """Adds the latencies of the completed ``cmd``"""
+        if cmd.queued_at is None or cmd.written_at is None:
+            # it never reached the device
+            return
+
+        histograms = self._get_histograms(cmd.name)
+        histograms[STAGE_QUEUED].add(cmd.written_at - cmd.queued_at)
+        if cmd.first_byte_at is not None:
+            latency = cmd.first_byte_at - cmd.written_at
+            histograms[STAGE_FIRST_BYTE].add(latency)
+        histograms[STAGE_EXECUTION].add(cmd.completed_at - cmd.written_at)
+        histograms[STAGE_TOTAL].add(cmd.completed_at - cmd.queued_at)
+
+        if failed:
+            self.errors[cmd.name] = self.errors.get(cmd.name, 0) + 1
+
+    def to_dict(self):
+        """
+        Returns the statistics as a dict
+
+        The latency histograms of each command are lists of counts, one for
+        each bucket in :obj:`LATENCY_BUCKETS` plus one for the latencies
+        above the last bucket
+        """
+        commands = {}
+        for name, histograms in self.histograms.iteritems():
+            info = dict(Count=len(histograms[STAGE_TOTAL]),
+                        Errors=self.errors.get(name, 0),
+                        Timeouts=self.timeouts.get(name, 0),
+                        MaxLatency=histograms[STAGE_TOTAL].max)
+            for stage, histogram in histograms.iteritems():
+                info[stage] = histogram.counts
+            commands[name] = info
+
+        return dict(Buckets=LATENCY_BUCKETS,
+                    Commands=commands,
+                    QueueDepth=self.queue_depth,
+                    MaxQueueDepth=self.max_queue_depth,
+                    Timeouts=sum(self.timeouts.values()))
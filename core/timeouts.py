@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Adaptive AT command timeouts"""
+
+from collections import deque
+from math import ceil
+
+from core.cache import read_pickle, write_pickle
+
+# Number of latencies remembered per command
+TIMEOUT_SAMPLES = 100
+# Number of latencies needed before the learned timeout is used
+TIMEOUT_MIN_SAMPLES = 20
+# The timeout is the p99 latency times this margin
+TIMEOUT_MARGIN = 3
+# Bounds in seconds of the learned timeouts
+TIMEOUT_FLOOR = 3
+TIMEOUT_CEILING = 300
+# Commands that depend on the network need a higher floor
+TIMEOUT_FLOORS = {
+    'get_network_info': 10,
+    'get_network_names': 120,
+    'register_with_netid': 30,
+    'send_sms': 30,
+    'send_sms_from_storage': 30,
+    'send_ussd': 30,
+}
+# Commands whose name does not identify the AT command keep their timeout
+TIMEOUT_UNLEARNED = frozenset(['compound', 'send_at'])
+# New latencies after which the learned latencies are saved
+TIMEOUT_SAVE_EVERY = 50
+
+
+def percentile(samples, p):
+    """Returns the ``p`` percentile of ``samples``"""
+    ordered = sorted(samples)
+    return ordered[max(int(ceil(p * len(ordered))) - 1, 0)]
+
+
+class TimeoutPolicy(object):
+    """
+    I set the timeout of the AT commands of a device model
+
+    I learn the p99 latency of every command name and set its timeout to
+    it times :obj:`TIMEOUT_MARGIN`, bounded by the floor and ceiling of
+    the command and never below the timeout its caller set. Until enough
+    latencies have been observed the command's own timeout is used.
+    Only successful commands are learned: an error is usually answered
+    right away and a timed out command only says it took longer than its
+    timeout, so the latter is counted but neither is learned.
+    What I learn can be persisted with :meth:`load` so it is not lost
+    across restarts.
+    """
+
+    def __init__(self, model, floor=TIMEOUT_FLOOR, ceiling=TIMEOUT_CEILING,
+                 floors=TIMEOUT_FLOORS, ceilings=None):
+        super(TimeoutPolicy, self).__init__()
+        self.model = model
+        self.floor = floor
+        self.ceiling = ceiling
+        self.floors = floors
+        self.ceilings = ceilings or {}
+        # {name: deque of latencies in seconds}
+        self.samples = {}
+        # {name: number of timeouts}
+        self.timeouts = {}
+        self.path = None
+        self.unsaved = 0
+
+    def get_timeout(self, cmd):
+        """Returns the timeout in seconds to use for ``cmd``"""
+        samples = self.samples.get(cmd.name)
+        if not samples or len(samples) < TIMEOUT_MIN_SAMPLES:
+            return cmd.timeout
+
+        timeout = percentile(samples, 0.99) * TIMEOUT_MARGIN
+        floor = self.floors.get(cmd.name, self.floor)
+        ceiling = self.ceilings.get(cmd.name, self.ceiling)
+        timeout = min(max(timeout, floor), ceiling)
+        return max(timeout, cmd.explicit_timeout or 0)
+
+    def add(self, name, latency):
+        """Adds a ``latency`` in seconds of command ``name``"""
+        if name in TIMEOUT_UNLEARNED:
+            return
+
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=TIMEOUT_SAMPLES)
+        self.samples[name].append(round(latency, 3))
+
+        self.unsaved += 1
+        if self.unsaved >= TIMEOUT_SAVE_EVERY:
+            self.save()
+
+    def on_completed(self, cmd):
+        """Learns the latency of the successfully completed ``cmd``"""
+        if cmd.written_at is not None:
+            self.add(cmd.name, cmd.completed_at - cmd.written_at)
+
+    def on_timeout(self, cmd, timeout):
+        """Counts that ``cmd`` did not complete in ``timeout`` seconds"""
+        # the latency is unknown, learning the timeout as one would make
+        # every hang raise the next timeout
+        self.timeouts[cmd.name] = self.timeouts.get(cmd.name, 0) + 1
+
+    def load(self, path):
+        """Loads the latencies learned for my model from ``path``"""
+        self.path = path
+        models = self._read()
+        for name, samples in models.get(self.model, {}).iteritems():
+            self.samples[name] = deque(samples, TIMEOUT_SAMPLES)
+
+    def save(self):
+        """Saves the learned latencies if :meth:`load` has been called"""
+        self.unsaved = 0
+        if self.path is None:
+            return
+
+        models = self._read()
+        models[self.model] = dict((name, list(samples))
+                            for name, samples in self.samples.iteritems())
+        write_pickle(self.path, models, 'timeouts')
+
+    def _read(self):
+        return read_pickle(self.path, 'timeouts')
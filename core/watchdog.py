@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Detection and recovery of devices that stop answering"""
+
+from time import time
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+import wader.common.aterrors as E
+import wader.common.signals as S
+from core.command import ATCmd
+from core.serialport import SerialPort
+
+# Consecutive timeouts after which the device is considered hung
+WATCHDOG_TIMEOUTS = 3
+# Seconds between closing the port of a hung device and opening it again
+WATCHDOG_REOPEN_DELAY = 1
+
+# Commands that bring a recovered device back to a known state
+RECOVERY_CMDS = ['ATZ', 'ATE0', 'AT+CMEE=1']
+
+
+class Watchdog(object):
+    """
+    I recover the devices that stop answering their AT commands
+
+    My :class:`~core.protocol.SerialProtocol` tells me about every
+    command that gets a response or times out. After
+    :obj:`WATCHDOG_TIMEOUTS` consecutive timeouts I fail the queued
+    commands with :exc:`~wader.common.aterrors.SerialPortHung` rather
+    than letting each one wait out its timeout. Then I re-open the port,
+    reset the device and run ``init_properties`` again. The commands
+    queued in the meantime fail right away.
+
+    The recoveries and the time without service are reported with the
+    ``PortRecovered`` signal and kept in :meth:`to_dict`.
+    """
+
+    def __init__(self, sconn, clock=reactor):
+        super(Watchdog, self).__init__()
+        self.sconn = sconn
+        self.clock = clock
+        self.timeouts = 0
+        self.recovering = False
+        self.hung_at = None
+        # the port being re-opened and the capture to resume on it
+        self.port = None
+        self.capture = None
+        self.recoveries = 0
+        self.failures = 0
+        self.last_duration = 0
+        self.downtime = 0
+
+    def get_model(self):
+        return getattr(self.sconn.device, 'name', None) or 'unknown device'
+
+    def on_response(self):
+        """Executed when a command gets a response"""
+        self.timeouts = 0
+
+    def on_timeout(self):
+        """Executed when a command times out"""
+        if self.recovering:
+            return
+
+        self.timeouts += 1
+        if self.timeouts >= WATCHDOG_TIMEOUTS:
+            self.recover()
+
+    def check(self, cmd):
+        """Returns False and fails ``cmd`` if I am recovering the device"""
+        if not self.recovering:
+            return True
+
+        cmd.deferred.errback(E.SerialPortHung("%s is being recovered" %
+                                              self.get_model()))
+        return False
+
+    def recover(self):
+        """Recovers the hung device"""
+        log.msg("watchdog: %s stopped answering after %d timeouts" %
+                (self.get_model(), self.timeouts))
+        self.recovering = True
+        self.hung_at = time()
+        self.timeouts = 0
+
+        for cmd in self.sconn.queue.drain():
+            self.check(cmd)
+
+        self.close_port()
+        self.clock.callLater(WATCHDOG_REOPEN_DELAY, self.reopen_port)
+
+    def _find_port(self):
+        ports = getattr(self.sconn.device, 'ports', None)
+        if ports is None:
+            return None
+
+        for port in [ports.cport, ports.dport]:
+            if port.obj is not None and port.obj is self.sconn.transport:
+                return port
+
+        return None
+
+    def close_port(self):
+        """Closes the port of the hung device"""
+        self.port = self._find_port()
+        if self.port is None:
+            # multiplexed channels and the like can not be re-opened
+            log.msg("watchdog: the port of %s can not be re-opened" %
+                    self.get_model())
+            return
+
+        # the capture goes on over the re-opened port
+        self.capture = self.sconn.capture
+        self.sconn.capture = None
+
+        self.port.obj.abort()
+        self.port.obj = None
+
+    def open_port(self, path):
+        """Returns a new transport of the protocol over ``path``"""
+        return SerialPort(self.sconn, path, reactor,
+                          baudrate=self.sconn.device.baudrate)
+
+    def reopen_port(self):
+        """Re-opens the port and resets the device"""
+        if self.port is not None:
+            try:
+                self.port.obj = self.open_port(self.port.path)
+            except Exception, e:
+                log.err(e, "watchdog: can not re-open %s" % self.port.path)
+                return self.on_recovered(False)
+
+            if hasattr(self.port.obj, 'flushInput'):
+                self.port.obj.flushInput()
+                self.port.obj.flushOutput()
+
+            if self.capture is not None:
+                self.sconn.capture, self.capture = self.capture, None
+
+        cmds = list(RECOVERY_CMDS)
+        charset = getattr(getattr(self.sconn.device, 'sim', None),
+                          'charset', None)
+        if charset:
+            cmds.append('AT+CSCS="%s"' % charset)
+
+        ret = []
+        for at_str in cmds:
+            # queued directly as check() would fail them
+            cmd = ATCmd(at_str, name='send_at')
+            cmd.queued_at = time()
+            self.sconn.queue.put(cmd)
+            ret.append(cmd.deferred)
+
+        d = defer.gatherResults(ret, consumeErrors=True)
+        d.addCallback(self._reinitialize)
+        d.addCallbacks(lambda _: self.on_recovered(True),
+                       lambda failure: self.on_recovered(False, failure))
+        return d
+
+    def _reinitialize(self, _):
+        self.recovering = False
+        # ATZ also reset the SMS set up
+        sim = getattr(self.sconn.device, 'sim', None)
+        if hasattr(sim, 'setup_sms'):
+            sim.setup_sms()
+
+        if hasattr(self.sconn, 'init_properties'):
+            return self.sconn.init_properties()
+
+    def on_recovered(self, success, failure=None):
+        """Reports the end of a recovery"""
+        self.recovering = False
+        self.port = None
+        duration = time() - self.hung_at
+        self.last_duration = duration
+        self.downtime += duration
+        if success:
+            self.recoveries += 1
+            log.msg("watchdog: %s recovered in %.1fs" %
+                    (self.get_model(), duration))
+        else:
+            self.failures += 1
+            log.msg("watchdog: %s not recovered after %.1fs: %s" %
+                    (self.get_model(), duration,
+                     failure.getErrorMessage() if failure else ''))
+
+        self.sconn.emit_signal(S.SIG_PORT_RECOVERED, success,
+                               int(duration * 1000))
+
+    def to_dict(self):
+        """Returns the recoveries of the device as a dict"""
+        return dict(Model=self.get_model(),
+                    Recoveries=self.recoveries,
+                    Failures=self.failures,
+                    Recovering=self.recovering,
+                    LastDuration=int(self.last_duration * 1000),
+                    Downtime=int(self.downtime * 1000))
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Benchmarks of the protocol against the virtual modem
+
+It measures:
+
+ - AT commands per second through :class:`~core.protocol.WCDMAProtocol`
+ - the time to list the SMS store as it grows
+ - the cost of processing an unsolicited notification with each vendor
+   customizer
+
+The virtual modem answers with no latency, so the figures are the
+protocol's own overhead plus a small constant one of the emulator.
+
+Run it from the test directory::
+
+    python bench_emulator.py [iterations]
+"""
+
+import sys
+from time import time
+
+sys.path.insert(0, '..')
+from core.command import get_cmd_dict_copy
+from core.protocol import WCDMAProtocol
+
+from emulator import VirtualModem, connect_protocol
+
+PDU = ('07914306073011F0040B914316709807F20000803091419582400BC8329BF'
+       'D06DDDF723619')
+
+SMS_STORE_SIZES = [10, 50, 100, 250, 500]
+
+# Unsolicited notifications sent by each vendor, the standard ones are
+# processed by every customizer
+STANDARD_NOTIFICATIONS = ['+CMTI: "SM",3', '+CREG: 1', 'RING']
+VENDOR_NOTIFICATIONS = {
+    'huawei': ('core.hardware.huawei', 'HuaweiWCDMACustomizer',
+               ['^RSSI: 17', '^MODE: 5,4', '^BOOT: 12345,0,0,0,75',
+                '^DSFLOWRPT: 0000001E,00000000,00000000,0000000000000000,'
+                '0000000000000000,00000000,00000000']),
+    'zte': ('core.hardware.zte', 'ZTEWCDMACustomizer',
+            ['+ZPASR: "UMTS"', '+ZDONR: "Vodafone",214,1,"CS_PS","ROAM_OFF"',
+             '+ZUSIMR:2']),
+    'option': ('core.hardware.option', 'OptionWCDMACustomizer',
+               ['_OSIGQ: 17,0', '_OSSYSI: 2']),
+    'icera': ('core.hardware.icera', 'IceraWCDMACustomizer',
+              ['%NWSTATE: 4,21401,3G,HSDPA,free', '%IPDPACT: 1,0,0']),
+    'ericsson': ('core.hardware.ericsson', 'EricssonCustomizer',
+                 ['+CIEV: 2,3', '+CIEV: 7,1', '*EMWI: 0,1']),
+}
+
+
+class FakeCustomizer(object):
+    async_regexp = None
+    signal_translations = {}
+    cmd_dict = get_cmd_dict_copy()
+
+
+class Sink(object):
+    """Accepts any method call, stands for the exporter and the wrapper"""
+
+    def __getattr__(self, name):
+        return lambda *args, **kw: None
+
+
+class FakeSim(object):
+    size = 250
+
+
+class FakeDevice(object):
+
+    def __init__(self, custom=None):
+        self.custom = custom or FakeCustomizer()
+        self.sim = FakeSim()
+        self.ports = None
+        self.quirks = {}
+        self.exporter = Sink()
+        self.sconn = Sink()
+
+
+def get_protocol(modem, custom=None):
+    sconn = WCDMAProtocol(FakeDevice(custom))
+    sconn.mal = Sink()
+    connect_protocol(sconn, modem)
+    return sconn
+
+
+def bench_commands(iterations):
+    modem = VirtualModem()
+    sconn = get_protocol(modem)
+    cmds = [sconn.get_imei, sconn.get_signal_quality,
+            sconn.get_netreg_status, sconn.get_pin_status]
+    n = iterations * 100
+
+    start = time()
+    for i in xrange(n):
+        # the modem answers synchronously
+        cmds[i % len(cmds)]()
+    elapsed = time() - start
+
+    assert modem.processed == n
+    print "commands: %d commands/s" % (n / elapsed)
+
+
+def bench_list_sms(iterations):
+    for size in SMS_STORE_SIZES:
+        modem = VirtualModem()
+        modem.state.sms_size = size
+        for index in range(1, size + 1):
+            modem.state.sms[index] = (1, PDU)
+
+        sconn = get_protocol(modem)
+        responses = []
+        start = time()
+        for i in xrange(iterations):
+            sconn.list_sms().addCallback(responses.append)
+        elapsed = (time() - start) / iterations
+
+        assert len(responses[-1]) == size
+        print "list_sms: %4d messages in %.2f ms" % (size, elapsed * 1000)
+
+
+def bench_notifications(iterations):
+    for vendor, (module, name, notifications) in sorted(
+                                            VENDOR_NOTIFICATIONS.items()):
+        custom = getattr(__import__(module, fromlist=[name]), name)()
+        modem = VirtualModem()
+        sconn = get_protocol(modem, custom)
+        notifications = notifications + STANDARD_NOTIFICATIONS
+        n = iterations * 100
+
+        start = time()
+        for i in xrange(n):
+            modem.inject(notifications[i % len(notifications)])
+        elapsed = time() - start
+
+        assert len(sconn.idlebuf) == 0
+        print "notifications: %-8s %.1f us per notification" % (
+                vendor, elapsed / n * 1e6)
+
+
+def main(iterations=50):
+    # silence the protocol's logging
+    from twisted.python import log
+    log.msg = lambda *args, **kw: None
+    log.err = lambda *args, **kw: None
+
+    bench_commands(iterations)
+    bench_list_sms(iterations)
+    bench_notifications(iterations)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
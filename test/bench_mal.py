@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Micro-benchmark of the assembly of concatenated SMS in the MAL
+
+It adds synthetic stores of two part SMS to the MAL, as
+:meth:`~core.mal.MessageAssemblyLayer.initialize` does with the SIM
+listing, and compares it with the former strategy of checking every
+cached SMS for each fragment. The senders reuse the references so the
+date check is still needed to tell the SMS apart.
+
+Run it from the test directory::
+
+    python bench_mal.py [fragments ...]
+"""
+
+import sys
+from datetime import datetime, timedelta
+from time import time
+
+sys.path.insert(0, '..')
+import core.mal
+from core.mal import MessageAssemblyLayer, should_fragment_be_assembled
+from wader.common.sms import Message
+
+STORE_SIZES = [10, 100, 1000, 10000]
+SENDERS = 50
+
+
+class FakeWrapper(object):
+
+    def emit_signal(self, *args):
+        pass
+
+
+def get_fragments(count):
+    """Returns ``count`` fragments of two part SMS, all first parts first"""
+    start = datetime(2011, 1, 1)
+    messages = count // 2
+    fragments = []
+    for seq in [1, 2]:
+        for i in range(messages):
+            sms = Message(number='+3460000%04d' % (i % SENDERS),
+                          index=seq * messages + i,
+                          _datetime=start + timedelta(minutes=i),
+                          ref=(i // SENDERS) % 256, cnt=2, seq=seq)
+            sms.add_text_fragment('part %d of %d' % (seq, i), seq)
+            fragments.append(sms)
+
+    return fragments
+
+
+def run_mal(fragments):
+    mal = MessageAssemblyLayer(FakeWrapper())
+    for sms in fragments:
+        mal._add_sms(sms)
+    return len(mal.sms_map)
+
+
+def run_linear_scan(fragments):
+    """The former strategy: check every cached SMS for each fragment"""
+    sms_map = {}
+    for index, sms in enumerate(fragments):
+        for value in sms_map.itervalues():
+            if should_fragment_be_assembled(value, sms):
+                value.append_sms(sms)
+                break
+        else:
+            sms_map[index] = sms
+
+    return len(sms_map)
+
+
+def main(*sizes):
+    # silence the MAL's debugging
+    core.mal.debug = lambda s, *args: None
+
+    for size in sizes or STORE_SIZES:
+        fragments = get_fragments(size)
+        start = time()
+        linear = run_linear_scan(fragments)
+        linear_elapsed = time() - start
+
+        fragments = get_fragments(size)
+        start = time()
+        assert run_mal(fragments) == linear
+        elapsed = time() - start
+
+        print "%5d fragments: linear scan %8.1f ms, index %8.1f ms" % (
+                size, linear_elapsed * 1000, elapsed * 1000)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
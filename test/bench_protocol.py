@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Micro-benchmark of the protocol's buffer management
+
+It feeds a recorded AT+CMGL response through
+:meth:`~core.protocol.BufferingStateMachine.dataReceived` in tty sized
+chunks and compares it with the former strategy of growing an immutable
+`str` and rescanning it on every chunk.
+
+Run it from the test directory::
+
+    python bench_protocol.py [iterations]
+"""
+
+import re
+import sys
+from time import time
+
+sys.path.insert(0, '..')
+from core.command import get_cmd_dict_copy
+from core.protocol import WCDMAProtocol
+
+cmd_dict = get_cmd_dict_copy()
+
+# AT+CMGL=4 traffic recorded from a Huawei E220 with a full SIM
+CMGL_ENTRY = ('+CMGL: %d,1,,29\r\n'
+              '07914306073011F0040B914316709807F20000803091419582400BC8329BF'
+              'D06DDDF72361907914306073011F0040B914316709807F20000803091419'
+              '582400BC8329BFD06DDDF723619\r\n')
+CMGL_RESPONSE = ('\r\n' + ''.join([CMGL_ENTRY % i for i in range(1, 121)]) +
+                 '\r\nOK\r\n')
+CHUNK_SIZE = 64
+
+
+class FakeCustomizer(object):
+    async_regexp = None
+    signal_translations = {}
+    cmd_dict = cmd_dict
+
+
+class FakeDevice(object):
+
+    def __init__(self):
+        self.custom = FakeCustomizer()
+        self.ports = None
+        self.quirks = {}
+
+
+class FakeTransport(object):
+
+    def write(self, data):
+        pass
+
+
+def get_chunks():
+    return [CMGL_RESPONSE[i:i + CHUNK_SIZE]
+                for i in range(0, len(CMGL_RESPONSE), CHUNK_SIZE)]
+
+
+def run_protocol(pieces):
+    sconn = WCDMAProtocol(FakeDevice())
+    sconn.transport = FakeTransport()
+    response = []
+    sconn.list_sms().addCallback(response.extend)
+    for piece in pieces:
+        sconn.dataReceived(piece)
+
+    return len(response)
+
+
+def run_str_buffer(pieces):
+    """The former strategy: grow a `str` and rescan it on every chunk"""
+    cmdinfo = cmd_dict['list_sms']
+    buf = ''
+    copied = 0
+    for piece in pieces:
+        buf += piece
+        copied += len(buf)
+        if cmdinfo['end'].search(buf):
+            return len(list(re.finditer(cmdinfo['extract'], buf))), copied
+
+
+def main(iterations=50):
+    # silence the protocol's logging
+    from twisted.python import log
+    log.msg = lambda *args, **kw: None
+
+    pieces = get_chunks()
+    print "%d bytes response in %d chunks of %d bytes" % (len(CMGL_RESPONSE),
+                                                          len(pieces),
+                                                          CHUNK_SIZE)
+
+    matches, copied = run_str_buffer(pieces)
+    print "str buffer: %d bytes copied while buffering" % copied
+
+    start = time()
+    for i in range(iterations):
+        run_str_buffer(pieces)
+    str_elapsed = (time() - start) / iterations
+
+    start = time()
+    for i in range(iterations):
+        assert run_protocol(pieces) == matches
+    elapsed = (time() - start) / iterations
+
+    print "str buffer: %.2f ms per response" % (str_elapsed * 1000)
+    print "protocol:   %.2f ms per response" % (elapsed * 1000)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Replays a traffic capture through :class:`~core.middleware.WCDMAWrapper`
+
+Captures are recorded with the ``StartTrafficCapture`` method of the
+``org.freedesktop.ModemManager.Modem.Diagnostics`` interface. The
+replay is as fast as possible unless a speed is given, ``1`` replays it
+at the captured speed.
+
+Run it from the test directory::
+
+    python bench_replay.py capture [speed] [iterations]
+"""
+
+import sys
+
+sys.path.insert(0, '..')
+from twisted.internet import reactor
+
+from core.capture import CaptureReplay, read_capture
+from core.hardware.base import WCDMACustomizer
+from core.middleware import WCDMAWrapper
+
+
+class FakeSim(object):
+    size = 250
+
+
+class FakeDevice(object):
+
+    def __init__(self):
+        self.custom = WCDMACustomizer()
+        self.sim = FakeSim()
+        self.ports = None
+        self.quirks = {}
+        self.name = 'replay'
+
+
+def replay(frames, speed):
+    device = FakeDevice()
+    device.sconn = WCDMAWrapper(device)
+    player = CaptureReplay(frames, device.sconn, speed=speed)
+    return player, player.run()
+
+
+def main(path, speed=0, iterations=10):
+    # silence the protocol's logging
+    from twisted.python import log
+    log.msg = lambda *args, **kw: None
+
+    frames = read_capture(path)
+    speed, iterations = float(speed), int(iterations)
+    results = []
+
+    def run(_=None):
+        if len(results) == iterations:
+            player = results[-1][0]
+            elapsed = sum([r[1] for r in results]) / iterations
+            print "%d frames in %.2f ms" % (len(player.frames),
+                                            elapsed * 1000)
+            print "%d commands injected, %d unexpected writes" % (
+                    player.injected, player.unexpected)
+            return reactor.stop()
+
+        player, d = replay(frames, speed)
+        d.addCallback(lambda elapsed: results.append((player, elapsed)))
+        d.addCallback(run)
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,735 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+A scriptable virtual modem for tests and benchmarks
+
+:class:`VirtualModem` speaks the subset of 27.007 and 27.005 used by
+:class:`~core.protocol.WCDMAProtocol` against an in-memory
+:class:`ModemState`. It can be plugged into a protocol as a Twisted
+transport with :func:`connect_protocol`, or exported through a pty with
+:class:`PtyModem` so :class:`~core.serialport.SerialPort` can open it::
+
+    python emulator.py
+    virtual modem listening on /dev/pts/5
+
+Responses are delayed ``latency`` seconds using ``clock``, pass a
+:class:`~twisted.internet.task.Clock` to run deterministically.
+"""
+
+import os
+import re
+import sys
+import tty
+
+from zope.interface import implements
+from twisted.internet import reactor, fdesc
+from twisted.internet.interfaces import ITransport, IReadDescriptor
+
+sys.path.insert(0, '..')
+from core.cmux import (FrameDecoder, encode_frame, encode_message,
+                       CONTROL_DLCI, CMUX_SABM, CMUX_UA, CMUX_DISC, CMUX_UIH,
+                       CMUX_PF, CMUX_MSG_CLD, CMUX_MSG_MSC)
+
+CTRL_Z = '\x1a'
+ESC = '\x1b'
+PROMPT = '\r\n> '
+
+SIM_READY, SIM_PIN, SIM_PUK = 'READY', 'SIM PIN', 'SIM PUK'
+
+
+class ModemError(Exception):
+    """Raised by the command handlers, sent as a +CME or +CMS error"""
+
+    def __init__(self, code, cms=False):
+        super(ModemError, self).__init__(code)
+        self.code = code
+        self.cms = cms
+
+
+def pdu_length(pdu):
+    """Returns the TPDU length of ``pdu``, as reported by +CMGL and +CMGR"""
+    smsc_len = int(pdu[:2], 16)
+    return len(pdu) / 2 - smsc_len - 1
+
+
+def split_cmd_line(line):
+    """
+    Splits the AT command line ``line`` in its commands
+
+    ``AT+CSQ;+CREG?`` becomes ``['+CSQ', '+CREG?']``
+    """
+    body = line[2:]
+    cmds = []
+    start = 0
+    quoted = False
+    for i, char in enumerate(body):
+        if char == '"':
+            quoted = not quoted
+        elif char == ';' and not quoted:
+            cmds.append(body[start:i])
+            start = i + 1
+
+    cmds.append(body[start:])
+    return [cmd for cmd in cmds if cmd]
+
+
+class ModemState(object):
+    """The device, SIM and network state of a :class:`VirtualModem`"""
+
+    def __init__(self):
+        super(ModemState, self).__init__()
+        self.manufacturer = 'Wader'
+        self.model = 'Virtual Modem'
+        self.revision = '1.0'
+        self.imei = '351234567890123'
+        self.imsi = '214012345678901'
+        self.iccid = '8934071234567890123'
+        self.pin = '0000'
+        self.puk = '12345678'
+        self.pin_enabled = False
+        self.sim_status = SIM_READY
+        self.charset = 'IRA'
+        self.charsets = ['IRA', 'GSM', 'UCS2']
+        self.radio = 1
+        self.rssi = 20
+        self.creg_mode = 0
+        self.creg_status = 1
+        self.operator = ('Virtual', '21401')
+        self.access_tech = 2
+        self.cops_format = 0
+        self.smsc = '+34607003110'
+        self.sms_size = 30
+        # {index: (stat, pdu)}
+        self.sms = {}
+        self.message_ref = 0
+        self.phonebook_size = 250
+        # {index: (number, name)}
+        self.contacts = {}
+        # {cid: apn}
+        self.apns = {}
+
+    def store_sms(self, pdu, stat=0):
+        """Stores ``pdu`` in the first free index and returns it"""
+        for index in range(1, self.sms_size + 1):
+            if index not in self.sms:
+                self.sms[index] = (stat, pdu)
+                return index
+
+        raise ModemError(322, cms=True)
+
+    def get_iccid_bcd(self):
+        """Returns the ICCID as stored in EF_ICCID"""
+        digits = self.iccid + 'F' * (20 - len(self.iccid))
+        return ''.join([digits[i + 1] + digits[i]
+                            for i in range(0, len(digits), 2)])
+
+
+class VirtualModem(object):
+    """
+    I am a scriptable AT command modem
+
+    Commands are matched against my handler table, :meth:`add_handler`
+    replaces or extends it, and the output is passed to ``self.output``
+    ``latency`` seconds later. Unsolicited notifications can be injected
+    with :meth:`inject`.
+    """
+
+    def __init__(self, state=None, latency=0, clock=reactor):
+        super(VirtualModem, self).__init__()
+        self.state = state or ModemState()
+        self.latency = latency
+        self.clock = clock
+        self.output = None
+        self.echo = False
+        self.cmee = 1
+        # AT+CMMS mode and number of links opened to the SMSC
+        self.cmms = 0
+        self.smsc_links = 0
+        self.smsc_link = False
+        # AT+CNMI routing of the SMS, AT+CSMS service and AT+CNMA received
+        self.cnmi_mt = 1
+        self.csms = 0
+        self.acks = 0
+        # a hung modem ignores everything
+        self.hung = False
+        self.inbuf = ''
+        # the command waiting for its PDU after the prompt
+        self.pdu_handler = None
+        # number of command lines processed
+        self.processed = 0
+        self.handlers = []
+        for regexp, handler in [
+                (r'^$', self.cmd_ok),
+                (r'^Z$', self.cmd_ok),
+                (r'^E(?P<on>[01])$', self.cmd_echo),
+                (r'^\+CMEE=(?P<level>\d)$', self.cmd_cmee),
+                (r'^\+C?GMI$', lambda: [self.state.manufacturer]),
+                (r'^\+C?GMM$', lambda: [self.state.model]),
+                (r'^\+C?GMR$', lambda: [self.state.revision]),
+                (r'^\+CGSN$', lambda: [self.state.imei]),
+                (r'^\+CIMI$', self.cmd_cimi),
+                (r'^\+CPIN\?$', self.cmd_cpin_read),
+                (r'^\+CPIN="(?P<code>\d+)"(,"(?P<pin>\d+)")?$',
+                    self.cmd_cpin),
+                (r'^\+CLCK="SC",2$', self.cmd_clck_read),
+                (r'^\+CLCK="SC",(?P<on>[01]),"(?P<pin>\d+)"$', self.cmd_clck),
+                (r'^\+CPWD="SC","(?P<old>\d+)","(?P<new>\d+)"$',
+                    self.cmd_cpwd),
+                (r'^\+CFUN\?$', lambda: ['+CFUN: %d' % self.state.radio]),
+                (r'^\+CFUN=(?P<fun>\d)$', self.cmd_cfun),
+                (r'^\+CSQ$', lambda: ['+CSQ: %d,99' % self.state.rssi]),
+                (r'^\+CREG\?$', self.cmd_creg_read),
+                (r'^\+CREG=(?P<mode>\d)$', self.cmd_creg),
+                (r'^\+COPS\?$', self.cmd_cops_read),
+                (r'^\+COPS=3,(?P<format>\d)$', self.cmd_cops_format),
+                (r'^\+COPS=(?P<mode>\d)(,.*)?$', self.cmd_ok),
+                (r'^\+CSCS\?$', lambda: ['+CSCS: "%s"' % self.state.charset]),
+                (r'^\+CSCS=\?$', self.cmd_cscs_test),
+                (r'^\+CSCS="(?P<charset>\w+)"$', self.cmd_cscs),
+                (r'^\+CGDCONT\?$', self.cmd_cgdcont_read),
+                (r'^\+CGDCONT=\?$', lambda: ['+CGDCONT: (1-16),"IP",,,(0-2),'
+                                             '(0-4)']),
+                (r'^\+CGDCONT=(?P<cid>\d+),"IP","(?P<apn>.*)"$',
+                    self.cmd_cgdcont),
+                (r'^\+CRSM=176,12258,0,0,10$', self.cmd_crsm_iccid),
+                (r'^\+CMGF\?$', lambda: ['+CMGF: 0']),
+                (r'^\+CMGF=0$', self.cmd_ok),
+                (r'^\+CNMI=\d,(?P<mt>\d).*$', self.cmd_cnmi),
+                (r'^\+CSMS\?$', lambda: ['+CSMS: %d,1,1,1' % self.csms]),
+                (r'^\+CSMS=(?P<service>[01])$', self.cmd_csms),
+                (r'^\+CNMA$', self.cmd_cnma),
+                (r'^\+CPMS=.*$', self.cmd_cpms),
+                (r'^\+CPMS\?$', self.cmd_cpms_query),
+                (r'^\+CSCA\?$', lambda: ['+CSCA: "%s",145' % self.state.smsc]),
+                (r'^\+CSCA="(?P<smsc>.*)"$', self.cmd_csca),
+                (r'^\+CMGL=(?P<status>[0-4])$', self.cmd_cmgl),
+                (r'^\+CMGR=(?P<index>\d+)$', self.cmd_cmgr),
+                (r'^\+CMGD=(?P<index>\d+)$', self.cmd_cmgd),
+                (r'^\+CMGW=(?P<length>\d+)$', self.cmd_cmgw),
+                (r'^\+CMGS=(?P<length>\d+)$', self.cmd_cmgs),
+                (r'^\+CMSS=(?P<index>\d+)$', self.cmd_cmss),
+                (r'^\+CMMS\?$', lambda: ['+CMMS: %d' % self.cmms]),
+                (r'^\+CMMS=(?P<mode>[0-2])$', self.cmd_cmms),
+                (r'^\+CPBR=\?$', lambda: ['+CPBR: (1-%d),40,16' %
+                                          self.state.phonebook_size]),
+                (r'^\+CPBR=(?P<start>\d+)(,(?P<end>\d+))?$', self.cmd_cpbr),
+                (r'^\+CPBW=(?P<index>\d+)(,"(?P<number>[^"]*)",\d+,'
+                    r'"(?P<name>.*)")?$', self.cmd_cpbw),
+                (r'^\+CPBF="(?P<name>.*)"$', self.cmd_cpbf)]:
+            self.add_handler(regexp, handler)
+
+    def add_handler(self, regexp, handler):
+        """
+        Adds ``handler`` for the commands matching ``regexp``
+
+        The handler receives the named groups of the match as keyword
+        arguments and returns the information response lines, or raises
+        :exc:`ModemError`. Handlers added later take precedence.
+        """
+        self.handlers.insert(0, (re.compile(regexp), handler))
+
+    def send(self, data):
+        """Outputs ``data`` after my latency"""
+        if self.latency:
+            self.clock.callLater(self.latency, self.output, data)
+        else:
+            self.output(data)
+
+    def inject(self, notification):
+        """Outputs the unsolicited ``notification`` right away"""
+        self.output('\r\n%s\r\n' % notification)
+
+    def receive_sms(self, pdu):
+        """
+        Stores the SMS ``pdu`` and notifies it with +CMTI
+
+        If the SMS are routed to the host it is output with +CMT instead
+        """
+        if self.cnmi_mt == 2:
+            return self.inject('+CMT: ,%d\r\n%s' % (pdu_length(pdu), pdu))
+
+        index = self.state.store_sms(pdu)
+        self.inject('+CMTI: "SM",%d' % index)
+        return index
+
+    def feed(self, data):
+        """Processes ``data`` written by the host"""
+        if self.hung:
+            return
+
+        self.inbuf += data
+        while self.inbuf:
+            if self.pdu_handler is not None:
+                pos = self.inbuf.find(CTRL_Z)
+                if pos == -1:
+                    if ESC in self.inbuf:
+                        self.pdu_handler = None
+                        self.inbuf = ''
+                    return
+
+                pdu, self.inbuf = self.inbuf[:pos], self.inbuf[pos + 1:]
+                handler, self.pdu_handler = self.pdu_handler, None
+                self.send(self.respond(handler, pdu=pdu.strip()))
+                continue
+
+            pos = self.inbuf.find('\r')
+            if pos == -1:
+                return
+
+            line, self.inbuf = self.inbuf[:pos], self.inbuf[pos + 1:]
+            line = line.strip()
+            if not line:
+                continue
+
+            if self.echo:
+                self.output(line + '\r')
+
+            self.processed += 1
+            self.process_line(line)
+
+    def process_line(self, line):
+        if not line.upper().startswith('AT'):
+            return self.send('\r\nERROR\r\n')
+
+        output = []
+        for cmd in split_cmd_line(line) or ['']:
+            handler, kwargs = self.find_handler(cmd)
+            if handler is None:
+                return self.send(''.join(output) + '\r\nERROR\r\n')
+
+            if handler in (self.cmd_cmgw, self.cmd_cmgs):
+                # the command is completed by the PDU after the prompt
+                self.pdu_handler = lambda pdu: handler(pdu=pdu, **kwargs)
+                return self.send(PROMPT)
+
+            response = self.respond(handler, **kwargs)
+            if not response.endswith('\r\nOK\r\n'):
+                return self.send(''.join(output) + response)
+
+            output.append(response[:-len('\r\nOK\r\n')])
+
+        self.send(''.join(output) + '\r\nOK\r\n')
+
+    def find_handler(self, cmd):
+        for regexp, handler in self.handlers:
+            match = regexp.match(cmd)
+            if match:
+                return handler, match.groupdict()
+
+        return None, None
+
+    def respond(self, handler, **kwargs):
+        """Returns the response of ``handler`` called with ``kwargs``"""
+        try:
+            lines = handler(**kwargs) or []
+        except ModemError, e:
+            if not self.cmee:
+                return '\r\nERROR\r\n'
+            kind = 'CMS' if e.cms else 'CME'
+            return '\r\n+%s ERROR: %d\r\n' % (kind, e.code)
+
+        if not lines:
+            return '\r\nOK\r\n'
+        return '\r\n%s\r\n\r\nOK\r\n' % '\r\n'.join(lines)
+
+    def check_sim(self):
+        if self.state.sim_status == SIM_PIN:
+            raise ModemError(11)
+        if self.state.sim_status == SIM_PUK:
+            raise ModemError(12)
+
+    # command handlers
+
+    def cmd_ok(self, **kwargs):
+        return []
+
+    def cmd_echo(self, on):
+        self.echo = on == '1'
+
+    def cmd_cmee(self, level):
+        self.cmee = int(level)
+
+    def cmd_cimi(self):
+        self.check_sim()
+        return [self.state.imsi]
+
+    def cmd_cpin_read(self):
+        return ['+CPIN: %s' % self.state.sim_status]
+
+    def cmd_cpin(self, code, pin=None):
+        state = self.state
+        if state.sim_status == SIM_PUK:
+            if code != state.puk or pin is None:
+                raise ModemError(16)
+            state.pin = pin
+        elif state.sim_status == SIM_PIN:
+            if code != state.pin:
+                raise ModemError(16)
+        else:
+            raise ModemError(3)
+
+        state.sim_status = SIM_READY
+
+    def cmd_clck_read(self):
+        self.check_sim()
+        return ['+CLCK: %d' % int(self.state.pin_enabled)]
+
+    def cmd_clck(self, on, pin):
+        self.check_sim()
+        if pin != self.state.pin:
+            raise ModemError(16)
+        self.state.pin_enabled = on == '1'
+
+    def cmd_cpwd(self, old, new):
+        self.check_sim()
+        if old != self.state.pin:
+            raise ModemError(16)
+        self.state.pin = new
+
+    def cmd_cfun(self, fun):
+        self.state.radio = int(fun)
+
+    def cmd_creg_read(self):
+        return ['+CREG: %d,%d' % (self.state.creg_mode,
+                                  self.state.creg_status)]
+
+    def cmd_creg(self, mode):
+        self.state.creg_mode = int(mode)
+
+    def cmd_cops_read(self):
+        state = self.state
+        if state.creg_status not in [1, 5]:
+            return ['+COPS: 0']
+
+        name = state.operator[0] if state.cops_format == 0 else \
+                state.operator[1]
+        return ['+COPS: 0,%d,"%s",%d' % (state.cops_format, name,
+                                         state.access_tech)]
+
+    def cmd_cops_format(self, format):
+        self.state.cops_format = int(format)
+
+    def cmd_cscs_test(self):
+        charsets = ','.join(['"%s"' % c for c in self.state.charsets])
+        return ['+CSCS: (%s)' % charsets]
+
+    def cmd_cscs(self, charset):
+        if charset not in self.state.charsets:
+            raise ModemError(4)
+        self.state.charset = charset
+
+    def cmd_cgdcont_read(self):
+        return ['+CGDCONT: %d,"IP","%s","0.0.0.0",0,0' % (cid, apn)
+                    for cid, apn in sorted(self.state.apns.items())]
+
+    def cmd_cgdcont(self, cid, apn):
+        self.state.apns[int(cid)] = apn
+
+    def cmd_crsm_iccid(self):
+        self.check_sim()
+        return ['+CRSM: 144,0,"%s"' % self.state.get_iccid_bcd()]
+
+    def cmd_cpms(self):
+        used = len(self.state.sms)
+        size = self.state.sms_size
+        return ['+CPMS: %d,%d,%d,%d,%d,%d' % ((used, size) * 3)]
+
+    def cmd_cpms_query(self):
+        used = len(self.state.sms)
+        size = self.state.sms_size
+        return ['+CPMS: ' + ','.join(['"SM",%d,%d' % (used, size)] * 3)]
+
+    def cmd_cnmi(self, mt):
+        self.cnmi_mt = int(mt)
+
+    def cmd_csms(self, service):
+        self.csms = int(service)
+        return ['+CSMS: 1,1,1']
+
+    def cmd_cnma(self):
+        if self.csms != 1:
+            raise ModemError(302, cms=True)
+        self.acks += 1
+
+    def cmd_csca(self, smsc):
+        self.state.smsc = smsc
+
+    def cmd_cmgl(self, status):
+        self.check_sim()
+        lines = []
+        for index, (stat, pdu) in sorted(self.state.sms.items()):
+            if status != '4' and stat != int(status):
+                continue
+            if stat == 0:
+                # read now
+                self.state.sms[index] = (1, pdu)
+            lines.append('+CMGL: %d,%d,,%d' % (index, stat, pdu_length(pdu)))
+            lines.append(pdu)
+        return lines
+
+    def cmd_cmgr(self, index):
+        self.check_sim()
+        try:
+            stat, pdu = self.state.sms[int(index)]
+        except KeyError:
+            raise ModemError(321, cms=True)
+
+        if stat == 0:
+            # read now
+            self.state.sms[int(index)] = (1, pdu)
+
+        return ['+CMGR: %d,,%d' % (stat, pdu_length(pdu)), pdu]
+
+    def cmd_cmgd(self, index):
+        self.check_sim()
+        self.state.sms.pop(int(index), None)
+
+    def cmd_cmgw(self, length, pdu):
+        self.check_sim()
+        return ['+CMGW: %d' % self.state.store_sms(pdu, stat=2)]
+
+    def cmd_cmgs(self, length, pdu):
+        self.check_sim()
+        if not self.smsc_link:
+            self.smsc_links += 1
+        # the mode 1 timeout is not emulated
+        self.smsc_link = self.cmms != 0
+        self.state.message_ref = (self.state.message_ref + 1) % 256
+        return ['+CMGS: %d' % self.state.message_ref]
+
+    def cmd_cmms(self, mode):
+        self.cmms = int(mode)
+        if not self.cmms:
+            self.smsc_link = False
+
+    def cmd_cmss(self, index):
+        self.check_sim()
+        if int(index) not in self.state.sms:
+            raise ModemError(321, cms=True)
+        self.state.message_ref = (self.state.message_ref + 1) % 256
+        return ['+CMSS: %d' % self.state.message_ref]
+
+    def cmd_cpbr(self, start, end=None):
+        self.check_sim()
+        start = int(start)
+        end = int(end) if end else start
+        lines = ['+CPBR: %d,"%s",145,"%s"' % (index, number, name)
+                    for index, (number, name)
+                        in sorted(self.state.contacts.items())
+                        if start <= index <= end]
+        if not lines:
+            raise ModemError(22)
+        return lines
+
+    def cmd_cpbw(self, index, number=None, name=None):
+        self.check_sim()
+        index = int(index)
+        if not 1 <= index <= self.state.phonebook_size:
+            raise ModemError(21)
+
+        if number is None:
+            self.state.contacts.pop(index, None)
+        else:
+            self.state.contacts[index] = (number, name)
+
+    def cmd_cpbf(self, name):
+        self.check_sim()
+        lines = ['+CPBF: %d,"%s",145,"%s"' % (index, number, _name)
+                    for index, (number, _name)
+                        in sorted(self.state.contacts.items())
+                        if _name.lower().startswith(name.lower())]
+        if not lines:
+            raise ModemError(22)
+        return lines
+
+
+class CMUXPeer(object):
+    """
+    I am the 27.010 multiplexer of a :class:`VirtualModem`
+
+    Use me instead of the modem when connecting a transport. The modem
+    enters multiplexer mode with AT+CMUX, then the AT commands travel in
+    the UIH frames of DLC 1 and the data sent to the other DLCs is
+    collected in :attr:`received`.
+    """
+
+    at_dlci = 1
+
+    def __init__(self, modem):
+        super(CMUXPeer, self).__init__()
+        self.modem = modem
+        self.output = None
+        self.muxed = False
+        self.switching = False
+        self.decoder = FrameDecoder()
+        self.open = set()
+        # {dlci: [data]}
+        self.received = {}
+        # V.24 signals of the MSC commands received, as (dlci, signals)
+        self.signals = []
+        modem.output = self.modem_output
+        modem.add_handler(r'^\+CMUX=.*$', self.cmd_cmux)
+
+    def cmd_cmux(self):
+        # the OK is still sent in AT mode
+        self.switching = True
+
+    def modem_output(self, data):
+        if self.muxed:
+            self.send_data(self.at_dlci, data)
+            return
+
+        self.output(data)
+        if self.switching:
+            self.switching = False
+            self.muxed = True
+
+    def send_data(self, dlci, data):
+        """Sends ``data`` to the host on ``dlci``"""
+        self.output(encode_frame(dlci, CMUX_UIH, data, cr=False))
+
+    def feed(self, data):
+        if not self.muxed:
+            return self.modem.feed(data)
+
+        for dlci, control, info in self.decoder.feed(data):
+            if control in (CMUX_SABM, CMUX_DISC):
+                if control == CMUX_SABM:
+                    self.open.add(dlci)
+                else:
+                    self.open.discard(dlci)
+                self.output(encode_frame(dlci, CMUX_UA | CMUX_PF, cr=True))
+            elif control != CMUX_UIH:
+                continue
+            elif dlci == CONTROL_DLCI:
+                self.process_message(info)
+            elif dlci == self.at_dlci:
+                self.modem.feed(info)
+            else:
+                self.received.setdefault(dlci, []).append(info)
+
+    def process_message(self, info):
+        msg_type = ord(info[0]) & ~0x03
+        value = info[2:2 + (ord(info[1]) >> 1)]
+        if not ord(info[0]) & 0x02:
+            return
+
+        if msg_type == CMUX_MSG_CLD:
+            self.muxed = False
+            self.open.clear()
+        elif msg_type == CMUX_MSG_MSC:
+            self.signals.append((ord(value[0]) >> 2, ord(value[1])))
+
+        self.send_data(CONTROL_DLCI, encode_message(msg_type, value,
+                                                    cr=False))
+
+
+class VirtualModemTransport(object):
+    """I connect a protocol to a :class:`VirtualModem`"""
+    implements(ITransport)
+
+    disconnecting = False
+
+    def __init__(self, modem, protocol):
+        super(VirtualModemTransport, self).__init__()
+        self.modem = modem
+        self.protocol = protocol
+        modem.output = self.deliver
+
+    def deliver(self, data):
+        if self.protocol is not None:
+            self.protocol.dataReceived(data)
+
+    def write(self, data):
+        self.modem.feed(data)
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def loseConnection(self):
+        self.protocol, protocol = None, self.protocol
+        if protocol is not None:
+            protocol.connectionLost(None)
+
+    abort = loseConnection
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+
+def connect_protocol(protocol, modem):
+    """Connects ``protocol`` to ``modem`` and returns the transport"""
+    transport = VirtualModemTransport(modem, protocol)
+    protocol.makeConnection(transport)
+    return transport
+
+
+class PtyModem(object):
+    """
+    I export a :class:`VirtualModem` through a pty
+
+    :attr:`path` is the slave end that the serial port should open
+    """
+    implements(IReadDescriptor)
+
+    def __init__(self, modem, reactor=reactor):
+        super(PtyModem, self).__init__()
+        self.modem = modem
+        self.reactor = reactor
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        fdesc.setNonBlocking(self.master)
+        modem.output = self.deliver
+
+    def start(self):
+        self.reactor.addReader(self)
+
+    def stop(self):
+        self.reactor.removeReader(self)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def deliver(self, data):
+        os.write(self.master, data)
+
+    def fileno(self):
+        return self.master
+
+    def doRead(self):
+        return fdesc.readFromFD(self.master, self.modem.feed)
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self):
+        return 'PtyModem'
+
+
+def main():
+    pty = PtyModem(VirtualModem())
+    pty.start()
+    print "virtual modem listening on %s" % pty.path
+    sys.stdout.flush()
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
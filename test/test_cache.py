@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the cache module"""
+
+import sys
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+from core.cache import (PropertyCache, CapabilityStore, EVENT_SETTINGS,
+                        SIGNAL_TTL)
+
+
+class FakeWrapper(object):
+
+    def __init__(self):
+        self.reads = 0
+        self.band = 1
+
+    def get_imei(self):
+        self.reads += 1
+        return defer.succeed('123456789012345')
+
+    def get_band(self):
+        self.reads += 1
+        return defer.succeed(self.band)
+
+    def set_band(self, band):
+        self.band = band
+        return defer.succeed(None)
+
+
+class TestPropertyCache(unittest.TestCase):
+    """Tests for core.cache.PropertyCache"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = PropertyCache(clock=self.clock)
+        self.wrapper = FakeWrapper()
+        self.cache.install(self.wrapper)
+
+    def test_session_property_is_read_once(self):
+        results = []
+        for i in range(3):
+            self.wrapper.get_imei().addCallback(results.append)
+
+        self.assertEqual(results, ['123456789012345'] * 3)
+        self.assertEqual(self.wrapper.reads, 1)
+        stats = self.cache.to_dict()['imei']
+        self.assertEqual((stats['Hits'], stats['Misses']), (2, 1))
+
+    def test_concurrent_misses_share_the_read(self):
+        reads = []
+
+        def read():
+            reads.append(defer.Deferred())
+            return reads[-1]
+
+        results = []
+        self.cache.get('signal', read).addCallback(results.append)
+        self.cache.get('signal', read).addCallback(results.append)
+        self.assertEqual(len(reads), 1)
+
+        reads[0].callback(80)
+        self.assertEqual(results, [80, 80])
+
+    def test_none_is_not_cached(self):
+        results = []
+        # a getter that logged its error
+        self.cache.get('band', lambda: None).addCallback(results.append)
+        self.cache.get('band', lambda: 4).addCallback(results.append)
+        self.assertEqual(results, [None, 4])
+        self.assertEqual(self.cache.entries['band'][1], 4)
+
+    def test_ttl_expires(self):
+        self.cache.update(80, 'signal')
+        self.clock.advance(SIGNAL_TTL + 1)
+        results = []
+        self.cache.get('signal', lambda: 60).addCallback(results.append)
+        self.assertEqual(results, [60])
+
+    def test_setter_invalidates(self):
+        self.wrapper.get_band()
+        self.wrapper.set_band(4)
+        results = []
+        self.wrapper.get_band().addCallback(results.append)
+        self.assertEqual(results, [4])
+        self.assertEqual(self.wrapper.reads, 2)
+
+    def test_event_invalidates_its_properties(self):
+        self.cache.update('123456789012345', 'imei')
+        self.cache.update(1, 'band')
+        self.cache.on_event(EVENT_SETTINGS)
+        self.failUnless('imei' in self.cache.entries)
+        self.failIf('band' in self.cache.entries)
+
+
+class TestCapabilityStore(unittest.TestCase):
+    """Tests for core.cache.CapabilityStore"""
+
+    def setUp(self):
+        self.path = self.mktemp()
+        cache = PropertyCache(clock=Clock())
+        cache.update(['IRA', 'UCS2'], 'charsets')
+        cache.update((1, 11), 'apn_range')
+        cache.update(250, 'phonebook_size')
+        # the current charset is not a capability
+        cache.update('UCS2', 'charset')
+
+        store = CapabilityStore()
+        store.load(self.path)
+        store.record(cache, '123456789012345', '8934071100272481446')
+
+        self.cache = PropertyCache(clock=Clock())
+        self.store = CapabilityStore()
+        self.store.load(self.path)
+
+    def test_seed(self):
+        names = self.store.seed(self.cache, '123456789012345',
+                                '8934071100272481446')
+        self.assertEqual(names, ['apn_range', 'charsets', 'phonebook_size'])
+        self.assertEqual(self.cache.entries['apn_range'][1], (1, 11))
+        self.failIf('charset' in self.cache.entries)
+
+    def test_other_sim_is_not_seeded(self):
+        names = self.store.seed(self.cache, '123456789012345',
+                                '8934071100272481447')
+        self.assertEqual(names, ['apn_range', 'charsets'])
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the capture module"""
+
+import sys
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+from core.capture import (TrafficCapture, CaptureReplay, read_capture,
+                          REC_CMD, REC_TX, REC_RX)
+from core.protocol import WCDMAProtocol
+
+from emulator import VirtualModem, connect_protocol
+from test_emulator import FakeDevice, FakeMal, PDU
+
+PORT = '/dev/ttyUSB2'
+
+
+class TestCapture(unittest.TestCase):
+    """Tests for core.capture"""
+
+    def setUp(self):
+        self.path = self.mktemp()
+        modem = VirtualModem()
+        modem.state.sms[1] = (1, PDU)
+        sconn = WCDMAProtocol(FakeDevice())
+        sconn.mal = FakeMal()
+        connect_protocol(sconn, modem)
+
+        sconn.start_capture(TrafficCapture(self.path), PORT)
+        sconn.get_imei()
+        modem.receive_sms(PDU)
+        sconn.list_sms()
+        sconn.save_sms(PDU, 29)
+        sconn.stop_capture()
+
+    def _get_protocol(self):
+        sconn = WCDMAProtocol(FakeDevice())
+        sconn.mal = FakeMal()
+        return sconn
+
+    def test_read_capture(self):
+        frames = read_capture(self.path)
+        self.assertEqual(set(f[2] for f in frames), set([PORT]))
+        self.assertEqual([f[3] for f in frames if f[1] == REC_CMD],
+                         ['get_imei', 'list_sms', 'save_sms'])
+        self.assertEqual([f[3] for f in frames if f[1] == REC_TX][:2],
+                         ['AT+CGSN\r\n', 'AT+CMGL=4\r\n'])
+        rx = ''.join([f[3] for f in frames if f[1] == REC_RX])
+        self.failUnless('+CMTI: "SM",2' in rx)
+
+    def test_truncated_capture(self):
+        frames = read_capture(self.path)
+        data = open(self.path, 'rb').read()
+        open(self.path, 'wb').write(data[:-3])
+        self.assertEqual(read_capture(self.path), frames[:-1])
+
+    def test_replay(self):
+        sconn = self._get_protocol()
+        replay = CaptureReplay(read_capture(self.path), sconn, speed=0)
+        done = []
+        replay.run().addCallback(done.append)
+        self.assertEqual(len(done), 1)
+        self.assertEqual(replay.injected, 3)
+        self.assertEqual(replay.unexpected, 0)
+        self.assertEqual(sconn.mal.notified, [2])
+        self.assertEqual(sorted(sconn.stats.histograms),
+                         ['get_imei', 'list_sms', 'save_sms'])
+
+    def test_replay_at_original_speed(self):
+        frames = read_capture(self.path)
+        # space the frames a second apart
+        frames = [(i, kind, port, data)
+                    for i, (_, kind, port, data) in enumerate(frames)]
+        clock = Clock()
+        sconn = self._get_protocol()
+        replay = CaptureReplay(frames, sconn, speed=2, clock=clock)
+        done = []
+        replay.run().addCallback(done.append)
+        clock.advance(0.5)
+        self.assertEqual(replay.pos, 2)
+        clock.pump([0.5] * len(frames))
+        self.assertEqual(len(done), 1)
+        self.assertEqual(replay.unexpected, 0)
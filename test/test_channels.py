@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the channels module"""
+
+import sys
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+from core.channels import ChannelPool, POOL_EXPAND_DELAY
+from core.protocol import WCDMAProtocol
+from core.serialport import Ports
+from wader.common.consts import (MM_MODEM_STATE_REGISTERED,
+                                 MM_MODEM_STATE_CONNECTING)
+
+from emulator import VirtualModem, ModemState, connect_protocol
+from test_emulator import FakeDevice, FakeMal, PDU
+
+
+class EmulatedChannelPool(ChannelPool):
+    """I open the data port against a :class:`VirtualModem`"""
+
+    def __init__(self, device, sconn, modem, clock):
+        super(EmulatedChannelPool, self).__init__(device, sconn, clock)
+        self.modem = modem
+
+    def open_port(self, protocol, path):
+        return connect_protocol(protocol, self.modem)
+
+
+class TestChannelPool(unittest.TestCase):
+    """Tests for core.channels.ChannelPool"""
+
+    def setUp(self):
+        self.clock = Clock()
+        state = ModemState()
+        state.store_sms(PDU)
+        self.modem = VirtualModem(state)
+        self.aux_modem = VirtualModem(state, latency=0.1, clock=self.clock)
+
+        self.device = FakeDevice()
+        self.device.ports = Ports('/dev/ttyUSB0', '/dev/ttyUSB1')
+        self.device.status = MM_MODEM_STATE_REGISTERED
+        self.sconn = WCDMAProtocol(self.device)
+        self.sconn.mal = FakeMal()
+        connect_protocol(self.sconn, self.modem)
+
+        self.pool = EmulatedChannelPool(self.device, self.sconn,
+                                        self.aux_modem, self.clock)
+        self.sconn.pool = self.pool
+
+    def expand(self):
+        self.pool.on_status(MM_MODEM_STATE_REGISTERED)
+        self.clock.advance(POOL_EXPAND_DELAY)
+        # the set up commands of the data port
+        for i in range(4):
+            self.clock.advance(0.1)
+
+    def test_expand(self):
+        self.expand()
+        self.failUnless(self.pool.ready)
+        self.assertEqual(self.aux_modem.processed, 3)
+
+    def test_bulk_commands_are_routed(self):
+        self.expand()
+        results = []
+        self.sconn.list_sms().addCallback(results.append)
+        self.sconn.get_imei().addCallback(results.append)
+        # the IMEI is not held up by the listing
+        self.assertEqual(len(results), 1)
+        self.assertEqual(self.modem.processed, 1)
+
+        self.clock.advance(0.1)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(results[1]), 1)
+
+    def test_not_expanded_with_quirk(self):
+        self.device.quirks = {'no_channel_pool': True}
+        self.expand()
+        self.failIf(self.pool.ready)
+        self.assertEqual(self.aux_modem.processed, 0)
+
+    def test_collapse_moves_commands(self):
+        self.expand()
+        results = []
+        self.sconn.list_sms().addCallback(results.append)
+        self.sconn.list_sms().addCallback(results.append)
+
+        self.pool.on_status(MM_MODEM_STATE_CONNECTING)
+        self.failIf(self.pool.ready)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(results[0]), 1)
+        # new bulk reads use the application port
+        self.sconn.list_sms().addCallback(results.append)
+        self.assertEqual(len(results), 3)
+
+    def test_collapse_waits_for_the_port_to_close(self):
+        self.expand()
+        port = self.pool.port
+        # a serial port is closed once the reactor gets to it
+        lose_connection = port.loseConnection
+        port.loseConnection = lambda: self.clock.callLater(0,
+                                                           lose_connection)
+        results = []
+        self.pool.collapse().addCallback(results.append)
+        # a dialer that asks again waits as well
+        self.pool.collapse().addCallback(results.append)
+        self.assertEqual(results, [])
+
+        self.clock.advance(0)
+        self.assertEqual(results, [True, True])
+        self.pool.collapse().addCallback(results.append)
+        self.assertEqual(len(results), 3)
+
+    def test_watchdog_is_shared(self):
+        self.expand()
+        self.assertIdentical(self.pool.aux.watchdog, self.sconn.watchdog)
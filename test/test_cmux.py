@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the cmux module"""
+
+import os
+import sys
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+from core.cmux import (FrameDecoder, CMUXMultiplexer, encode_frame,
+                       encode_message, get_fcs, get_cmux_n1,
+                       start_multiplexer, stop_multiplexer,
+                       CMUX_SABM, CMUX_UA, CMUX_UIH, CMUX_UI, CMUX_PF,
+                       CMUX_N2, CMUX_T1, CMUX_MSC_ON, CMUX_MSC_OFF,
+                       CMUX_MSG_TEST, CMUX_MSG_NSC, CMUX_DTR_DELAY,
+                       CONTROL_DLCI, AT_DLCI, DATA_DLCI)
+from core.protocol import WCDMAProtocol
+from core.serialport import Ports
+from wader.common.exceptions import MultiplexerError
+
+from emulator import VirtualModem, CMUXPeer, connect_protocol
+from test_emulator import FakeDevice, FakeMal
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class TestFrames(unittest.TestCase):
+    """Tests for the 27.010 basic option frames"""
+
+    def test_encode_sabm(self):
+        self.assertEqual(encode_frame(0, CMUX_SABM | CMUX_PF),
+                         '\xf9\x03\x3f\x01\x1c\xf9')
+
+    def test_encode_ua(self):
+        self.assertEqual(encode_frame(0, CMUX_UA | CMUX_PF),
+                         '\xf9\x03\x73\x01\xd7\xf9')
+
+    def test_decode_in_small_chunks(self):
+        data = encode_frame(1, CMUX_UIH, 'AT\r') + \
+               encode_frame(2, CMUX_UIH, 'x' * 300)
+        decoder = FrameDecoder()
+        frames = []
+        for i in range(0, len(data), 7):
+            frames.extend(decoder.feed(data[i:i + 7]))
+
+        self.assertEqual(frames, [(1, CMUX_UIH, 'AT\r'),
+                                  (2, CMUX_UIH, 'x' * 300)])
+
+    def test_resync_after_garbage_and_bad_fcs(self):
+        bad = encode_frame(1, CMUX_UIH, 'AT\r')
+        bad = bad[:-2] + chr(ord(bad[-2]) ^ 0xff) + bad[-1]
+        decoder = FrameDecoder()
+        frames = decoder.feed('garbage' + bad +
+                              encode_frame(1, CMUX_UIH, 'OK'))
+        self.assertEqual(frames, [(1, CMUX_UIH, 'OK')])
+        self.assertEqual(decoder.dropped, 1)
+
+    def test_ui_frame_fcs_covers_data(self):
+        frame = encode_frame(1, CMUX_UI, 'AT\r')
+        self.assertEqual(ord(frame[-2]), get_fcs(frame[1:-2]))
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(frame), [(1, CMUX_UI, 'AT\r')])
+
+        bad = frame[:5] + 'X' + frame[6:]
+        self.assertEqual(decoder.feed(bad), [])
+        self.assertEqual(decoder.dropped, 1)
+
+    def test_get_cmux_n1(self):
+        self.assertEqual(get_cmux_n1('AT+CMUX=0'), 31)
+        self.assertEqual(get_cmux_n1('AT+CMUX=0,0,5,127'), 127)
+
+
+class TestMultiplexer(unittest.TestCase):
+    """Tests for core.cmux.CMUXMultiplexer"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.mux = CMUXMultiplexer(n1=10, clock=self.clock)
+        self.mux.makeConnection(FakeTransport())
+
+    def test_data_is_split_in_frames(self):
+        self.mux.send_data(AT_DLCI, 'AT+CMGL=4\r\n')
+        self.assertEqual(self.mux.transport.written,
+                         [encode_frame(AT_DLCI, CMUX_UIH, 'AT+CMGL=4\r'),
+                          encode_frame(AT_DLCI, CMUX_UIH, '\n')])
+
+    def test_open_channel_retransmits(self):
+        failures = []
+        d = self.mux.open_channel(AT_DLCI)
+        d.addErrback(lambda f: failures.append(f.trap(MultiplexerError)))
+        for i in range(CMUX_N2 + 1):
+            self.clock.advance(CMUX_T1)
+
+        self.assertEqual(len(self.mux.transport.written), CMUX_N2 + 1)
+        self.assertEqual(failures, [MultiplexerError])
+
+    def test_test_message_is_echoed(self):
+        msg = encode_message(CMUX_MSG_TEST, 'ping')
+        self.mux.dataReceived(encode_frame(CONTROL_DLCI, CMUX_UIH, msg,
+                                           cr=False))
+        reply = encode_message(CMUX_MSG_TEST, 'ping', cr=False)
+        self.assertEqual(self.mux.transport.written,
+                         [encode_frame(CONTROL_DLCI, CMUX_UIH, reply)])
+
+    def test_unsupported_message_gets_nsc(self):
+        # a parameter negotiation
+        msg = encode_message(0x80, '\x02\x00\x00\x00\x40\x00\x03\x02')
+        self.mux.dataReceived(encode_frame(CONTROL_DLCI, CMUX_UIH, msg,
+                                           cr=False))
+        reply = encode_message(CMUX_MSG_NSC, '\x83', cr=False)
+        self.assertEqual(self.mux.transport.written,
+                         [encode_frame(CONTROL_DLCI, CMUX_UIH, reply)])
+
+
+class TestMultiplexedDevice(unittest.TestCase):
+    """Tests for start_multiplexer against a CMUX peer"""
+
+    def setUp(self):
+        self.peer = CMUXPeer(VirtualModem())
+        self.device = FakeDevice()
+        self.device.quirks = {'cmux': 'AT+CMUX=0,0,5,64'}
+        self.device.ports = Ports('/dev/ttyUSB0', None)
+        self.device.mux = None
+        self.device.sconn = WCDMAProtocol(self.device)
+        self.device.sconn.mal = FakeMal()
+        transport = connect_protocol(self.device.sconn, self.peer)
+        self.device.ports.dport.obj = transport
+
+        done = []
+        start_multiplexer(self.device).addCallback(done.append)
+        self.assertEqual(done, [self.device])
+
+    def tearDown(self):
+        stop_multiplexer(self.device)
+
+    def test_ports(self):
+        ports = self.device.ports
+        self.failUnless(ports.has_two())
+        self.assertEqual(ports.cport.path, '/dev/ttyUSB0')
+        self.failUnless(os.path.exists(ports.dport.path))
+        self.assertEqual(self.peer.open, set([0, AT_DLCI, DATA_DLCI]))
+        self.assertEqual(self.device.mux.n1, 64)
+
+    def test_at_commands_and_notifications(self):
+        results = []
+        self.device.sconn.get_imei().addCallback(
+                lambda r: results.append(r[0].group('imei')))
+        self.assertEqual(results, [self.peer.modem.state.imei])
+
+        self.peer.modem.inject('+CMTI: "SM",3')
+        self.assertEqual(self.device.sconn.mal.notified, [3])
+
+    def test_data_channel(self):
+        self.peer.send_data(DATA_DLCI, '\r\nCONNECT\r\n')
+        slave = os.open(self.device.ports.dport.path, os.O_RDWR)
+        try:
+            self.assertEqual(os.read(slave, 100), '\r\nCONNECT\r\n')
+        finally:
+            os.close(slave)
+
+    def test_hangup(self):
+        clock = self.device.mux.clock = Clock()
+        self.device.mux.hangup(DATA_DLCI)
+        self.assertEqual(self.peer.signals[-1], (DATA_DLCI, CMUX_MSC_OFF))
+
+        # the DTR is raised once the device has noticed the drop
+        clock.advance(CMUX_DTR_DELAY)
+        self.assertEqual(self.peer.signals[-2:],
+                         [(DATA_DLCI, CMUX_MSC_OFF), (DATA_DLCI, CMUX_MSC_ON)])
+
+    def test_stop(self):
+        stop_multiplexer(self.device)
+        self.failIf(self.peer.muxed)
+        self.failIf(self.device.ports.has_two())
+        self.assertEqual(self.device.ports.dport.path, '/dev/ttyUSB0')
@@ -24,7 +24,7 @@ import sys
 from twisted.trial import unittest
 
 sys.path.insert(0, '..')
-from core.command import get_cmd_dict_copy
+from core.command import get_cmd_dict_copy, ATCmd, CompoundATCmd
 
 cmd_dict = get_cmd_dict_copy()
 
@@ -264,3 +264,43 @@ class TestCommandsRegexps(unittest.TestCase):
         match = extract.match(text)
         self.failIf(match == None)
         self.assertEqual(match.group('smsc'), '002B00330034003600300037003000300033003100310030')
+
+
+class TestCompoundATCmd(unittest.TestCase):
+    """Tests for core.command.CompoundATCmd"""
+
+    def test_cmd(self):
+        cmd = CompoundATCmd([ATCmd('AT+CSQ', name='get_signal_quality'),
+                             ATCmd('AT+COPS=3,2;+COPS?',
+                                   name='get_network_info'),
+                             ATCmd('AT+CREG?', name='get_netreg_status')])
+        self.assertEqual(cmd.get_cmd(), 'AT+CSQ;+COPS=3,2;+COPS?;+CREG?\r\n')
+
+    def test_split_response(self):
+        cmd = CompoundATCmd([ATCmd('AT+CSQ', name='get_signal_quality'),
+                             ATCmd('AT+COPS?', name='get_network_info'),
+                             ATCmd('AT+CREG?', name='get_netreg_status')])
+        text = ('\r\n+CSQ: 20,99\r\n'
+                '\r\n+COPS: 0,2,"21401",2\r\n'
+                '\r\n+CREG: 0,1\r\n\r\nOK\r\n')
+        csq, cops, creg = cmd.split_response(text, cmd_dict)
+        self.assertEqual(len(csq), 1)
+        self.assertEqual(csq[0].group('rssi'), '20')
+        self.assertEqual(cops[0].group('netname'), '21401')
+        self.assertEqual(creg[0].group('status'), '1')
+
+    def test_split_response_without_blank_lines(self):
+        cmd = CompoundATCmd([ATCmd('AT+CSQ', name='get_signal_quality'),
+                             ATCmd('AT+CREG?', name='get_netreg_status')])
+        text = '\r\n+CSQ: 20,99\r\n+CREG: 0,5\r\n\r\nOK\r\n'
+        csq, creg = cmd.split_response(text, cmd_dict)
+        self.assertEqual(csq[0].group('ber'), '99')
+        self.assertEqual(creg[0].group('status'), '5')
+
+    def test_split_response_missing_part(self):
+        cmd = CompoundATCmd([ATCmd('AT+CSQ', name='get_signal_quality'),
+                             ATCmd('AT+CREG?', name='get_netreg_status')])
+        csq, creg = cmd.split_response('\r\n+CREG: 0,1\r\n\r\nOK\r\n',
+                                       cmd_dict)
+        self.assertEqual(csq, [])
+        self.assertEqual(creg[0].group('status'), '1')
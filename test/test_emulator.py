@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the virtual modem, driven through WCDMAProtocol"""
+
+import sys
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+from core.command import get_cmd_dict_copy
+from core.protocol import WCDMAProtocol
+import wader.common.aterrors as E
+
+from emulator import (VirtualModem, ModemState, connect_protocol,
+                      split_cmd_line, pdu_length, SIM_PIN)
+
+PDU = ('07914306073011F0040B914316709807F20000803091419582400BC8329BF'
+       'D06DDDF723619')
+
+
+class FakeCustomizer(object):
+    async_regexp = None
+    signal_translations = {}
+    cmd_dict = get_cmd_dict_copy()
+
+
+class FakeSim(object):
+    size = 250
+
+
+class FakeDevice(object):
+
+    def __init__(self):
+        self.custom = FakeCustomizer()
+        self.sim = FakeSim()
+        self.ports = None
+        self.quirks = {}
+
+
+class FakeMal(object):
+
+    def __init__(self):
+        self.notified = []
+
+    def on_sms_notification(self, index):
+        self.notified.append(index)
+
+    def on_sms_direct(self, pdu):
+        self.notified.append(pdu)
+
+
+class TestVirtualModem(unittest.TestCase):
+    """Tests for emulator.VirtualModem"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.modem = VirtualModem(latency=0.1, clock=self.clock)
+        self.sconn = WCDMAProtocol(FakeDevice())
+        self.sconn.mal = FakeMal()
+        connect_protocol(self.sconn, self.modem)
+
+    def test_split_cmd_line(self):
+        self.assertEqual(split_cmd_line('AT+CSQ;+CREG?'), ['+CSQ', '+CREG?'])
+        self.assertEqual(split_cmd_line('AT+CPBW=1,"a;b",129,"c"'),
+                         ['+CPBW=1,"a;b",129,"c"'])
+
+    def test_pdu_length(self):
+        self.assertEqual(pdu_length(PDU), 29)
+
+    def test_response_after_latency(self):
+        results = []
+        self.sconn.get_imei().addCallback(
+                lambda r: results.append(r[0].group('imei')))
+        self.assertEqual(results, [])
+        self.clock.advance(0.1)
+        self.assertEqual(results, [self.modem.state.imei])
+
+    def test_compound_command(self):
+        results = []
+        self.sconn.begin_compound()
+        self.sconn.get_signal_quality().addCallback(
+                lambda r: results.append(int(r[0].group('rssi'))))
+        self.sconn.get_netreg_status().addCallback(
+                lambda r: results.append(int(r[0].group('status'))))
+        self.sconn.end_compound()
+        self.clock.advance(0.1)
+        self.assertEqual(self.modem.processed, 1)
+        self.assertEqual(results, [20, 1])
+
+    def test_sms_roundtrip(self):
+        results = []
+        d = self.sconn.save_sms(PDU, pdu_length(PDU))
+        d.addCallback(lambda r: results.append(int(r[0].group('index'))))
+        # the prompt and the response
+        self.clock.advance(0.1)
+        self.clock.advance(0.1)
+        self.assertEqual(results, [1])
+
+        self.sconn.list_sms().addCallback(results.append)
+        self.clock.advance(0.1)
+        self.assertEqual(results[1][0].group('pdu'), PDU)
+
+    def test_more_messages_mode(self):
+        for mode in [2, None, None, 0, None]:
+            if mode is None:
+                self.sconn.send_sms(PDU, pdu_length(PDU))
+            else:
+                self.sconn.set_more_messages_mode(mode)
+            for i in range(2):
+                self.clock.advance(0.1)
+
+        # the first two share the link
+        self.assertEqual(self.modem.smsc_links, 2)
+        self.assertEqual(self.modem.state.message_ref, 3)
+
+    def test_list_unread_sms(self):
+        self.modem.state.store_sms(PDU, stat=1)
+        for i in range(3):
+            self.modem.receive_sms(PDU)
+
+        results = []
+        self.sconn.list_sms(0).addCallback(results.append)
+        self.clock.advance(0.1)
+        self.assertEqual([int(r.group('id')) for r in results[0]], [2, 3, 4])
+        self.assertEqual(self.modem.processed, 1)
+        # they are read now
+        self.sconn.list_sms(0).addCallback(results.append)
+        self.clock.advance(0.1)
+        self.assertEqual(results[1], [])
+
+    def test_sms_storage(self):
+        for i in range(2):
+            self.modem.receive_sms(PDU)
+
+        results = []
+        self.sconn.get_sms_storage().addCallback(results.extend)
+        self.clock.advance(0.1)
+        self.assertEqual([(r.group('mem'), int(r.group('used')))
+                          for r in results], [('SM', 2)])
+
+    def test_injected_notification(self):
+        self.modem.receive_sms(PDU)
+        self.assertEqual(self.sconn.mal.notified, [1])
+        self.assertEqual(self.modem.state.sms[1], (0, PDU))
+
+    def test_direct_sms(self):
+        self.sconn.set_message_service(1)
+        self.sconn.set_sms_indication(2, 2, 0, 1, 0)
+        for i in range(2):
+            self.clock.advance(0.1)
+        self.sconn.sms_ack = True
+
+        self.modem.receive_sms(PDU)
+        self.assertEqual(self.sconn.mal.notified, [PDU])
+        self.clock.advance(0.1)
+        self.assertEqual(self.modem.acks, 1)
+        self.assertEqual(self.modem.state.sms, {})
+
+    def test_phonebook(self):
+        results = []
+        self.sconn.add_contact('John', '+4917212345', 3)
+        self.sconn.list_contacts().addCallback(results.extend)
+        self.clock.advance(0.1)
+        self.clock.advance(0.1)
+        self.assertEqual([(c.group('id'), c.group('name')) for c in results],
+                         [('3', 'John')])
+
+    def test_sim_pin_error(self):
+        self.modem.state = ModemState()
+        self.modem.state.sim_status = SIM_PIN
+        failures = []
+        d = self.sconn.get_imsi()
+        d.addErrback(lambda f: failures.append(f.trap(E.SimPinRequired)))
+        self.clock.advance(0.1)
+        self.assertEqual(failures, [E.SimPinRequired])
+        self.flushLoggedErrors(E.SimPinRequired)
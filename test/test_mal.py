@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the mal module"""
+
+import sys
+from datetime import datetime, timedelta
+
+from twisted.internet.defer import succeed, fail, Deferred
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+# python-messaging 0.5.11 or 0.5.12, later versions only run on Python 3
+import core.mal
+from core.mal import (MessageAssemblyLayer, SMS_NOTIFICATION_WINDOW,
+                      DELIVERY_REPORT_TTL, SNAPSHOT_DELAY)
+from wader.common.signals import (SIG_MMS, SIG_SMS, SIG_SMS_COMP,
+                                  SIG_SMS_DELV, SIG_SMS_DELV_TIMEOUT)
+from wader.common.exceptions import MalformedSMSError
+from wader.common.sms import Message
+
+from test_sms import PDU_7BIT, PDU_UCS2
+
+START = datetime(2011, 1, 1)
+ICCID = '89340100000000000001'
+
+
+def get_sms(number, index, ref=None, cnt=None, seq=0, minutes=0):
+    """Returns the SMS read from ``index``, a fragment if ``cnt``"""
+    sms = Message(number=number, index=index, where=1,
+                  _datetime=START + timedelta(minutes=minutes),
+                  ref=ref, cnt=cnt, seq=seq)
+    sms.add_text_fragment('sms %d' % index, seq)
+    return sms
+
+
+def read_sms(pdu, index):
+    """Returns the SMS ``pdu`` as read from ``index``"""
+    sms = Message.from_pdu(pdu)
+    sms.index, sms.where = index, 1
+    return sms
+
+
+def get_wap_push(index, tx_id, _from, ref, minutes=0):
+    """
+    Returns the two parts of a WAP push read from ``index`` onwards
+
+    Its text is the Transaction-Id and the sender of the MMS, as read
+    by :func:`extract_push_notification`
+    """
+    parts = []
+    for seq, text in [(1, tx_id), (2, ' ' + _from)]:
+        sms = Message(number='+34600000000', index=index + seq - 1, where=1,
+                      _datetime=START + timedelta(minutes=minutes),
+                      fmt=0x04, ref=ref, cnt=2, seq=seq)
+        sms.add_text_fragment(text, seq)
+        parts.append(sms)
+
+    return parts
+
+
+class FakeNotification(object):
+
+    content_type = 'application/vnd.wap.mms-message'
+
+    def __init__(self, tx_id, _from):
+        self.headers = {'Transaction-Id': tx_id, 'From': _from}
+
+
+def extract_push_notification(text):
+    return FakeNotification(*text.split())
+
+
+def get_status_report(ref):
+    """Returns the PDU of the delivery report of the SMS sent as ``ref``"""
+    return ('07914306073011F006%02X0B914316325476F8111010123450001110101235'
+            '000000' % ref)
+
+
+class FakeWrapper(object):
+    """I am the storage of the SMS that the MAL reads"""
+
+    def __init__(self):
+        # {real index: Message}
+        self.storage = {}
+        # the real indexes of the unread SMS
+        self.unread = set()
+        self.state_dict = {}
+        self.signals = []
+        # the real indexes read and the statuses listed
+        self.read = []
+        self.listed = []
+        # the TP-MRs of the SMS to send
+        self.refs = []
+        # the real indexes whose PDU can not be read
+        self.malformed = set()
+
+    def emit_signal(self, signal, *args):
+        self.signals.append((signal,) + args)
+
+    def do_get_sms(self, index):
+        self.read.append(index)
+        if index in self.malformed:
+            return fail(MalformedSMSError("Malformed PDU"))
+        return succeed(self.storage.get(index))
+
+    def do_list_sms(self, status=4, priority=None):
+        self.listed.append(status)
+        indexes = sorted(self.storage)
+        if status == 0:
+            indexes = [i for i in indexes if i in self.unread]
+            self.unread.difference_update(indexes)
+        indexes = [i for i in indexes if i not in self.malformed]
+        return succeed([self.storage[i] for i in indexes])
+
+    def get_iccid(self):
+        return succeed(ICCID)
+
+    def get_sms_storage(self):
+        return succeed((len(self.storage), 30))
+
+    def do_save_sms(self, sms):
+        index = max([0] + self.storage.keys()) + 1
+        self.storage[index] = Message(sms.number, sms.text, index=index,
+                                      where=2)
+        return succeed([index])
+
+    def do_send_sms(self, sms):
+        return succeed(self.refs.pop(0))
+
+    def do_acknowledge_mms(self, index, extra_info):
+        return succeed(None)
+
+    def do_delete_sms(self, index):
+        del self.storage[index]
+        return succeed(None)
+
+
+class TestMessageAssemblyLayer(unittest.TestCase):
+    """Tests for core.mal.MessageAssemblyLayer"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.wrapper = FakeWrapper()
+        self.mal = MessageAssemblyLayer(self.wrapper)
+        self.mal.clock = self.clock
+
+    def patch_wap_push(self):
+        self.patch(core.mal, 'is_a_wap_push_notification', lambda text: True)
+        self.patch(core.mal, 'extract_push_notification',
+                   extract_push_notification)
+        self.patch(core.mal, 'is_mms_notification', lambda n: True)
+
+    def store(self, *messages):
+        for sms in messages:
+            self.wrapper.storage[sms.index] = sms
+
+    def send_sms(self, *refs):
+        self.wrapper.refs.append(list(refs))
+        sms = Message('+34612345678', 'hello')
+        sms.status_request = True
+        self.mal.send_sms(sms)
+
+    def test_notifications_are_listed_at_once(self):
+        # another unread SMS that was not notified
+        self.store(get_sms('+34600000001', 3), get_sms('+34600000002', 4),
+                   get_sms('+34600000003', 5))
+        self.wrapper.unread.update([3, 4, 5])
+        results = []
+        self.mal.on_sms_notification(3).addCallback(results.append)
+        self.mal.on_sms_notification(4).addCallback(results.append)
+        self.assertEqual(self.wrapper.listed, [])
+
+        self.clock.advance(SMS_NOTIFICATION_WINDOW)
+        self.assertEqual(self.wrapper.listed, [0])
+        self.assertEqual(self.wrapper.read, [])
+        self.assertEqual(results, [1, 2])
+        self.assertEqual(self.wrapper.signals,
+                         [(SIG_SMS, 1, True), (SIG_SMS_COMP, 1, True),
+                          (SIG_SMS, 2, True), (SIG_SMS_COMP, 2, True)])
+
+    def test_notified_sms_missing_from_listing_are_read(self):
+        # 4 was listed meanwhile, 5 can not be parsed
+        self.store(get_sms('+34600000001', 3), get_sms('+34600000002', 4),
+                   get_sms('+34600000003', 5))
+        self.wrapper.unread.update([3, 5])
+        self.wrapper.malformed.add(5)
+        results, errors = [], []
+        for index in [3, 4, 5]:
+            d = self.mal.on_sms_notification(index)
+            d.addCallbacks(results.append, errors.append)
+
+        self.clock.advance(SMS_NOTIFICATION_WINDOW)
+        self.assertEqual(self.wrapper.read, [4, 5])
+        # the good reads are still added and signalled
+        self.assertEqual(results, [1, 2])
+        self.assertEqual(len(errors), 1)
+        errors[0].trap(MalformedSMSError)
+        self.assertEqual(self.wrapper.signals,
+                         [(SIG_SMS, 1, True), (SIG_SMS_COMP, 1, True),
+                          (SIG_SMS, 2, True), (SIG_SMS_COMP, 2, True)])
+
+    def test_delivery_report(self):
+        self.send_sms(5)
+        self.mal.on_sms_delivery_report(get_status_report(5))
+        self.assertEqual(self.wrapper.signals, [(SIG_SMS_DELV, 5)])
+        self.assertEqual(self.mal.reports, {})
+        self.assertEqual(self.mal.report_refs, [])
+
+    def test_delivery_reports_expire(self):
+        self.send_sms(5)
+        self.clock.advance(60)
+        self.send_sms(6)
+
+        self.clock.advance(DELIVERY_REPORT_TTL - 60)
+        self.assertEqual(self.wrapper.signals, [(SIG_SMS_DELV_TIMEOUT, 5)])
+        self.assertEqual(self.mal.report_refs, [6])
+
+        # too late
+        self.mal.on_sms_delivery_report(get_status_report(5))
+        self.clock.advance(60)
+        self.assertEqual(self.wrapper.signals, [(SIG_SMS_DELV_TIMEOUT, 5),
+                                                (SIG_SMS_DELV_TIMEOUT, 6)])
+        self.assertEqual(self.mal.reports, {})
+        self.assertEqual(self.mal.report_refs, [])
+
+    def test_reused_reference(self):
+        self.send_sms(5)
+        # the TP-MR wrapped around before the report of the first one
+        self.send_sms(5)
+        self.assertEqual(self.wrapper.signals, [(SIG_SMS_DELV_TIMEOUT, 5)])
+
+        self.mal.on_sms_delivery_report(get_status_report(5))
+        self.assertEqual(self.wrapper.signals[1:], [(SIG_SMS_DELV, 5)])
+        self.assertEqual(self.mal.report_refs, [])
+
+    def test_multipart_reports_arrive_in_part(self):
+        self.send_sms(6, 7, 8)
+        self.mal.on_sms_delivery_report(get_status_report(7))
+        self.assertEqual(self.wrapper.signals, [])
+        self.assertEqual(self.mal.report_refs, [6, 8])
+
+        # one of the parts is never confirmed
+        self.clock.advance(DELIVERY_REPORT_TTL)
+        self.assertEqual(self.wrapper.signals, [(SIG_SMS_DELV_TIMEOUT, 6)])
+        self.assertEqual(self.mal.reports, {})
+        self.assertEqual(self.mal.report_refs, [])
+
+    def test_fragment_matches_its_siblings(self):
+        number = '+34600000001'
+        self.store(get_sms(number, 1, ref=7, cnt=3, seq=1),
+                   get_sms(number, 2, ref=7, cnt=3, seq=3),
+                   get_sms(number, 3, ref=7, cnt=3, seq=2))
+        messages = []
+        self.mal.list_sms().addCallback(messages.extend)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['text'], 'sms 1sms 3sms 2')
+        self.assertEqual(self.mal.sms_map[1].real_indexes, set([1, 2, 3]))
+
+    def test_same_reference_from_two_senders(self):
+        self.store(get_sms('+34600000001', 1, ref=7, cnt=2, seq=1),
+                   get_sms('+34600000002', 2, ref=7, cnt=2, seq=1),
+                   get_sms('+34600000002', 3, ref=7, cnt=2, seq=2),
+                   get_sms('+34600000001', 4, ref=7, cnt=2, seq=2))
+        self.mal.list_sms()
+        self.assertEqual(sorted((sms.number, sms.text)
+                                for sms in self.mal.sms_map.values()),
+                         [('+34600000001', 'sms 1sms 4'),
+                          ('+34600000002', 'sms 2sms 3')])
+
+    def test_reference_reused_later(self):
+        number = '+34600000001'
+        self.store(get_sms(number, 1, ref=7, cnt=2, seq=1),
+                   get_sms(number, 2, ref=7, cnt=2, seq=1, minutes=60),
+                   get_sms(number, 3, ref=7, cnt=2, seq=2, minutes=60))
+        self.mal.list_sms()
+        self.failIf(self.mal.sms_map[1].completed)
+        self.assertEqual(self.mal.sms_map[2].real_indexes, set([2, 3]))
+        self.assertEqual(self.mal.fragments.values(), [[1]])
+
+    def test_fragment_index_cleanup_after_assembly(self):
+        number = '+34600000001'
+        self.store(get_sms(number, 1, ref=7, cnt=2, seq=1))
+        self.mal.list_sms()
+        self.assertEqual(self.mal.fragments.values(), [[1]])
+
+        self.store(get_sms(number, 2, ref=7, cnt=2, seq=2))
+        self.mal.on_sms_notification(2)
+        self.clock.advance(SMS_NOTIFICATION_WINDOW)
+        self.failUnless(self.mal.sms_map[1].completed)
+        self.assertEqual(self.mal.fragments, {})
+
+    def test_fragment_index_cleanup_after_deletion(self):
+        self.store(get_sms('+34600000001', 1, ref=7, cnt=2, seq=1))
+        self.mal.list_sms()
+        self.mal.delete_sms(1)
+        self.assertEqual(self.mal.fragments, {})
+        self.assertEqual(self.wrapper.storage, {})
+
+        # a late sibling starts a new SMS
+        self.store(get_sms('+34600000001', 2, ref=7, cnt=2, seq=2))
+        self.mal.on_sms_notification(2)
+        self.clock.advance(SMS_NOTIFICATION_WINDOW)
+        self.assertEqual(self.mal.sms_map.keys(), [2])
+        self.assertEqual(self.mal.fragments.values(), [[2]])
+
+    def test_mms_notifications_are_matched(self):
+        self.patch_wap_push()
+        self.store(*get_wap_push(1, 'tx1', '+34611111111', ref=1))
+        # sent again later, and the same Transaction-Id from someone else
+        self.store(*get_wap_push(3, 'tx1', '+34611111111', ref=2,
+                                 minutes=5))
+        self.store(*get_wap_push(5, 'tx1', '+34622222222', ref=3))
+        self.mal.list_sms()
+
+        self.assertEqual(self.mal.sms_map, {})
+        self.assertEqual(self.mal.wap_index, {('tx1', '+34611111111'): 0,
+                                              ('tx1', '+34622222222'): 1})
+        container = self.mal.wap_map[0]
+        self.assertEqual(len(container.notifications), 2)
+        self.assertEqual(container.last[0].real_indexes, set([3, 4]))
+        self.assertEqual(len(self.mal.wap_map[1].notifications), 1)
+
+    def test_mms_signal_is_emitted_once(self):
+        self.patch_wap_push()
+        self.mal.list_sms()
+        for index in [1, 3]:
+            self.store(*get_wap_push(index, 'tx1', '+34611111111', ref=index))
+            self.mal.on_sms_notification(index)
+            self.mal.on_sms_notification(index + 1)
+            self.clock.advance(SMS_NOTIFICATION_WINDOW)
+
+        signals = [s for s in self.wrapper.signals if s[0] == SIG_MMS]
+        self.assertEqual(signals, [(SIG_MMS, 0, {
+                'Transaction-Id': 'tx1', 'From': '+34611111111',
+                'Content-Type': FakeNotification.content_type})])
+        self.assertEqual(len(self.mal.wap_map[0].notifications), 2)
+
+    def test_mms_container_cleanup_after_ack(self):
+        self.patch_wap_push()
+        self.store(*get_wap_push(1, 'tx1', '+34611111111', ref=1))
+        self.store(*get_wap_push(3, 'tx1', '+34611111111', ref=2))
+        self.store(*get_wap_push(5, 'tx1', '+34622222222', ref=3))
+        self.mal.list_sms()
+
+        self.mal.acknowledge_mms(0, {})
+        self.assertEqual(self.mal.wap_map.keys(), [1])
+        self.assertEqual(self.mal.wap_index, {('tx1', '+34622222222'): 1})
+        self.assertEqual(sorted(self.wrapper.storage), [5, 6])
+
+        # the Transaction-Id is not matched with the deleted container
+        self.store(*get_wap_push(7, 'tx1', '+34611111111', ref=4))
+        self.mal.on_sms_notification(7)
+        self.mal.on_sms_notification(8)
+        self.clock.advance(SMS_NOTIFICATION_WINDOW)
+        self.assertEqual(self.mal.wap_index[('tx1', '+34611111111')], 2)
+        self.assertEqual(len(self.mal.wap_map[2].notifications), 1)
+
+    def test_resync_keeps_mms_notifications(self):
+        self.patch_wap_push()
+        self.store(*get_wap_push(1, 'tx1', '+34611111111', ref=1))
+        self.store(*get_wap_push(3, 'tx1', '+34611111111', ref=2))
+        self.mal.list_sms()
+
+        self.mal._resync(get_wap_push(1, 'tx1', '+34611111111', ref=1) +
+                         get_wap_push(3, 'tx1', '+34611111111', ref=2))
+        self.assertEqual(self.mal.wap_index, {('tx1', '+34611111111'): 0})
+        self.assertEqual(len(self.mal.wap_map[0].notifications), 2)
+        self.failIf(SIG_MMS in [s[0] for s in self.wrapper.signals])
+
+        deleted = []
+        self.patch(self.wrapper, 'do_delete_sms',
+                   lambda index: succeed(deleted.append(index)))
+        self.mal.acknowledge_mms(0, {})
+        self.assertEqual(sorted(deleted), [1, 2, 3, 4])
+
+
+class TestSmsSnapshots(unittest.TestCase):
+    """Tests for the SMS snapshots of core.mal.MessageAssemblyLayer"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.wrapper = FakeWrapper()
+        self.mal = MessageAssemblyLayer(self.wrapper)
+        self.mal.clock = self.clock
+        self.mal.snapshots.load(self.mktemp())
+        self.mal.snapshots.put(ICCID, {1: (1, PDU_7BIT), 2: (1, PDU_UCS2)})
+
+    def store(self, *messages):
+        for sms in messages:
+            self.wrapper.storage[sms.index] = sms
+
+    def initialize(self):
+        messages = []
+        self.mal.initialize().addCallback(messages.extend)
+        # before the storage is checked
+        self.assertEqual(self.wrapper.listed, [])
+        self.clock.advance(0)
+        self.clock.advance(SNAPSHOT_DELAY)
+        return messages
+
+    def test_snapshot_matches_storage(self):
+        self.store(read_sms(PDU_7BIT, 1), read_sms(PDU_UCS2, 2))
+        messages = self.initialize()
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(self.wrapper.listed, [])
+        self.failUnless(self.mal.cached)
+        self.assertEqual(self.mal.snapshots.get(ICCID),
+                         {1: (1, PDU_7BIT), 2: (1, PDU_UCS2)})
+
+    def test_new_unread_sms(self):
+        self.store(read_sms(PDU_7BIT, 1), read_sms(PDU_UCS2, 2),
+                   read_sms(PDU_UCS2, 5))
+        self.wrapper.unread.add(5)
+        self.initialize()
+        # only the unread ones are listed
+        self.assertEqual(self.wrapper.listed, [0])
+        self.assertEqual(self.wrapper.signals,
+                         [(SIG_SMS, 3, True), (SIG_SMS_COMP, 3, True)])
+        self.assertEqual(sorted(self.mal.snapshots.get(ICCID)), [1, 2, 5])
+
+    def test_deleted_sms_are_relisted(self):
+        # deleted while we were not running
+        self.store(read_sms(PDU_UCS2, 2))
+        self.initialize()
+        self.assertEqual(self.wrapper.listed, [4])
+        # the logical index served from the snapshot is kept
+        self.assertEqual(self.mal.sms_map.keys(), [2])
+        self.assertEqual(self.mal.sms_map[2].real_indexes, set([2]))
+        self.assertEqual(self.wrapper.signals, [])
+        self.assertEqual(self.mal.snapshots.get(ICCID), {2: (1, PDU_UCS2)})
+
+    def test_reused_real_index_is_relisted(self):
+        # 1 was deleted and its real index reused
+        self.store(read_sms(PDU_UCS2, 1), read_sms(PDU_UCS2, 2),
+                   read_sms(PDU_7BIT, 3))
+        self.initialize()
+        self.assertEqual(sorted(self.mal.sms_map), [2, 3, 4])
+        self.assertEqual(self.mal.sms_map[2].real_indexes, set([2]))
+        self.assertEqual(self.wrapper.signals,
+                         [(SIG_SMS, 3, True), (SIG_SMS_COMP, 3, True),
+                          (SIG_SMS, 4, True), (SIG_SMS_COMP, 4, True)])
+
+    def test_read_sms_missing_from_snapshot_are_relisted(self):
+        self.store(read_sms(PDU_7BIT, 1), read_sms(PDU_UCS2, 2),
+                   read_sms(PDU_UCS2, 5))
+        self.initialize()
+        # no unread one accounts for the difference
+        self.assertEqual(self.wrapper.listed, [0, 4])
+        self.assertEqual(sorted(self.mal.sms_map), [1, 2, 3])
+        self.assertEqual(self.mal.sms_map[3].real_indexes, set([5]))
+        self.assertEqual(sorted(self.mal.snapshots.get(ICCID)), [1, 2, 5])
+
+    def test_snapshot_is_written_after_deletion(self):
+        self.store(read_sms(PDU_7BIT, 1), read_sms(PDU_UCS2, 2))
+        self.initialize()
+        deleted = {}
+        self.patch(self.wrapper, 'do_delete_sms',
+                   lambda index: deleted.setdefault(index, Deferred()))
+        self.mal.delete_sms(1)
+        self.mal.delete_sms(2)
+        self.clock.advance(SNAPSHOT_DELAY)
+        self.assertEqual(sorted(self.mal.snapshots.get(ICCID)), [1, 2])
+
+        deleted[1].callback(None)
+        deleted[2].callback(None)
+        # written once both are deleted
+        self.assertEqual(sorted(self.mal.snapshots.get(ICCID)), [1, 2])
+        self.clock.advance(SNAPSHOT_DELAY)
+        self.assertEqual(self.mal.snapshots.get(ICCID), {})
+
+    def test_snapshot_with_saved_sms_is_discarded(self):
+        self.store(read_sms(PDU_7BIT, 1), read_sms(PDU_UCS2, 2))
+        self.initialize()
+        # its PDU is not known
+        self.mal.save_sms(Message('+34612345678', 'draft'))
+        self.clock.advance(SNAPSHOT_DELAY)
+        self.assertEqual(self.mal.snapshots.get(ICCID), None)
+
+        self.mal.initialize()
+        self.assertEqual(self.wrapper.listed, [4])
+        self.assertEqual(len(self.mal.sms_map), 3)
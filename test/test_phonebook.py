@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the phonebook module"""
+
+import sys
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+from core.phonebook import Phonebook
+import wader.common.aterrors as E
+
+
+class Contact(object):
+
+    def __init__(self, name, number, index=None):
+        self.name = name
+        self.number = number
+        self.index = index
+
+
+class FakeSIM(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.contacts = {}
+        self.listings = 0
+        self.fail_writes = False
+
+
+class FakeDevice(object):
+    sim = None
+
+
+class FakeWrapper(object):
+    """I keep a phonebook as the contact methods of the wrapper"""
+
+    def __init__(self, sim):
+        self.device = FakeDevice()
+        self.sim = sim
+
+    def get_phonebook_size(self):
+        return defer.succeed(self.sim.size)
+
+    def list_contacts(self):
+        self.sim.listings += 1
+        return defer.succeed([self.sim.contacts[i]
+                                for i in sorted(self.sim.contacts)])
+
+    def add_contact(self, contact):
+        if self.sim.fail_writes:
+            return defer.fail(E.General())
+        self.sim.contacts[contact.index] = contact
+        return defer.succeed(contact.index)
+
+    def delete_contact(self, index):
+        del self.sim.contacts[index]
+        return defer.succeed('OK')
+
+
+class TestPhonebook(unittest.TestCase):
+    """Tests for core.phonebook.Phonebook"""
+
+    def setUp(self):
+        self.sim = FakeSIM(5)
+        self.sim.contacts[2] = Contact(u'Alice', u'+34600000001', index=2)
+        self.phonebook = Phonebook(FakeWrapper(self.sim))
+
+    def add(self, name, number):
+        results = []
+        self.phonebook.add_contact(Contact(name, number)).addBoth(
+                                                            results.append)
+        return results[0]
+
+    def test_adds_use_free_slots_without_listing(self):
+        indexes = [self.add(u'Bob %d' % i, u'60000000%d' % i)
+                        for i in range(4)]
+        self.assertEqual(indexes, [1, 3, 4, 5])
+        self.assertEqual(self.sim.listings, 1)
+        self.assertEqual(sorted(self.sim.contacts), range(1, 6))
+
+        # the phonebook is full
+        self.failUnless(self.add(u'Carol', u'600000009').check(E.MemoryFull))
+
+    def test_failed_write_frees_the_slot(self):
+        self.sim.fail_writes = True
+        self.failUnless(self.add(u'Bob', u'600000001').check(E.General))
+        self.assertEqual(self.phonebook.get_free_index(), 1)
+
+    def test_reads_from_memory(self):
+        results = []
+        self.phonebook.find_contacts(u'ali').addCallback(results.append)
+        self.phonebook.find_contacts_by_number(u'600000001').addCallback(
+                                                            results.append)
+        self.phonebook.delete_contact(2)
+        self.phonebook.get_count().addCallback(results.append)
+
+        self.assertEqual([c.index for c in results[0]], [2])
+        self.assertEqual([c.index for c in results[1]], [2])
+        self.assertEqual(results[2], 0)
+        self.assertEqual(self.sim.listings, 1)
+        self.assertEqual(self.phonebook.get_free_index(), 1)
@@ -0,0 +1,573 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the protocol module"""
+
+import re
+import sys
+
+from twisted.internet.defer import CancelledError
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+from core.command import (get_cmd_dict_copy, ATCmd, PRIORITY_INTERACTIVE,
+                          PRIORITY_CONNECTION, PRIORITY_BACKGROUND)
+from core.protocol import (ResponseParser, NotificationDispatcher,
+                           PriorityCommandQueue, WCDMAProtocol,
+                           BUFFER_COMPACT_THRESHOLD,
+                           rewind_lines, SMS_RECEIVED)
+import wader.common.aterrors as E
+
+cmd_dict = get_cmd_dict_copy()
+
+CMGL_RESPONSE = ('\r\n+CMGL: 1,1,,29\r\n'
+                 '07914306073011F0040B914316709807F2000080309141958240'
+                 '0BC8329BFD06DDDF723619\r\n'
+                 '+CMGL: 2,1,,27\r\n'
+                 '07914306073011F0040B914316709807F20000803091419593400'
+                 '9C8329BFD0661D32C\r\n'
+                 '+CMGL: 3,1,,28\r\n'
+                 '07914306073011F0040B914316709807F200008030914195044'
+                 '00AC8329BFD06C9D36C32\r\n'
+                 '\r\nOK\r\n')
+
+
+def chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def feed_all(parser, pieces):
+    """Feeds ``pieces`` to ``parser`` and returns the end match"""
+    for piece in pieces:
+        parser.feed(piece)
+        match = parser.search_end()
+        if match:
+            return match
+
+        parser.advance()
+
+
+class TestResponseParser(unittest.TestCase):
+    """Tests for core.protocol.ResponseParser"""
+
+    def _assert_same_matches(self, name, text, size):
+        extract = cmd_dict[name]['extract']
+        expected = [m.groupdict() for m in re.finditer(extract, text)]
+
+        parser = ResponseParser(cmd_dict[name])
+        self.failIf(feed_all(parser, chunks(text, size)) is None)
+        response = [m.groupdict() for m in parser.get_response()]
+        self.assertEqual(response, expected)
+
+    def test_list_sms_in_one_chunk(self):
+        self._assert_same_matches('list_sms', CMGL_RESPONSE,
+                                  len(CMGL_RESPONSE))
+
+    def test_list_sms_in_small_chunks(self):
+        for size in [1, 2, 3, 7, 16, 64]:
+            self._assert_same_matches('list_sms', CMGL_RESPONSE, size)
+
+    def test_list_contacts_in_small_chunks(self):
+        text = ('\r\n+CPBR: 1,"+4917212345",145,"John"\r\n'
+                '+CPBR: 2,"+4917212346",145,"Paul"\r\n'
+                '+CPBR: 3,"+4917212347",145,"Ringo"\r\n\r\nOK\r\n')
+        for size in [1, 5, 11, len(text)]:
+            self._assert_same_matches('list_contacts', text, size)
+
+    def test_single_line_response_in_small_chunks(self):
+        text = '\r\n351234567890123\r\n\r\nOK\r\n'
+        for size in [1, 3, len(text)]:
+            self._assert_same_matches('get_imei', text, size)
+
+    def test_matches_are_collected_before_the_end(self):
+        parser = ResponseParser(cmd_dict['list_sms'])
+        # everything but the final OK
+        parser.feed(CMGL_RESPONSE[:-6])
+        self.assertEqual(len(parser.matches), 3)
+        self.assertEqual(parser.search_end(), None)
+
+    def test_notifications_are_consumed_from_the_tail(self):
+        seen = []
+
+        def process(_buffer):
+            while True:
+                match = SMS_RECEIVED.search(_buffer)
+                if not match:
+                    return _buffer
+                seen.append(int(match.group('id')))
+                _buffer = _buffer.replace(match.group(), '', 1)
+
+        parser = ResponseParser(cmd_dict['get_imei'], process)
+        pieces = ['\r\n351234567890123\r\n',
+                  '\r\n+CMTI: "SM",4\r\n',
+                  '\r\nOK\r\n']
+        self.failIf(feed_all(parser, pieces) is None)
+        self.assertEqual(seen, [4])
+        response = parser.get_response()
+        self.assertEqual(len(response), 1)
+        self.assertEqual(response[0].group('imei'), '351234567890123')
+        self.failIf('CMTI' in parser.buf)
+
+    def test_error_is_found(self):
+        parser = ResponseParser(cmd_dict['list_sms'])
+        parser.feed('\r\n+CMS ')
+        self.assertEqual(parser.search_error(), None)
+        parser.advance()
+        parser.feed('ERROR: 321\r\n')
+        exception, error, match = parser.search_error()
+        self.assertEqual(exception, E.CMSError321)
+
+    def test_rewind_lines(self):
+        text = 'a\r\nb\r\nc\r\nd\r\n'
+        self.assertEqual(rewind_lines(text, len(text), 1), 10)
+        self.assertEqual(rewind_lines(text, len(text), 3), 4)
+        self.assertEqual(rewind_lines(text, len(text), 5), 0)
+
+
+HUAWEI_ASYNC_REGEXP = re.compile(
+                        '\r\n(?P<signal>\^[A-Z]{3,9}):\s*(?P<args>.*?)\r\n')
+HUAWEI_TRANSLATIONS = {'^RSSI': ('SignalQuality', None),
+                       '^MODE': ('NetworkMode', None)}
+
+
+class TestNotificationDispatcher(unittest.TestCase):
+    """Tests for core.protocol.NotificationDispatcher"""
+
+    def setUp(self):
+        self.seen = []
+        self.dispatcher = NotificationDispatcher(HUAWEI_ASYNC_REGEXP,
+                                                 HUAWEI_TRANSLATIONS)
+
+    def _handler(self, kind):
+
+        def handler(match):
+            self.seen.append((kind, match.group()))
+            return True
+
+        return handler
+
+    def _dispatch(self, text, *kinds):
+        handlers = dict((kind, self._handler(kind)) for kind in kinds)
+        return self.dispatcher.dispatch(text, handlers)
+
+    def test_pipelined_notifications_in_one_pass(self):
+        text = ('\r\n^RSSI:14\r\n\r\n+CMTI: "SM",2\r\n'
+                '\r\n+CREG: 1\r\n\r\nRING\r\n')
+        left = self._dispatch(text, 'signal', 'sms_received', 'creg', 'call')
+        self.assertEqual(left, '')
+        self.assertEqual([kind for kind, _ in self.seen],
+                         ['signal', 'sms_received', 'creg', 'call'])
+
+    def test_unknown_data_is_kept(self):
+        text = '\r\n^BOOT:1,2\r\n\r\n^RSSI:14\r\n\r\n+FOO: 3\r\n'
+        left = self._dispatch(text, 'signal')
+        self.assertEqual(left, '\r\n^BOOT:1,2\r\n\r\n+FOO: 3\r\n')
+        self.assertEqual(self.seen, [('signal', '\r\n^RSSI:14\r\n')])
+
+    def test_kinds_without_handler_are_kept(self):
+        text = '\r\n+CREG: 1\r\n\r\nRING\r\n'
+        left = self._dispatch(text, 'creg')
+        self.assertEqual(left, '\r\nRING\r\n')
+
+    def test_buffer_untouched_without_notifications(self):
+        text = '\r\n351234567890123\r\n'
+        self.failUnless(self._dispatch(text, 'signal', 'creg') is text)
+
+    def test_handler_can_refuse_a_notification(self):
+        text = '\r\n^MODE:5,4\r\n'
+        left = self.dispatcher.dispatch(text, {'signal': lambda m: False})
+        self.assertEqual(left, text)
+
+    def test_multiline_notification(self):
+        text = '\r\n+CDS: 25\r\n0791447758100650\r\n\r\n^RSSI:3\r\n'
+        left = self._dispatch(text, 'sms_delivery', 'signal')
+        self.assertEqual(left, '')
+        self.assertEqual(self.seen[0][0], 'sms_delivery')
+
+
+class TestPriorityCommandQueue(unittest.TestCase):
+    """Tests for core.protocol.PriorityCommandQueue"""
+
+    def _get_all(self, queue):
+        names = []
+        while len(queue):
+            queue.get().addCallback(lambda cmd: names.append(cmd.name))
+        return names
+
+    def test_default_priorities(self):
+        # the priority depends on who asks, not on the command
+        self.assertEqual(ATCmd('AT+CSQ', name='get_signal_quality').priority,
+                         PRIORITY_INTERACTIVE)
+        cmd = ATCmd('AT+CSQ', name='get_signal_quality',
+                    priority=PRIORITY_BACKGROUND)
+        self.assertEqual(cmd.priority, PRIORITY_BACKGROUND)
+        cmd = ATCmd('AT*ENAP=0', name='send_at', priority=PRIORITY_CONNECTION)
+        self.assertEqual(cmd.priority, PRIORITY_CONNECTION)
+
+    def test_highest_class_is_served_first(self):
+        queue = PriorityCommandQueue()
+        queue.put(ATCmd('AT+CSQ', name='get_signal_quality',
+                        priority=PRIORITY_BACKGROUND))
+        queue.put(ATCmd('AT+CREG?', name='get_netreg_status',
+                        priority=PRIORITY_BACKGROUND))
+        queue.put(ATCmd('AT_OWANDATA=1', name='get_ip4_config',
+                        priority=PRIORITY_CONNECTION))
+        queue.put(ATCmd('AT+CPIN="0000"', name='send_pin'))
+        self.assertEqual(self._get_all(queue),
+                         ['send_pin', 'get_ip4_config',
+                          'get_signal_quality', 'get_netreg_status'])
+
+    def test_waiting_get_is_callbacked_on_put(self):
+        queue = PriorityCommandQueue()
+        names = []
+        queue.get().addCallback(lambda cmd: names.append(cmd.name))
+        queue.put(ATCmd('AT+CSQ', name='get_signal_quality'))
+        self.assertEqual(names, ['get_signal_quality'])
+        self.assertEqual(len(queue), 0)
+
+    def test_background_commands_do_not_starve(self):
+        queue = PriorityCommandQueue(max_overtakes=2)
+        queue.put(ATCmd('AT+CSQ', name='get_signal_quality',
+                        priority=PRIORITY_BACKGROUND))
+        for i in range(4):
+            queue.put(ATCmd('AT+CPBR=%d' % i, name='get_contact'))
+        names = self._get_all(queue)
+        self.assertEqual(names.index('get_signal_quality'), 2)
+
+    def test_put_first_goes_before_starved_commands(self):
+        queue = PriorityCommandQueue(max_overtakes=0)
+        queue.put(ATCmd('AT+CSQ', name='get_signal_quality',
+                        priority=PRIORITY_BACKGROUND))
+        queue.put(ATCmd('AT+CPBR=1', name='get_contact'))
+        queue.put_first(ATCmd('AT+CNMA', name='ack_sms'))
+        self.assertEqual(self._get_all(queue)[0], 'ack_sms')
+
+
+class FakeCustomizer(object):
+    async_regexp = None
+    signal_translations = {}
+    cmd_dict = cmd_dict
+
+
+class FakeDevice(object):
+
+    def __init__(self):
+        self.custom = FakeCustomizer()
+        self.ports = None
+        self.quirks = {}
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class TestCommandCoalescing(unittest.TestCase):
+    """Tests for the coalescing of read-only commands in WCDMAProtocol"""
+
+    def setUp(self):
+        self.sconn = WCDMAProtocol(FakeDevice())
+        self.sconn.transport = FakeTransport()
+
+    def _get_imei(self, results):
+        d = self.sconn.get_imei()
+        d.addCallback(lambda resp: results.append(resp[0].group('imei')))
+        return d
+
+    def test_identical_reads_share_one_round_trip(self):
+        results = []
+        for i in range(3):
+            self._get_imei(results)
+
+        self.assertEqual(self.sconn.transport.written, ['AT+CGSN\r\n'])
+        self.sconn.dataReceived('\r\n351234567890123\r\n\r\nOK\r\n')
+        self.assertEqual(results, ['351234567890123'] * 3)
+        self.assertEqual(self.sconn.coalesced, 2)
+        self.assertEqual(self.sconn.inflight, {})
+        self.assertEqual(len(self.sconn.stats.histograms['get_imei']['Total']),
+                         1)
+
+    def test_failure_is_shared(self):
+        failures = []
+        for i in range(2):
+            d = self.sconn.get_imei()
+            d.addErrback(lambda f: failures.append(f.trap(E.General)))
+
+        self.sconn.dataReceived('\r\nERROR\r\n')
+        self.assertEqual(failures, [E.General] * 2)
+        # the error is not learned as a latency
+        self.assertEqual(self.sconn.timeouts.samples, {})
+        self.flushLoggedErrors(E.General)
+
+    def test_queued_background_poll_is_promoted(self):
+        self.sconn.send_at('AT+CPBR=1')
+        self.sconn.get_signal_quality(PRIORITY_BACKGROUND)
+        self.sconn.promote_cmds('get_signal_quality')
+        self.sconn.send_at('AT+CPBR=2')
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.assertEqual(self.sconn.transport.written,
+                         ['AT+CPBR=1\r\n', 'AT+CSQ\r\n'])
+        self.sconn.dataReceived('\r\n+CSQ: 17,99\r\n\r\nOK\r\n')
+        self.sconn.dataReceived('\r\nOK\r\n')
+
+    def test_read_after_write_is_not_coalesced(self):
+        results = []
+        self.sconn.send_at('AT+CPBR=1')
+        self.sconn.get_charset().addCallback(results.append)
+        self.sconn.set_charset('UCS2')
+        self.sconn.get_charset().addCallback(results.append)
+
+        self.assertEqual(self.sconn.coalesced, 0)
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.sconn.dataReceived('\r\n+CSCS: "IRA"\r\n\r\nOK\r\n')
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.sconn.dataReceived('\r\n+CSCS: "UCS2"\r\n\r\nOK\r\n')
+        self.assertEqual(self.sconn.transport.written,
+                         ['AT+CPBR=1\r\n', 'AT+CSCS?\r\n',
+                          'AT+CSCS="UCS2"\r\n', 'AT+CSCS?\r\n'])
+        self.assertEqual([resp[0].group('lang') for resp in results],
+                         ['IRA', 'UCS2'])
+        self.assertEqual(self.sconn.inflight, {})
+        self.assertEqual(self.sconn.shared, {})
+
+    def test_read_is_not_promoted_ahead_of_a_write(self):
+        self.sconn.send_at('AT+CPBR=1')
+        self.sconn.send_at('AT+CMGD=1', priority=PRIORITY_BACKGROUND)
+        self.sconn.get_signal_quality(PRIORITY_BACKGROUND)
+        self.sconn.promote_cmds('get_signal_quality')
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.assertEqual(self.sconn.transport.written,
+                         ['AT+CPBR=1\r\n', 'AT+CMGD=1\r\n', 'AT+CSQ\r\n'])
+        self.sconn.dataReceived('\r\n+CSQ: 17,99\r\n\r\nOK\r\n')
+
+    def test_writes_are_not_coalesced(self):
+        self.sconn.delete_sms(1).addErrback(lambda _: None)
+        self.sconn.delete_sms(1).addErrback(lambda _: None)
+        self.assertEqual(self.sconn.coalesced, 0)
+        self.assertEqual(len(self.sconn.queue), 1)
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.assertEqual(self.sconn.transport.written,
+                         ['AT+CMGD=1\r\n'] * 2)
+
+
+class TestCommandCancellation(unittest.TestCase):
+    """Tests for the cancellation of queued and executing commands"""
+
+    def setUp(self):
+        self.sconn = WCDMAProtocol(FakeDevice())
+        self.sconn.transport = FakeTransport()
+
+    def test_queued_command_is_removed(self):
+        cancelled = []
+        self.sconn.send_at('AT+CSQ')
+        d = self.sconn.send_at('AT+CREG?')
+        d.addErrback(lambda f: cancelled.append(f.trap(CancelledError)))
+        d.cancel()
+
+        self.assertEqual(cancelled, [CancelledError])
+        self.assertEqual(len(self.sconn.queue), 0)
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.assertEqual(self.sconn.transport.written, ['AT+CSQ\r\n'])
+
+    def test_abortable_command_is_aborted(self):
+        d = self.sconn.get_network_names()
+        d.addErrback(lambda f: f.trap(CancelledError))
+        d.cancel()
+        self.assertEqual(self.sconn.transport.written,
+                         ['AT+COPS=?\r\n', '\r'])
+
+        # the final result code of the aborted command is discarded
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.assertEqual(self.sconn.state, 'idle')
+        self.assertEqual(self.sconn.inflight, {})
+
+    def test_executing_command_is_not_aborted(self):
+        d = self.sconn.send_at('AT+CSQ')
+        d.addErrback(lambda f: f.trap(CancelledError))
+        d.cancel()
+        self.assertEqual(self.sconn.transport.written, ['AT+CSQ\r\n'])
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.assertEqual(self.sconn.state, 'idle')
+
+    def test_shared_read_is_kept(self):
+        results = []
+        self.sconn.send_at('AT+CSQ')
+        first = self.sconn.get_imei()
+        first.addErrback(lambda f: f.trap(CancelledError))
+        self.sconn.get_imei().addCallback(results.append)
+        first.cancel()
+        self.assertEqual(len(self.sconn.queue), 1)
+
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.sconn.dataReceived('\r\n351234567890123\r\n\r\nOK\r\n')
+        self.assertEqual(len(results), 1)
+
+
+class TestCompoundCommands(unittest.TestCase):
+    """Tests for the compound commands in SerialProtocol"""
+
+    def setUp(self):
+        self.sconn = WCDMAProtocol(FakeDevice())
+        self.sconn.transport = FakeTransport()
+        self.results = []
+
+    def _queue_status(self):
+        self.sconn.begin_compound()
+        d1 = self.sconn.get_signal_quality()
+        d1.addCallback(lambda r: self.results.append(r[0].group('rssi')))
+        d2 = self.sconn.get_netreg_status()
+        d2.addCallback(lambda r: self.results.append(r[0].group('status')))
+        self.sconn.end_compound()
+
+    def test_one_write(self):
+        self._queue_status()
+        self.assertEqual(self.sconn.transport.written,
+                         ['AT+CSQ;+CREG?\r\n'])
+        self.sconn.dataReceived('\r\n+CSQ: 17,99\r\n'
+                                '\r\n+CREG: 0,1\r\n\r\nOK\r\n')
+        self.assertEqual(self.results, ['17', '1'])
+
+    def test_fallback_to_single_commands(self):
+        self._queue_status()
+        self.sconn.dataReceived('\r\nERROR\r\n')
+        self.sconn.dataReceived('\r\n+CSQ: 17,99\r\n\r\nOK\r\n')
+        self.sconn.dataReceived('\r\n+CREG: 0,1\r\n\r\nOK\r\n')
+        self.assertEqual(self.sconn.transport.written,
+                         ['AT+CSQ;+CREG?\r\n', 'AT+CSQ\r\n',
+                          'AT+CREG?\r\n'])
+        self.assertEqual(self.results, ['17', '1'])
+
+    def test_quirk_disables_compound_commands(self):
+        self.sconn.device.quirks = {'no_compound_commands': True}
+        self._queue_status()
+        self.assertEqual(self.sconn.transport.written, ['AT+CSQ\r\n'])
+        self.sconn.dataReceived('\r\n+CSQ: 17,99\r\n\r\nOK\r\n')
+        self.sconn.dataReceived('\r\n+CREG: 0,1\r\n\r\nOK\r\n')
+        self.assertEqual(self.results, ['17', '1'])
+
+
+class FakeMal(object):
+
+    def __init__(self):
+        self.notified = []
+
+    def on_sms_notification(self, index):
+        self.notified.append(index)
+
+    def on_sms_direct(self, pdu):
+        self.notified.append(pdu)
+
+    def on_sms_delivery_report(self, pdu):
+        self.notified.append(pdu)
+
+
+class TestProtocolBuffers(unittest.TestCase):
+    """Tests for the idle and wait buffers of BufferingStateMachine"""
+
+    def setUp(self):
+        self.sconn = WCDMAProtocol(FakeDevice())
+        self.sconn.transport = FakeTransport()
+        self.sconn.mal = FakeMal()
+
+    def test_notification_split_across_chunks(self):
+        for piece in chunks('\r\n+CMTI: "SM",3\r\n'
+                                   '\r\n+CMTI: "SM",4\r\n', 5):
+            self.sconn.dataReceived(piece)
+
+        self.assertEqual(self.sconn.mal.notified, [3, 4])
+        self.assertEqual(len(self.sconn.idlebuf), 0)
+        self.assertEqual(self.sconn.idle_pos, 0)
+
+    def test_direct_sms_split_after_its_header(self):
+        pdu = CMGL_RESPONSE.split('\r\n')[2]
+        imei = []
+        self.sconn.sms_ack = True
+        self.sconn.get_imei().addCallback(
+                lambda r: imei.append(r[0].group('imei')))
+        self.sconn.send_at('AT+CSQ')
+        for piece in ['\r\n+CMT: ,29\r\n', pdu + '\r\n',
+                      '\r\n351234567890123\r\n\r\nOK\r\n']:
+            self.sconn.dataReceived(piece)
+
+        self.assertEqual(self.sconn.mal.notified, [pdu])
+        self.assertEqual(imei, ['351234567890123'])
+        # the ack goes before the queued command
+        self.assertEqual(self.sconn.transport.written,
+                         ['AT+CGSN\r\n', 'AT+CNMA\r\n'])
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.sconn.dataReceived('\r\n+CSQ: 17,99\r\n\r\nOK\r\n')
+
+    def test_status_report_while_waiting(self):
+        pdu = ('07914306073011F006270B913426565711F70120811113454001208111'
+               '74054043')
+        imei = []
+        self.sconn.sms_ack = True
+        self.sconn.get_imei().addCallback(
+                lambda r: imei.append(r[0].group('imei')))
+        for piece in ['\r\n+CDS: 25\r\n', pdu + '\r\n',
+                      '\r\n351234567890123\r\n\r\nOK\r\n']:
+            self.sconn.dataReceived(piece)
+
+        self.assertEqual(self.sconn.mal.notified, [pdu])
+        self.assertEqual(imei, ['351234567890123'])
+        self.assertEqual(self.sconn.transport.written,
+                         ['AT+CGSN\r\n', 'AT+CNMA\r\n'])
+        self.sconn.dataReceived('\r\nOK\r\n')
+
+    def test_long_command_is_preempted_by_the_ack(self):
+        pdu = CMGL_RESPONSE.split('\r\n')[2]
+        names = []
+        self.sconn.sms_ack = True
+        self.sconn.get_network_names().addCallback(names.extend)
+        self.sconn.dataReceived('\r\n+CMT: ,29\r\n' + pdu + '\r\n')
+        self.assertEqual(self.sconn.transport.written,
+                         ['AT+COPS=?\r\n', '\r'])
+
+        # aborted, the ack goes first and then it is sent again
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.sconn.dataReceived('\r\nOK\r\n')
+        self.assertEqual(self.sconn.transport.written,
+                         ['AT+COPS=?\r\n', '\r', 'AT+CNMA\r\n',
+                          'AT+COPS=?\r\n'])
+        self.assertEqual(names, [])
+        self.sconn.dataReceived('\r\n+COPS: (2,"Vodafone ES","voda ES",'
+                                '"21401",2),,(0,1,2),(0,1,2)\r\n'
+                                '\r\nOK\r\n')
+        self.assertEqual(len(names), 1)
+
+    def test_unmatched_idle_data_is_compacted(self):
+        line = '\r\n^UNKNOWN: %s\r\n' % ('x' * 100)
+        for i in range(100):
+            self.sconn.dataReceived(line)
+
+        self.failUnless(len(self.sconn.idlebuf) < BUFFER_COMPACT_THRESHOLD)
+        self.sconn.dataReceived('\r\n+CMTI: "SM",5\r\n')
+        self.assertEqual(self.sconn.mal.notified, [5])
+
+    def test_long_response_in_small_chunks(self):
+        response = []
+        self.sconn.list_sms().addCallback(response.extend)
+        for piece in chunks(CMGL_RESPONSE, 16):
+            self.sconn.dataReceived(piece)
+
+        self.assertEqual([m.group('id') for m in response], ['1', '2', '3'])
+        self.failUnless(isinstance(response[0].group('pdu'), str))
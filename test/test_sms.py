@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the sms module"""
+
+import sys
+
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+# python-messaging 0.5.11 or 0.5.12, later versions only run on Python 3
+from messaging.sms import SmsDeliver
+from wader.common.exceptions import MalformedSMSError
+from wader.common.sms import Message, parse_deliver_header, get_pdu_datetime
+
+PDU_7BIT = ('07914306073011F0040B914316709807F20000803091419582400BC8329BF'
+            'D06DDDF723619')
+# sent at UTC+5:45, "Hola, ¿qué tal? 你好"
+PDU_UCS2 = ('07914306073011F0040B914316325476F8000811101012345023240048006F'
+            '006C0061002C002000BF0071007500E9002000740061006C003F00204F6059'
+            '7D')
+# the two parts of a concatenated SMS with reference 0xA7
+PDU_PART1 = ('07914306073011F0440B914316325476F8000011101012345023A0050003A7'
+             '0201C2E231B96C3EA3D3EAB0784C2E9BCFE8B43A2C1E93CBE6333AAD0E8BC7'
+             'E4B2F98C4EABC3E231B96C3EA3D3EAB0784C2E9BCFE8B43A2C1E93CBE6333A'
+             'AD0E8BC7E4B2F98C4EABC3E231B96C3EA3D3EAB0784C2E9BCFE8B43A2C1E93'
+             'CBE6333AAD0E8BC7E4B2F98C4EABC3E231B96C3EA3D3EAB0784C2E9BCFE8B4'
+             '3A2C1E93CBE6333AAD0E8BC7')
+PDU_PART2 = ('07914306073011F0440B914316325476F800001110101234502336050003A7'
+             '0202C865F3199D5687C56372D97C46A7D561F1985C369FD16975583C2697CD'
+             '67745A1D168FC965F3199D5603')
+# a UCS2 text with an odd number of octets
+PDU_BAD_UCS2 = '07914306073011F0040B914316325476F800081110101234502303004800'
+# sent by "Vodafone"
+PDU_ALPHANUMERIC = ('07914306073011F0040ED0D637396C7EBBCB00001110101234502315'
+                    'D9775D0E1287D961F7B80C4ACF413550B12A05')
+
+FIELDS = ['csca', 'number', 'fmt', 'date', 'ref', 'cnt', 'seq']
+
+
+class TestParseDeliverHeader(unittest.TestCase):
+    """Tests for wader.common.sms.parse_deliver_header"""
+
+    def assertMatchesSmsDeliver(self, pdu):
+        ret = parse_deliver_header(pdu)
+        data = SmsDeliver(pdu).data
+        self.assertEqual([ret.get(field) for field in FIELDS],
+                         [data.get(field) for field in FIELDS])
+
+    def test_7bit(self):
+        self.assertMatchesSmsDeliver(PDU_7BIT)
+
+    def test_ucs2(self):
+        self.assertMatchesSmsDeliver(PDU_UCS2)
+
+    def test_concatenated(self):
+        self.assertMatchesSmsDeliver(PDU_PART1)
+        self.assertMatchesSmsDeliver(PDU_PART2)
+        self.assertEqual(parse_deliver_header(PDU_PART2)['ref'], 0xA7)
+
+    def test_alphanumeric_sender(self):
+        self.assertEqual(parse_deliver_header(PDU_ALPHANUMERIC), None)
+
+    def test_truncated(self):
+        self.assertEqual(parse_deliver_header(PDU_UCS2[:-4]), None)
+
+
+class TestMessageFromPdu(unittest.TestCase):
+    """Tests for wader.common.sms.Message.from_pdu"""
+
+    def test_datetime_does_not_decode_the_text(self):
+        data = SmsDeliver(PDU_UCS2).data
+        sms = Message.from_pdu(PDU_UCS2)
+        self.assertEqual(sms.datetime, get_pdu_datetime(data))
+        self.failUnless(sms.pending)
+
+        self.assertEqual(sms.text, data['text'])
+        self.failIf(sms.pending)
+
+    def test_malformed_text_is_logged(self):
+        sms = Message.from_pdu(PDU_BAD_UCS2)
+        self.failUnless(sms.pending)
+        self.assertEqual(sms.text, u'')
+        self.assertEqual(len(self.flushLoggedErrors(MalformedSMSError)), 1)
+
+    def test_alphanumeric_sender_is_decoded_right_away(self):
+        data = SmsDeliver(PDU_ALPHANUMERIC).data
+        sms = Message.from_pdu(PDU_ALPHANUMERIC)
+        self.failIf(sms.pending)
+        self.assertEqual(sms.number, data['number'])
+        self.assertEqual(sms.datetime, get_pdu_datetime(data))
+        self.assertEqual(sms.text, data['text'])
+
+    def test_concatenated_fragments(self):
+        sms = Message.from_pdu(PDU_PART1)
+        fragment = Message.from_pdu(PDU_PART2)
+        fragment.index = 2
+
+        self.failUnless(sms.append_sms(fragment))
+        self.failUnless(fragment.pending)
+        self.assertEqual(sms.text, SmsDeliver(PDU_PART1).data['text'] +
+                                   SmsDeliver(PDU_PART2).data['text'])
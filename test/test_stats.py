@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the stats module"""
+
+import sys
+
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+from core.command import ATCmd
+from core.stats import (CommandStats, LatencyHistogram, LATENCY_BUCKETS,
+                        STAGE_QUEUED, STAGE_FIRST_BYTE, STAGE_EXECUTION,
+                        STAGE_TOTAL)
+
+
+def get_cmd(name, queued, written, first_byte, completed):
+    cmd = ATCmd('AT', name=name)
+    cmd.queued_at = queued
+    cmd.written_at = written
+    cmd.first_byte_at = first_byte
+    cmd.completed_at = completed
+    return cmd
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    """Tests for core.stats.LatencyHistogram"""
+
+    def test_add(self):
+        histogram = LatencyHistogram()
+        histogram.add(0.005)
+        histogram.add(0.010)
+        histogram.add(0.3)
+        histogram.add(60)
+        self.assertEqual(len(histogram), 4)
+        self.assertEqual(histogram.counts[0], 2)
+        self.assertEqual(histogram.counts[LATENCY_BUCKETS.index(500)], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(histogram.max, 60000)
+
+
+class TestCommandStats(unittest.TestCase):
+    """Tests for core.stats.CommandStats"""
+
+    def test_stages(self):
+        stats = CommandStats()
+        stats.on_completed(get_cmd('get_signal_quality', 0, 2, 2.04, 2.2))
+        histograms = stats.histograms['get_signal_quality']
+        self.assertEqual(histograms[STAGE_QUEUED].max, 2000)
+        self.assertEqual(histograms[STAGE_FIRST_BYTE].max, 40)
+        self.assertEqual(histograms[STAGE_EXECUTION].max, 200)
+        self.assertEqual(histograms[STAGE_TOTAL].max, 2200)
+
+    def test_unsent_commands_are_ignored(self):
+        stats = CommandStats()
+        stats.on_completed(get_cmd('get_imei', 0, None, None, 1))
+        self.assertEqual(stats.histograms, {})
+
+    def test_to_dict(self):
+        stats = CommandStats()
+        cmd = get_cmd('get_imei', 0, 0, None, 15)
+        stats.on_queue_depth(3)
+        stats.on_queue_depth(1)
+        stats.on_timeout(cmd)
+        stats.on_completed(cmd, failed=True)
+        info = stats.to_dict()
+        self.assertEqual(info['QueueDepth'], 1)
+        self.assertEqual(info['MaxQueueDepth'], 3)
+        self.assertEqual(info['Timeouts'], 1)
+        imei = info['Commands']['get_imei']
+        self.assertEqual(imei['Count'], 1)
+        self.assertEqual(imei['Errors'], 1)
+        self.assertEqual(imei['Timeouts'], 1)
+        self.assertEqual(sum(imei[STAGE_FIRST_BYTE]), 0)
+        self.assertEqual(len(imei[STAGE_TOTAL]), len(LATENCY_BUCKETS) + 1)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the timeouts module"""
+
+import os
+import sys
+
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+from core.command import ATCmd
+from core.timeouts import (TimeoutPolicy, percentile, TIMEOUT_MIN_SAMPLES,
+                           TIMEOUT_FLOOR, TIMEOUT_MARGIN)
+
+
+class TestTimeoutPolicy(unittest.TestCase):
+    """Tests for core.timeouts.TimeoutPolicy"""
+
+    def test_percentile(self):
+        samples = range(1, 101)
+        self.assertEqual(percentile(samples, 0.99), 99)
+        self.assertEqual(percentile(samples, 0.5), 50)
+        self.assertEqual(percentile([7], 0.99), 7)
+
+    def test_static_timeout_until_learned(self):
+        policy = TimeoutPolicy('E220')
+        cmd = ATCmd('AT+CSQ', name='get_signal_quality')
+        for i in range(TIMEOUT_MIN_SAMPLES - 1):
+            policy.add(cmd.name, 0.1)
+        self.assertEqual(policy.get_timeout(cmd), cmd.timeout)
+        policy.add(cmd.name, 0.1)
+        self.assertEqual(policy.get_timeout(cmd), TIMEOUT_FLOOR)
+
+    def test_learned_timeout_and_ceiling(self):
+        policy = TimeoutPolicy('E220', ceiling=20)
+        cmd = ATCmd('AT+CPBR=1,250', name='list_contacts')
+        for i in range(TIMEOUT_MIN_SAMPLES):
+            policy.add(cmd.name, 2)
+        self.assertEqual(policy.get_timeout(cmd), 2 * TIMEOUT_MARGIN)
+        policy.add(cmd.name, 10)
+        self.assertEqual(policy.get_timeout(cmd), 20)
+
+    def test_explicit_timeout_is_kept(self):
+        policy = TimeoutPolicy('E220')
+        cmd = ATCmd('AT+CFUN=1', name='enable_radio', timeout=30)
+        for i in range(TIMEOUT_MIN_SAMPLES):
+            policy.add(cmd.name, 0.1)
+        self.assertEqual(policy.get_timeout(cmd), 30)
+
+        for i in range(TIMEOUT_MIN_SAMPLES):
+            policy.add(cmd.name, 20)
+        self.assertEqual(policy.get_timeout(cmd), 20 * TIMEOUT_MARGIN)
+
+    def test_timeouts_are_not_learned(self):
+        policy = TimeoutPolicy('E220')
+        cmd = ATCmd('AT+CSQ', name='get_signal_quality')
+        for i in range(TIMEOUT_MIN_SAMPLES):
+            policy.add(cmd.name, 0.1)
+        for i in range(3):
+            cmd.timeout = policy.get_timeout(cmd)
+            policy.on_timeout(cmd, cmd.timeout)
+        self.assertEqual(policy.get_timeout(cmd), TIMEOUT_FLOOR)
+        self.assertEqual(policy.timeouts, {'get_signal_quality': 3})
+
+    def test_generic_commands_are_not_learned(self):
+        policy = TimeoutPolicy('E220')
+        for i in range(TIMEOUT_MIN_SAMPLES):
+            policy.add('send_at', 0.1)
+        self.assertEqual(policy.samples, {})
+
+    def test_persistence(self):
+        path = os.path.join(self.mktemp(), 'timeouts.pickle')
+        policy = TimeoutPolicy('E220')
+        policy.load(path)
+        policy.add('get_imei', 0.25)
+        policy.save()
+
+        other = TimeoutPolicy('K3765')
+        other.load(path)
+        other.add('get_imei', 0.5)
+        other.save()
+
+        policy = TimeoutPolicy('E220')
+        policy.load(path)
+        self.assertEqual(list(policy.samples['get_imei']), [0.25])
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the watchdog module"""
+
+import sys
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+sys.path.insert(0, '..')
+import core.protocol
+from core.protocol import WCDMAProtocol
+from core.serialport import Ports
+from core.watchdog import Watchdog, WATCHDOG_REOPEN_DELAY, WATCHDOG_TIMEOUTS
+import wader.common.aterrors as E
+
+from emulator import VirtualModem, connect_protocol
+from test_emulator import FakeDevice
+
+
+class FakeExporter(object):
+
+    def __init__(self):
+        self.recovered = []
+
+    def PortRecovered(self, success, duration):
+        self.recovered.append(success)
+
+
+class EmulatedWatchdog(Watchdog):
+    """I re-open the port against a :class:`VirtualModem`"""
+
+    def __init__(self, sconn, modem, clock):
+        super(EmulatedWatchdog, self).__init__(sconn, clock)
+        self.modem = modem
+
+    def open_port(self, path):
+        return connect_protocol(self.sconn, self.modem)
+
+
+class TestWatchdog(unittest.TestCase):
+    """Tests for core.watchdog.Watchdog"""
+
+    def setUp(self):
+        self.clock = Clock()
+        # the timeouts of the commands
+        self.patch(core.protocol, 'reactor', self.clock)
+
+        self.modem = VirtualModem()
+        self.device = FakeDevice()
+        self.device.exporter = FakeExporter()
+        self.device.ports = Ports('/dev/ttyUSB0', None)
+        self.sconn = WCDMAProtocol(self.device)
+        self.sconn.watchdog = EmulatedWatchdog(self.sconn, self.modem,
+                                               self.clock)
+        self.device.ports.dport.obj = connect_protocol(self.sconn, self.modem)
+
+    def time_out(self, n):
+        for i in range(n):
+            self.clock.advance(self.sconn.cmd.timeout)
+
+    def test_recovery(self):
+        self.modem.hung = True
+        timeouts, hung = [], []
+        for i in range(WATCHDOG_TIMEOUTS + 2):
+            d = self.sconn.send_at('AT')
+            d.addErrback(lambda f: timeouts.append(
+                                f.trap(E.SerialResponseTimeout)))
+            d.addErrback(lambda f: hung.append(f.trap(E.SerialPortHung)))
+
+        self.time_out(WATCHDOG_TIMEOUTS)
+        self.assertEqual(len(timeouts), WATCHDOG_TIMEOUTS)
+        self.assertEqual(len(hung), 2)
+        self.failUnless(self.sconn.watchdog.recovering)
+
+        # the commands queued while recovering fail right away
+        self.sconn.send_at('AT').addErrback(
+                lambda f: hung.append(f.trap(E.SerialPortHung)))
+        self.assertEqual(len(hung), 3)
+
+        self.modem.hung = False
+        self.clock.advance(WATCHDOG_REOPEN_DELAY)
+        self.assertEqual(self.device.exporter.recovered, [True])
+        stats = self.sconn.watchdog.to_dict()
+        self.assertEqual(stats['Recoveries'], 1)
+        self.failIf(stats['Recovering'])
+
+        results = []
+        self.sconn.get_imei().addCallback(results.append)
+        self.assertEqual(len(results), 1)
+
+    def test_response_resets_count(self):
+        for hung in [True] * (WATCHDOG_TIMEOUTS - 1) + [False] + \
+                    [True] * (WATCHDOG_TIMEOUTS - 1):
+            self.modem.hung = hung
+            d = self.sconn.send_at('AT')
+            d.addErrback(lambda f: f.trap(E.SerialResponseTimeout))
+            if hung:
+                self.time_out(1)
+
+        self.failIf(self.sconn.watchdog.recovering)
+        self.assertEqual(self.sconn.watchdog.timeouts, WATCHDOG_TIMEOUTS - 1)
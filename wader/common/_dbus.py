@@ -20,6 +20,7 @@
 
 import dbus
 import dbus.service
+from twisted.internet import reactor
 from twisted.python import log
 
 
@@ -35,6 +36,45 @@ class DBusExporterHelper(object):
         deferred.addErrback(self._process_failure, async_eb)
         return deferred
 
+    def add_cancellable_callbacks(self, deferred, async_cb, async_eb,
+                                  sender=None, timeout=None):
+        """
+        Like :meth:`add_callbacks` but cancels ``deferred`` when its reply
+        can not be delivered anymore
+
+        That is, when ``sender`` leaves the bus or, if given, after
+        ``timeout`` seconds, the time the caller is known to wait.
+        """
+        call = None
+        if timeout is not None:
+            call = reactor.callLater(timeout, deferred.cancel)
+
+        match = None
+        connection = getattr(self, 'connection', None)
+        if sender is not None and connection is not None:
+
+            def name_owner_changed(name, old_owner, new_owner):
+                if not new_owner:
+                    log.msg("%s left the bus, cancelling its request" % name)
+                    deferred.cancel()
+
+            match = connection.add_signal_receiver(name_owner_changed,
+                                        'NameOwnerChanged',
+                                        dbus.BUS_DAEMON_IFACE,
+                                        dbus.BUS_DAEMON_NAME,
+                                        dbus.BUS_DAEMON_PATH,
+                                        arg0=sender)
+
+        def stop_watching(result):
+            if call is not None and call.active():
+                call.cancel()
+            if match is not None:
+                match.remove()
+            return result
+
+        deferred.addBoth(stop_watching)
+        return self.add_callbacks(deferred, async_cb, async_eb)
+
     def add_callbacks_and_swallow(self, deferred, async_cb, async_eb):
         """
         Like previous method but swallows the result
@@ -71,6 +71,11 @@ class SerialResponseTimeout(dbus.DBusException):
     _dbus_error_name = "%s.%s" % (GEN_ERROR, 'SerialResponseTimeout')
 
 
+class SerialPortHung(dbus.DBusException):
+    """The device stopped answering and is being recovered"""
+    _dbus_error_name = "%s.%s" % (GEN_ERROR, 'SerialPortHung')
+
+
 class Connected(dbus.DBusException):
     """Operation attempted whilst connected"""
     _dbus_error_name = "%s.%s" % (GEN_ERROR, 'Connected')
@@ -563,14 +568,14 @@ ERROR_DICT = {
 }
 
 
-def extract_error(s):
+def extract_error(s, pos=0):
     """
-    Scans ``s`` looking for AT Errors
+    Scans ``s`` looking for AT Errors starting at offset ``pos``
 
     Returns a tuple with the exception, error and the match
     """
     try:
-        match = ERROR_REGEXP.search(s)
+        match = ERROR_REGEXP.search(s, pos)
         if match:
             try:
                 error = match.group('error')
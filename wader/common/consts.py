@@ -53,6 +53,7 @@ NET_INTFACE = 'org.freedesktop.ModemManager.Modem.Gsm.Network'
 USD_INTFACE = 'org.freedesktop.ModemManager.Modem.Gsm.Ussd'
 CRD_INTFACE = 'org.freedesktop.ModemManager.Modem.Gsm.Card'
 HSO_INTFACE = 'org.freedesktop.ModemManager.Modem.Gsm.Hso'
+DGN_INTFACE = 'org.freedesktop.ModemManager.Modem.Diagnostics'
 
 STATUS_IDLE, STATUS_HOME, STATUS_SEARCHING = 0, 1, 2
 STATUS_DENIED, STATUS_UNKNOWN, STATUS_ROAMING = 3, 4, 5
@@ -214,6 +215,12 @@ EXTRA_DIR = join(RESOURCES_DIR, 'extra')
 MBPI = '/usr/share/mobile-broadband-provider-info/serviceproviders.xml'
 NETWORKS_DB = join(DATA_DIR, 'networks.db')
 
+# caches of what we learn from the devices
+CACHE_DIR = join(BASE_DIR, 'var', 'cache', APP_SLUG_NAME)
+TIMEOUTS_CACHE = join(CACHE_DIR, 'timeouts.pickle')
+CAPABILITIES_CACHE = join(CACHE_DIR, 'capabilities.pickle')
+SMS_SNAPSHOTS_CACHE = join(CACHE_DIR, 'sms.pickle')
+
 # plugins consts
 PLUGINS_DIR = join(DATA_DIR, 'plugins')
 PLUGINS_DIR = [PLUGINS_DIR,
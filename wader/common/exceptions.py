@@ -37,6 +37,10 @@ class MalformedUssdPduError(Exception):
     """Exception raised when an error is received decoding a USSD response"""
 
 
+class MultiplexerError(Exception):
+    """Exception raised when the 27.010 multiplexer can not be set up"""
+
+
 class NetworkRegistrationError(Exception):
     """
     Exception raised when an error occurred while registering with the network
@@ -32,11 +32,13 @@ SIG_DIAL_STATS = 'DialStats'
 SIG_DISCONNECTED = 'Disconnected'
 SIG_INVALID_DNS = 'InvalidDNS'
 SIG_NETWORK_MODE = 'NetworkMode'
+SIG_PORT_RECOVERED = 'PortRecovered'
 SIG_REG_INFO = 'RegistrationInfo'
 SIG_RSSI = 'SignalQuality'
 SIG_SMS = 'SmsReceived'
 SIG_MMS = 'MMSReceived'
 SIG_SMS_COMP = 'Completed'
 SIG_SMS_DELV = 'Delivered'
+SIG_SMS_DELV_TIMEOUT = 'DeliveryTimedOut'
 SIG_SMS_NOTIFY_ONLINE = 'SmsNotifyOnline'
 SIG_TIMEOUT = 'Timeout'
@@ -17,17 +17,125 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """Sms-related classes"""
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from operator import itemgetter
 from time import mktime
 from pytz import timezone
 
+from twisted.python import log
 from zope.interface import implements
 
 from messaging.sms import SmsSubmit, SmsDeliver
+from wader.common.exceptions import MalformedSMSError
 from wader.common.interfaces import IMessage
 from wader.common.utils import get_tz_aware_now
 
+INTERNATIONAL, ALPHANUMERIC = 0x01, 0x05
+
+
+def _swap_number(digits):
+    """Returns the semi-octet encoded ``digits`` as a number"""
+    digits = digits.lower().replace('f', '')
+    return ''.join(digits[i:i + 2][::-1] for i in range(0, len(digits), 2))
+
+
+def parse_deliver_header(pdu):
+    """
+    Returns the fields of the SMS-DELIVER ``pdu`` needed to assemble it
+
+    Only the addresses, the data coding scheme, the date and the
+    concatenation header are parsed, the user data is left alone. As
+    with :class:`SmsDeliver`, the date is UTC but naive. None is returned
+    for the PDUs that must be decoded right away: status reports,
+    alphanumeric senders and malformed ones.
+
+    :rtype: dict
+    """
+    if len(pdu) % 2:
+        return None
+
+    def octet(i):
+        return int(pdu[2 * i:2 * i + 2], 16)
+
+    try:
+        smscl = octet(0)
+        csca = None
+        if smscl > 0:
+            csca = _swap_number(pdu[4:2 + 2 * smscl])
+            if (octet(1) >> 4) & 0x07 == INTERNATIONAL:
+                csca = '+' + csca
+
+        pos = 1 + smscl
+        mtype = octet(pos)
+        if mtype & 0x03 != 0x00:
+            # not a SMS-DELIVER
+            return None
+
+        sndlen = (octet(pos + 1) + 1) // 2
+        sndtype = (octet(pos + 2) >> 4) & 0x07
+        if sndtype == ALPHANUMERIC:
+            return None
+
+        pos += 3
+        number = _swap_number(pdu[2 * pos:2 * (pos + sndlen)])
+        if sndtype == INTERNATIONAL:
+            number = '+' + number
+
+        # TP-PID, TP-DCS, TP-SCTS and TP-UDL
+        pos += sndlen
+        dcs = octet(pos + 1)
+        if dcs & (0x04 | 0x08) == 0:
+            fmt = 0x00
+        elif dcs & 0x04:
+            fmt = 0x04
+        else:
+            fmt = 0x08
+
+        # the sender's local time, its offset is in quarters of an hour
+        scts = _swap_number(pdu[2 * (pos + 2):2 * (pos + 8)])
+        tz = octet(pos + 8)
+        offset = ((tz & 0x07) * 10 + (tz >> 4)) * 15
+        if tz & 0x08:
+            offset = -offset
+        date = (datetime.strptime(scts, '%y%m%d%H%M%S') -
+                timedelta(minutes=offset))
+
+        udl = octet(pos + 9)
+        pos += 10
+        needed = (udl * 7 + 7) // 8 if fmt == 0x00 else udl
+        if len(pdu) // 2 - pos < needed:
+            return None
+
+        ret = dict(csca=csca, number=number, fmt=fmt, date=date, type=None)
+        if mtype & 0x40:
+            # User Data Header, look for the concatenation IEs
+            end = pos + 1 + octet(pos)
+            pos += 1
+            while pos < end:
+                iei, ie_len = octet(pos), octet(pos + 1)
+                if iei == 0x00:
+                    ret.update(ref=octet(pos + 2), cnt=octet(pos + 3),
+                               seq=octet(pos + 4))
+                elif iei == 0x08:
+                    ret.update(ref=octet(pos + 2) << 8 | octet(pos + 3),
+                               cnt=octet(pos + 4), seq=octet(pos + 5))
+                pos += 2 + ie_len
+
+        return ret
+    except ValueError:
+        # truncated, not hexadecimal or not a valid date
+        return None
+
+
+def get_pdu_datetime(data):
+    """Returns the date of the decoded PDU ``data`` as an aware datetime"""
+    if data.get('date') is None:
+        # XXX: Should we really fake a date?
+        return get_tz_aware_now()
+
+    # SmsDeliver dates are UTC but naive
+    return data['date'].replace(tzinfo=timezone('UTC'))
+
 
 class Message(object):
     """I am a Message in the system"""
@@ -52,6 +160,10 @@ class Message(object):
         self.status_references = []
         self.status_reference = None
         self.type = None
+        # the PDU it was read from, if any
+        self.pdu = None
+        # whether the text of ``pdu`` is still to be decoded
+        self.pending = False
         self._fragments = []
 
         if text is not None:
@@ -60,9 +172,30 @@ class Message(object):
 
     @property
     def text(self):
-        return "".join(text for index, text
+        self._decode()
+        return "".join(text if isinstance(text, basestring) else text.text
+                       for index, text
                             in sorted(self._fragments, key=itemgetter(0)))
 
+    def _decode(self):
+        """Decodes the text of :attr:`pdu` if still pending"""
+        if not self.pending:
+            return
+
+        self.pending = False
+        try:
+            ret = SmsDeliver(self.pdu).data
+        # python-messaging raises any of these on a malformed PDU, and the
+        # text is read outside of the listing's error handling, e.g. by a
+        # DBus call. UnicodeDecodeError is a ValueError
+        except (IndexError, KeyError, TypeError, ValueError), e:
+            log.err(MalformedSMSError("Malformed PDU %s: %s" % (self.pdu, e)))
+            ret = dict(text=u'')
+
+        # our own fragment was added without its text
+        self._fragments = [(pos, ret['text'] if text is None else text)
+                           for pos, text in self._fragments]
+
     def __repr__(self):
         import pprint
         import StringIO
@@ -129,19 +262,20 @@ class Message(object):
         :param pdu: The PDU to convert
         :rtype: ``Message``
         """
-        ret = SmsDeliver(pdu).data
-
-        if 'date' not in ret:
-            # XXX: Should we really fake a date?
-            _datetime = get_tz_aware_now()
+        ret = parse_deliver_header(pdu)
+        if ret is None:
+            ret = SmsDeliver(pdu).data
         else:
-            # SmsDeliver dates are UTC but naive
-            _datetime = ret['date'].replace(tzinfo=timezone('UTC'))
+            # the text is decoded on first use
+            ret['text'] = None
 
-        m = cls(ret['number'], _datetime=_datetime, csca=ret['csca'],
+        m = cls(ret['number'], _datetime=get_pdu_datetime(ret),
+                csca=ret['csca'],
                 ref=ret.get('ref'), cnt=ret.get('cnt'), seq=ret.get('seq', 0),
                 fmt=ret.get('fmt'))
         m.type = ret.get('type')
+        m.pdu = pdu
+        m.pending = ret['text'] is None
         m.add_text_fragment(ret['text'], ret.get('seq', 0))
 
         return m
@@ -180,7 +314,8 @@ class Message(object):
         return sms.to_pdu()
 
     def add_fragment(self, sms):
-        self.add_text_fragment(sms.text, sms.seq)
+        # a pending fragment is kept as is and decoded with our text
+        self.add_text_fragment(sms if sms.pending else sms.text, sms.seq)
 
     def add_text_fragment(self, text, pos=0):
         self._fragments.append((pos, text))